@@ -12,6 +12,7 @@ import atexit
 import logging
 import signal
 import argparse
+import yaml
 from typing import TYPE_CHECKING, Optional
 
 from subiquitycore.ui.utils import Color, LoadingDialog, Padding
@@ -19,6 +20,8 @@ from subiquitycore.ui.buttons import header_btn
 
 from alpaquita_installer.app.distro import DISTRO_NAME
 from alpaquita_installer.common.utils import run_cmd, Arch
+from alpaquita_installer.smanager.planner import plan_host_layout
+from alpaquita_installer.installers.utils import str_size_to_bytes
 from alpaquita_installer.controllers.eula import EULAController
 from alpaquita_installer.controllers.timezone import TimezoneController
 from alpaquita_installer.controllers.proxy import ProxyController
@@ -145,9 +148,34 @@ class Application:
                             help="display menu with shim installation option")
         parser.add_argument("--no-colors", action="store_true",
                             help="do not use colors")
+        parser.add_argument("--plan-storage", action="store_true",
+                            help="print a storage configuration proposed for the host disks and exit")
+        parser.add_argument("--probe-disks", action="store_true",
+                            help="measure disk read throughput for --plan-storage")
+        parser.add_argument("--plan-swap", metavar="SIZE",
+                            help="add a swap partition of SIZE (e.g. 4G) to --plan-storage, "
+                                 "preferably on a non-rotational disk")
 
         args = parser.parse_args()
 
+        if args.plan_storage:
+            swap_size = None
+            if args.plan_swap:
+                try:
+                    swap_size = str_size_to_bytes(args.plan_swap)
+                except ValueError as exc:
+                    parser.error('--plan-swap: {}'.format(exc))
+            try:
+                data = plan_host_layout(efi=self.is_efi(), probe=args.probe_disks, swap_size=swap_size)
+            except (OSError, ValueError) as exc:
+                sys.exit('Unable to plan storage: {}'.format(exc))
+            print(yaml.dump(data, sort_keys=False), end='')
+            sys.exit(0)
+        if args.probe_disks:
+            parser.error("--probe-disks must be set with --plan-storage")
+        if args.plan_swap:
+            parser.error("--plan-swap must be set with --plan-storage")
+
         self._config_file = args.config_file if args.config_file else ''
         self._no_ui = args.no_ui
         if args.debug:
@@ -5,7 +5,9 @@ import os
 from typing import Iterable, Optional
 
 from alpaquita_installer.common.utils import run_cmd_live, write_file
+from alpaquita_installer.common.apk_index import APKIndexCache
 from alpaquita_installer.common.events import EventReceiver
+from alpaquita_installer.common.boot_artifacts import BootArtifacts
 
 
 class APKManager:
@@ -14,6 +16,10 @@ class APKManager:
 
         self.keys_dir = '/etc/apk/keys'
         self.root_dir = None
+        # Records the initramfs images and grub.cfg built by package triggers
+        self.boot_artifacts: Optional[BootArtifacts] = None
+        # Indexes verified on the Repo screen, reused instead of fetching them again
+        self.index_cache: Optional[APKIndexCache] = None
 
     @staticmethod
     def _dir_exists(d: str):
@@ -67,12 +73,37 @@ class APKManager:
         with open(self._get_repo_file_path(), 'r') as file:
             return file.read()
 
+    def _repo_urls(self) -> list[str]:
+        res = []
+        for line in self.read_repo_file().splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                # Without an optional @tag
+                res.append(line.split()[-1])
+        return res
+
+    def _use_cached_indexes(self) -> bool:
+        if (self.index_cache is None) or (self.root_dir is None):
+            return False
+        urls = self._repo_urls()
+        if not self.index_cache.covers(urls):
+            return False
+        self.index_cache.install(urls, root_dir=self.root_dir)
+        return True
+
     def add(self, args: Iterable):
-        all_args = ['apk', 'add', '--no-progress', '--update-cache', '--clean-protected']
+        all_args = ['apk', 'add', '--no-progress', '--clean-protected']
+        if not self._use_cached_indexes():
+            all_args.append('--update-cache')
         if self.root_dir is not None:
             all_args.extend(['--root', self.root_dir])
         if self.keys_dir is not None:
             all_args.extend(['--keys-dir', self.keys_dir])
         all_args.extend(args)
-        run_cmd_live(args=all_args, event_receiver=self._event_receiver,
-                     event_transform=self._transform_apk_add)
+        if self.boot_artifacts is None:
+            run_cmd_live(args=all_args, event_receiver=self._event_receiver,
+                         event_transform=self._transform_apk_add)
+            return
+        with self.boot_artifacts.track_external_builds():
+            run_cmd_live(args=all_args, event_receiver=self._event_receiver,
+                         event_transform=self._transform_apk_add)
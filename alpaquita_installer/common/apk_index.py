@@ -0,0 +1,106 @@
+#  SPDX-FileCopyrightText: 2023 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from typing import Iterable, Optional
+import glob
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger('common.apk_index')
+
+# apk keeps the indexes of remote repositories here, relative to the root
+APK_CACHE_DIR = 'var/cache/apk'
+# Indexes older than this are fetched again
+INDEX_MAX_AGE = 3600
+
+
+def is_remote_repo(url: str) -> bool:
+    return urllib.parse.urlparse(url).scheme in ('http', 'https')
+
+
+def check_apk_index(path: str, url: str, keys_dir: str):
+    """Checks the signing key and the package list of an index downloaded by 'apk update'.
+
+    apk has already verified the signature, this makes sure it was made with
+    one of the keys in keys_dir and that the index is not empty.
+    """
+    if os.path.getsize(path) == 0:
+        raise ValueError('Repository {} has an empty index.'.format(url))
+    try:
+        with tarfile.open(path, 'r:gz') as tar:
+            members = tar.getmembers()
+            sign = [m.name for m in members if m.name.startswith('.SIGN.')]
+            if not sign:
+                raise ValueError('Repository {} has an unsigned index.'.format(url))
+            key = re.sub(r'^\.SIGN\.RSA[0-9]*\.', '', sign[0])
+            if not os.path.exists(os.path.join(keys_dir, key)):
+                raise ValueError('Repository {} is signed with an unknown key {}.'.format(url, key))
+            index = [m for m in members if m.name == 'APKINDEX']
+            data = tar.extractfile(index[0]).read() if index and index[0].size else b''
+    except (tarfile.TarError, OSError, EOFError) as exc:
+        raise ValueError('Repository {} has an invalid index: {}'.format(url, exc)) from None
+    if not re.search(rb'^P:', data, flags=re.MULTILINE):
+        raise ValueError('Repository {} contains no packages.'.format(url))
+
+
+class APKIndexCache:
+    """Verified indexes of remote repositories.
+
+    The indexes fetched while validating the repositories are copied into the
+    target, so that the installation does not download them again.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self._cache_dir = cache_dir
+        self._lock = threading.Lock()
+        # URL -> (the index file name in the apk cache, when it was fetched)
+        self._indexes: dict[str, tuple[str, float]] = {}
+
+    def _dir(self) -> str:
+        if self._cache_dir is None:
+            self._cache_dir = tempfile.mkdtemp(prefix='apkindex-')
+        os.makedirs(self._cache_dir, exist_ok=True)
+        return self._cache_dir
+
+    def add(self, url: str, path: str):
+        """Stores a verified index file downloaded by apk for url"""
+        name = os.path.basename(path)
+        with self._lock:
+            shutil.copy2(path, os.path.join(self._dir(), name))
+            self._indexes[url] = (name, time.monotonic())
+        log.debug("Cached the index of '{}' as '{}'".format(url, name))
+
+    def covers(self, urls: Iterable[str]) -> bool:
+        """Whether the indexes of all remote repositories in urls are cached and fresh"""
+        now = time.monotonic()
+        with self._lock:
+            for url in filter(is_remote_repo, urls):
+                entry = self._indexes.get(url, None)
+                if (entry is None) or (now - entry[1] > INDEX_MAX_AGE):
+                    return False
+        return True
+
+    def install(self, urls: Iterable[str], root_dir: str):
+        """Copies the cached indexes of urls to the apk cache of root_dir"""
+        dest_dir = os.path.join(root_dir, APK_CACHE_DIR)
+        os.makedirs(dest_dir, exist_ok=True)
+        with self._lock:
+            for url in filter(is_remote_repo, urls):
+                name, _ = self._indexes[url]
+                shutil.copy2(os.path.join(self._dir(), name), os.path.join(dest_dir, name))
+
+
+def find_apk_index(root_dir: str) -> str:
+    """The only index in the apk cache of root_dir"""
+    paths = glob.glob(os.path.join(root_dir, APK_CACHE_DIR, 'APKINDEX.*.tar.gz'))
+    if len(paths) != 1:
+        raise RuntimeError('One index expected in {}, found {}'.format(
+            os.path.join(root_dir, APK_CACHE_DIR), len(paths)))
+    return paths[0]
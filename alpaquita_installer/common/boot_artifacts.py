@@ -0,0 +1,147 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+import glob
+import hashlib
+import logging
+import os
+import re
+
+from .events import EventReceiver
+
+log = logging.getLogger('common.boot_artifacts')
+
+INITRAMFS_PREFIX = '/boot/initramfs-'
+GRUB_CFG = '/boot/grub/grub.cfg'
+
+# Target files read by dracut
+INITRAMFS_INPUTS = ('/etc/fstab', '/etc/crypttab', '/etc/mdadm.conf', '/etc/conf.d/dmcrypt',
+                    '/etc/dracut.conf', '/etc/dracut.conf.d/*.conf', '/etc/cmdline.d/*.conf')
+# Target files read by grub-mkconfig, besides the list of kernels and initramfs images
+GRUB_CFG_INPUTS = ('/etc/default/grub', '/etc/grub.d/*')
+GRUB_CFG_BOOT_FILES = ('/boot/vmlinuz-*', '/boot/initramfs-*', '/boot/*-ucode.img')
+
+
+def initramfs_path(kver: str) -> str:
+    return INITRAMFS_PREFIX + kver
+
+
+def kernel_versions(target_root: str) -> list[str]:
+    """Versions of the kernels installed in /boot of target_root, each kernel package installs config-<version>"""
+    res = []
+    for name in os.listdir(os.path.join(target_root, 'boot')):
+        m = re.match(r'^config-(\d+.*)$', name)
+        if m:
+            res.append(m.group(1))
+    return sorted(res)
+
+
+class BootArtifacts:
+    """Regenerates the initramfs images and grub.cfg only if their inputs have changed.
+
+    Package triggers, KernelInstaller and BootloaderInstaller all build these
+    artifacts. The fingerprint of the inputs is recorded each time an artifact
+    is built, so update() rebuilds only the artifacts that are stale by the
+    end of the installation.
+    """
+
+    def __init__(self, target_root: str):
+        self._target_root = target_root
+        # Artifact path -> fingerprint of its inputs when it was built
+        self._built: dict[str, str] = {}
+        # Artifact path -> how to build it, in the order of requests
+        self._requested: dict[str, Callable[[], None]] = {}
+
+    def _abs_path(self, path: str) -> str:
+        return os.path.join(self._target_root, path.lstrip('/'))
+
+    def _hash_files(self, digest, patterns, content: bool = True):
+        for pattern in patterns:
+            for path in sorted(glob.glob(self._abs_path(pattern))):
+                if not os.path.isfile(path):
+                    continue
+                digest.update(os.path.relpath(path, self._target_root).encode() + b'\0')
+                if content:
+                    with open(path, 'rb') as file:
+                        digest.update(hashlib.sha256(file.read()).digest())
+
+    def fingerprint(self, path: str) -> str:
+        digest = hashlib.sha256(path.encode() + b'\0')
+        if path.startswith(INITRAMFS_PREFIX):
+            kver = path[len(INITRAMFS_PREFIX):]
+            modules_dep = self._abs_path(f'/lib/modules/{kver}/modules.dep')
+            # A reinstalled kernel brings a new modules.dep
+            if os.path.exists(modules_dep):
+                st = os.stat(modules_dep)
+                digest.update('{}:{}\0'.format(st.st_size, st.st_mtime_ns).encode())
+            self._hash_files(digest, INITRAMFS_INPUTS)
+        elif path == GRUB_CFG:
+            self._hash_files(digest, GRUB_CFG_INPUTS)
+            self._hash_files(digest, GRUB_CFG_BOOT_FILES, content=False)
+        else:
+            raise ValueError('Unknown boot artifact: {}'.format(path))
+        return digest.hexdigest()
+
+    def _artifacts_on_disk(self) -> dict[str, int]:
+        res = {}
+        for abs_path in glob.glob(self._abs_path(INITRAMFS_PREFIX + '*')) + [self._abs_path(GRUB_CFG)]:
+            if os.path.isfile(abs_path):
+                path = '/' + os.path.relpath(abs_path, self._target_root)
+                # Backups and images of other tools, e.g. initramfs-lts.img.old
+                if path.startswith(INITRAMFS_PREFIX) and \
+                        not re.match(r'^\d', path[len(INITRAMFS_PREFIX):]):
+                    continue
+                res[path] = os.stat(abs_path).st_mtime_ns
+        return res
+
+    def mark_built(self, path: str):
+        self._built[path] = self.fingerprint(path)
+
+    def is_stale(self, path: str) -> bool:
+        if not os.path.exists(self._abs_path(path)):
+            return True
+        return self._built.get(path, None) != self.fingerprint(path)
+
+    @contextmanager
+    def track_external_builds(self) -> Iterator[None]:
+        """Records artifacts (re)built by package triggers in the block as up to date"""
+        before = self._artifacts_on_disk()
+        yield
+        for path, mtime in self._artifacts_on_disk().items():
+            if before.get(path, None) != mtime:
+                log.debug('{} was built by a package trigger'.format(path))
+                self.mark_built(path)
+
+    def request(self, path: str, build: Callable[[], None]):
+        """Build the artifact on update() unless it is up to date by then"""
+        self._requested[path] = build
+
+    def _build(self, path: str):
+        self._requested[path]()
+        self.mark_built(path)
+
+    def update(self, event_receiver: Optional[EventReceiver] = None) -> list[str]:
+        """Builds the stale requested artifacts, returns their paths"""
+        stale = [path for path in self._requested if self.is_stale(path)]
+        for path in self._requested:
+            if path not in stale:
+                log.debug('{} is up to date'.format(path))
+        initramfs = [path for path in stale if path.startswith(INITRAMFS_PREFIX)]
+        if initramfs:
+            if event_receiver:
+                event_receiver.start_event('Regenerating initrd')
+            # dracut is mostly single-threaded apart from the compressor
+            with ThreadPoolExecutor(max_workers=len(initramfs)) as executor:
+                for future in [executor.submit(self._build, path) for path in initramfs]:
+                    future.result()
+        # grub.cfg lists the initramfs images, so it goes last
+        for path in stale:
+            if path not in initramfs:
+                if event_receiver:
+                    event_receiver.start_event('Generating {}'.format(os.path.basename(path)))
+                self._build(path)
+        self._requested.clear()
+        return stale
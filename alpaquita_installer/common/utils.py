@@ -1,14 +1,18 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
+from concurrent.futures import ThreadPoolExecutor
 import enum
 import subprocess
 import urllib
 from typing import Optional, Callable, Iterable
 import logging
 import os
+import signal
+import threading
 from tempfile import TemporaryDirectory
 
+from .apk_index import APKIndexCache, APK_CACHE_DIR, check_apk_index, find_apk_index, is_remote_repo
 from .events import EventReceiver, LoggingReceiver
 
 log = logging.getLogger('common.utils')
@@ -58,24 +62,60 @@ def run_cmd(args, input: Optional[bytes] = None,
 
 def run_cmd_live(args, ignore_status: bool = False,
                  event_receiver: EventReceiver = LoggingReceiver(),
-                 event_transform: Callable = None) -> subprocess.CompletedProcess:
-
-    event_receiver.add_log_line(f'Running command: {args}')
+                 event_transform: Callable = None,
+                 input: Optional[bytes] = None,
+                 timeout: Optional[float] = None,
+                 env: Optional[dict[str, str]] = None,
+                 line_prefix: str = '') -> subprocess.CompletedProcess:
+
+    event_receiver.add_log_line(f'{line_prefix}Running command: {args}')
+    if env is not None:
+        env = dict(os.environ, **env)
     with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                          preexec_fn=os.setpgrp) as proc:
-        for b_line in iter(proc.stdout.readline, b''):
-            line = b_line.decode().strip(' \n')
-            if not line:
-                continue
-            if event_transform:
-                new_line = event_transform(line)
-                if new_line:
-                    event_receiver.start_event(new_line)
+                          stdin=subprocess.PIPE if input is not None else None,
+                          env=env, preexec_fn=os.setpgrp) as proc:
+        if input is not None:
+            # Written concurrently with reading, so that a large input cannot block the output
+            def write_input():
+                try:
+                    proc.stdin.write(input)
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            threading.Thread(target=write_input, daemon=True).start()
+
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            # The command runs in its own process group, so its children go too
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            for b_line in iter(proc.stdout.readline, b''):
+                line = b_line.decode(errors='replace').strip(' \n')
+                if not line:
                     continue
-            event_receiver.add_log_line(line)
-
-        ret = proc.wait()
-
+                if event_transform:
+                    new_line = event_transform(line)
+                    if new_line:
+                        event_receiver.start_event(new_line)
+                        continue
+                event_receiver.add_log_line(line_prefix + line)
+
+            ret = proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+
+        if timed_out.is_set():
+            event_receiver.add_log_line(f'{line_prefix}Command did not complete in {timeout} seconds')
+            raise RuntimeError("'{}' did not complete in {} seconds".format(' '.join(args), timeout))
         if (not ignore_status) and (ret != 0):
             raise RuntimeError("'{}' exited with {}".format(' '.join(args), ret))
 
@@ -95,6 +135,26 @@ def write_file(path, mode: str, data):
     log.debug("{} to '{}' data: '{}'".format(action, path, data))
 
 
+def run_concurrently(tasks: Iterable[tuple[str, Callable[[], None]]], event_receiver: EventReceiver):
+    """Runs (label, function) tasks at once and raises the error of the first failed one.
+
+    Every failure is logged with its '[label] ' prefix, so the other errors are not lost.
+    """
+    tasks = list(tasks)
+    if not tasks:
+        return
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = [executor.submit(func) for _, func in tasks]
+    errors = []
+    for (label, _), future in zip(tasks, futures):
+        exc = future.exception()
+        if exc:
+            event_receiver.add_log_line(f'[{label}] Failed: {exc}')
+            errors.append(exc)
+    if errors:
+        raise errors[0]
+
+
 def validate_proxy_url(url: str):
     msg = "Proxy URL '{}' does not match template '{}'".format(
         url, VALID_PROXY_URL_TEMPLATE)
@@ -117,21 +177,39 @@ def button_width_for_label(label: str) -> int:
     return len(label) + 4
 
 
-def validate_apk_repo(url: str, keys_dir: str, timeout: float):
+def validate_apk_repo(url: str, keys_dir: str, timeout: float,
+                      index_cache: Optional[APKIndexCache] = None):
     with TemporaryDirectory() as tmpdir:
         args = ['apk', '--root', tmpdir, '--keys', keys_dir,
                 '--repository', url]
         try:
             run_cmd(args=(args + ['add', '--initdb']))
+            os.makedirs(os.path.join(tmpdir, APK_CACHE_DIR), exist_ok=True)
             run_cmd(args=(args + ['update']), timeout=timeout)
-            res = run_cmd(args=(args + ['list', '-a']))
+            if is_remote_repo(url):
+                path = find_apk_index(tmpdir)
+            else:
+                path = os.path.join(url, os.uname().machine, 'APKINDEX.tar.gz')
         except RuntimeError as exc:
             raise ValueError(str(exc)) from None
 
-        if not res.stdout:
-            raise ValueError('Repository {} contains no packages.'.format(url))
-
-
-def validate_apk_repos(urls: Iterable[str], keys_dir: str, timeout: float):
-    for url in urls:
-        validate_apk_repo(url=url, keys_dir=keys_dir, timeout=timeout)
+        # Instead of listing all packages
+        check_apk_index(path, url=url, keys_dir=keys_dir)
+        if (index_cache is not None) and is_remote_repo(url):
+            index_cache.add(url, path)
+
+
+def validate_apk_repos(urls: Iterable[str], keys_dir: str, timeout: float,
+                       index_cache: Optional[APKIndexCache] = None):
+    urls = list(urls)
+    if not urls:
+        return
+    # The checks are network-bound, so they all run at once
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        futures = [executor.submit(validate_apk_repo, url=url, keys_dir=keys_dir, timeout=timeout,
+                                   index_cache=index_cache)
+                   for url in urls]
+        errors = [f.exception() for f in futures if f.exception()]
+    # The error of the first failed repository in the list
+    if errors:
+        raise errors[0]
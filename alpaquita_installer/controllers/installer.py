@@ -19,15 +19,20 @@ from alpaquita_installer.installers.proxy import ProxyInstaller
 from alpaquita_installer.installers.packages import PackagesInstaller
 from alpaquita_installer.installers.services import ServicesInstaller
 from alpaquita_installer.installers.swapfile import SwapfileInstaller
+from alpaquita_installer.installers.zram import ZramInstaller
 from alpaquita_installer.installers.timezone import TimezoneInstaller
 from alpaquita_installer.installers.users import UsersInstaller
 from alpaquita_installer.installers.network import NetworkInstaller
 from alpaquita_installer.installers.kernel import KernelInstaller
+from alpaquita_installer.installers.libc import LibcInstaller
+from alpaquita_installer.installers.performance import PerformanceProfileInstaller
 from alpaquita_installer.installers.secureboot import SecureBootInstaller
 from alpaquita_installer.installers.bootloader import BootloaderInstaller
+from alpaquita_installer.installers.jdk_cds import JDKCDSInstaller
 from alpaquita_installer.installers.post_scripts import PostScriptsInstaller
 from alpaquita_installer.installers.installer import InstallerException
 from alpaquita_installer.common.apk import APKManager
+from alpaquita_installer.common.boot_artifacts import BootArtifacts
 from alpaquita_installer.common.events import EventReceiver
 from alpaquita_installer.common.utils import DEFAULT_CONFIG_FILE, Arch
 from .controller import Controller
@@ -94,10 +99,18 @@ class BaseInstallerController(Controller, EventReceiver):
                                              config=config, event_receiver=self)
         arch = Arch(os.uname().machine)
         efi_mount = storage_installer.efi_mount_point
+        boot_artifacts = BootArtifacts(self.TARGET_ROOT)
         apk = APKManager(event_receiver=self)
         apk.root_dir = self.TARGET_ROOT
+        apk.boot_artifacts = boot_artifacts
+        repo_controller = self._app.controller('RepoController')
+        if repo_controller is not None:
+            apk.index_cache = repo_controller.index_cache
         pkgs_installer = PackagesInstaller(target_root=self.TARGET_ROOT,
                                            config=config, event_receiver=self, apk=apk)
+        libc_installer = LibcInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self)
+        performance_installer = PerformanceProfileInstaller(target_root=self.TARGET_ROOT,
+                                                            config=config, event_receiver=self)
 
         installers = [
             storage_installer,
@@ -107,31 +120,52 @@ class BaseInstallerController(Controller, EventReceiver):
             pkgs_installer,
             ServicesInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
             SwapfileInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
+            ZramInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self,
+                          disk_swap_priorities=storage_installer.swap_priorities),
             TimezoneInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
             UsersInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
             NetworkInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
-            KernelInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
+            libc_installer,
+            performance_installer,
+            KernelInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self,
+                            storage_dracut_modules=storage_installer.dracut_modules,
+                            boot_artifacts=boot_artifacts,
+                            extra_cmdline=performance_installer.kernel_cmdline),
             BootloaderInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self,
-                                arch=arch, efi_mount=efi_mount),
+                                arch=arch, efi_mount=efi_mount, boot_artifacts=boot_artifacts,
+                                smanager=storage_installer.smanager),
             SecureBootInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self,
                                 apk=apk),
+            JDKCDSInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
             PostScriptsInstaller(target_root=self.TARGET_ROOT, config=config, event_receiver=self),
         ]
 
         for i in installers:
             pkgs_installer.add_package(*i.packages)
 
-        for i in installers:
-            i.apply()
+        # The RAID resync speed is limited and its progress is reported from the creation
+        # of the arrays till the end, both must stop even if the installation fails and
+        # cleanup() is not run
+        try:
+            for i in installers:
+                i.apply()
 
-        for i in installers:
-            i.post_apply()
+            for i in installers:
+                i.post_apply()
+
+            # Each stale initramfs and grub.cfg is built once, after everything affecting them
+            boot_artifacts.update(event_receiver=self)
+            # Nothing runs in the target after this, so the allocator is not preloaded into the installer commands
+            libc_installer.activate_allocator()
 
-        if self._app.copy_config:
-            self._copy_yaml_config()
+            if self._app.copy_config:
+                self._copy_yaml_config()
 
-        for i in reversed(installers):
-            i.cleanup()
+            for i in reversed(installers):
+                i.cleanup()
+        finally:
+            storage_installer.stop_raid_sync_reports()
+            storage_installer.smanager.restore_raid_resync_speed()
 
         self.add_log_line(f'Removing {self.TARGET_ROOT}')
         os.rmdir(self.TARGET_ROOT)
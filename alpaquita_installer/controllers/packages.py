@@ -59,15 +59,15 @@ class PackagesController(Controller):
 
         self._add_pkg(epkgs, 'kernel', 'extramods', 'linux-lts-extra-modules')
 
-        self._add_pkg(epkgs, 'jdk', 'jdk_8', DISTRO_JDK8.package)
-        self._add_pkg(epkgs, 'jdk', 'jdk_11', DISTRO_JDK11.package)
-        self._add_pkg(epkgs, 'jdk', 'jdk_17', DISTRO_JDK17.package)
-        self._add_pkg(epkgs, 'jdk', 'jdk_21', DISTRO_JDK21.package)
-        self._add_pkg(epkgs, 'jdk', 'nik_23_17', DISTRO_NIK23_17.package)
-        self._add_pkg(epkgs, 'jdk', 'nik_23_21', DISTRO_NIK23_21.package)
-        self._add_pkg(epkgs, 'jdk', 'nik_24_22', DISTRO_NIK24_22.package)
-
-        self._add_pkg(epkgs, 'libc', 'perf', 'musl-perf')
+        jdk_pkgs = []
+        self._add_pkg(jdk_pkgs, 'jdk', 'jdk_8', DISTRO_JDK8.package)
+        self._add_pkg(jdk_pkgs, 'jdk', 'jdk_11', DISTRO_JDK11.package)
+        self._add_pkg(jdk_pkgs, 'jdk', 'jdk_17', DISTRO_JDK17.package)
+        self._add_pkg(jdk_pkgs, 'jdk', 'jdk_21', DISTRO_JDK21.package)
+        self._add_pkg(jdk_pkgs, 'jdk', 'nik_23_17', DISTRO_NIK23_17.package)
+        self._add_pkg(jdk_pkgs, 'jdk', 'nik_23_21', DISTRO_NIK23_21.package)
+        self._add_pkg(jdk_pkgs, 'jdk', 'nik_24_22', DISTRO_NIK24_22.package)
+        epkgs.extend(jdk_pkgs)
 
         self._add_pkg(epkgs, 'other', 'ssh_server', 'openssh')
         self._add_pkg(epkgs, 'other', 'ssh_server', 'openssh-server')
@@ -79,5 +79,12 @@ class PackagesController(Controller):
         data = {'extra_packages': epkgs}
         if enable_services:
             data['services'] = {'enabled': enable_services}
+        libc = self._data.get('libc') or {}
+        allocator = libc.get('allocator') or 'default'
+        if libc.get('perf') or (allocator != 'default'):
+            data['libc'] = {'perf': bool(libc.get('perf')), 'allocator': allocator}
+        if jdk_pkgs:
+            # CDS archives for the CPU of the target machine
+            data['jdk_cds'] = {}
 
         return yaml.dump(data)
@@ -10,6 +10,7 @@ from .controller import Controller
 import alpaquita_installer
 from alpaquita_installer.app.distro import DISTRO, DISTRO_REPO_BASE_URL
 from alpaquita_installer.views.repo import RepoView
+from alpaquita_installer.common.apk_index import APKIndexCache
 from alpaquita_installer.common.utils import MEDIA_PATH, validate_apk_repos
 
 log = logging.getLogger('controllers.repo')
@@ -26,6 +27,8 @@ class RepoController(Controller):
         self._libc_type = 'musl' if os.path.exists(f"/lib/ld-musl-{app.arch.value}.so.1") else 'glibc'
         self._host_libc_type = self._libc_type
         self._validated_repo_pairs: Set[Tuple[str, str]] = set()
+        # The verified indexes, reused by the installation
+        self.index_cache = APKIndexCache()
 
     def get_os_release(self):
         res = {}
@@ -49,7 +52,8 @@ class RepoController(Controller):
                 task = self._app.aio_loop.run_in_executor(None, validate_apk_repos,
                                                           self.get_repos(repo_base_url, libc_type),
                                                           self.get_keys_dir(libc_type),
-                                                          self.REPO_CHECK_TIMEOUT)
+                                                          self.REPO_CHECK_TIMEOUT,
+                                                          self.index_cache)
                 await self._app.wait_with_text_dialog(task, 'Checking repositories')
                 self._validated_repo_pairs.add(repo_pair)
 
@@ -5,17 +5,20 @@ from __future__ import annotations
 from typing import Optional, TYPE_CHECKING
 import json
 import logging
+import os
 
 import attrs
 import yaml
 
 from alpaquita_installer.app.distro import DISTRO
 from alpaquita_installer.smanager.manager import StorageManager
-from alpaquita_installer.smanager.file_system import FSType
-from alpaquita_installer.smanager.storage_unit import Partition, StorageUnit, StorageUnitFlag, CryptoVolume
+from alpaquita_installer.smanager.file_system import FSType, MountProfile
+from alpaquita_installer.smanager.storage_unit import Partition, StorageUnit, StorageUnitFlag, CryptoVolume, \
+    LogicalVolume
 from alpaquita_installer.smanager.disk import Disk as SM_Disk
 from alpaquita_installer.smanager.raid import RAID
 from alpaquita_installer.smanager.lvm import VolumeGroup
+from alpaquita_installer.smanager import planner
 from alpaquita_installer.common.utils import run_cmd
 from alpaquita_installer.views.storage import StorageView, StorageViewData
 from .controller import Controller
@@ -32,6 +35,19 @@ class Disk:
     size: int
     model: Optional[str]
     serial: Optional[str]
+    # 'hdd', 'ssd' or 'nvme'
+    media: Optional[str] = None
+    transport: Optional[str] = None
+    logical_block_size: Optional[int] = None
+    physical_block_size: Optional[int] = None
+    queue_depth: Optional[int] = None
+    discard: bool = False
+
+    def matches(self, text: str) -> bool:
+        text = text.lower()
+        return any(text in value.lower()
+                   for value in (self.path, self.model, self.serial, self.media, self.transport)
+                   if value)
 
 
 def scan_host_disks() -> list[Disk]:
@@ -47,27 +63,34 @@ def scan_host_disks() -> list[Disk]:
                 blkdev[opt_name] = blkdev[opt_name].strip()
             if not blkdev[opt_name]:
                 blkdev[opt_name] = None
+        # The queue and device attributes are plain sysfs reads,
+        # so they don't slow down hosts with many disks
+        props = planner.read_disk_properties(os.path.basename(blkdev['path']))
         disk = Disk(path=blkdev['path'], size=blkdev['size'],
-                    model=blkdev['model'], serial=blkdev['serial'])
+                    model=blkdev['model'], serial=blkdev['serial'],
+                    media=props.media, transport=props.transport,
+                    logical_block_size=props.logical_block_size,
+                    physical_block_size=props.physical_block_size,
+                    queue_depth=props.queue_depth, discard=props.discard)
         log.debug('Found disk: {}'.format(disk))
         disks.append(disk)
     return disks
 
 
 class StorageController(Controller):
-    MB = 1024 * 1024
-    GB = 1024 * MB
+    MB = planner.MB
+    GB = planner.GB
 
     # Size of /boot/efi for EFI installations
-    BOOT_EFI_SIZE = 512 * MB
+    BOOT_EFI_SIZE = planner.BOOT_EFI_SIZE
     # Size of the bios_boot partition for non-EFI installations
-    BIOS_BOOT_SIZE = MB
+    BIOS_BOOT_SIZE = planner.BIOS_BOOT_SIZE
     # Size of /boot
-    BOOT_SIZE = 512 * MB
+    BOOT_SIZE = planner.BOOT_SIZE
     # A bare installation takes less than 100M.
     # All liberica{8,11,17} and liberica{8,11,17} lite take < 1.2G.
     # liberica{11,17}-nik both take ~ 1G.
-    ROOT_MIN_SIZE = 4 * GB
+    ROOT_MIN_SIZE = planner.ROOT_MIN_SIZE
 
     def __init__(self, app: Application):
         super().__init__(app)
@@ -103,6 +126,7 @@ class StorageController(Controller):
                 self._selected_disk.path, self._selected_disk.size, req_size))
 
         root_fs_type = {'ext4': FSType.EXT4, 'xfs': FSType.XFS}[self._file_system]
+        mount_profile = MountProfile.GENERAL
 
         smanager = StorageManager()
 
@@ -119,7 +143,8 @@ class StorageController(Controller):
 
         if create_boot:
             disk.add_partition(id='boot', size=self.BOOT_SIZE,
-                               mount_point='/boot', fs_type=root_fs_type)
+                               mount_point='/boot', fs_type=root_fs_type,
+                               mount_profile=mount_profile)
 
         if self._use_lvm:
             if self._crypto_passphrase:
@@ -131,15 +156,18 @@ class StorageController(Controller):
                 pv = disk.add_partition(id='pv', fs_type=FSType.PHYSICAL_VOLUME)
 
             vg = smanager.add_vg(id=f'{DISTRO}_vg', physical_volumes=[pv])
-            vg.add_lv(id='root', fs_type=root_fs_type, mount_point='/')
+            vg.add_lv(id='root', fs_type=root_fs_type, mount_point='/',
+                      mount_profile=mount_profile)
         else:
             if self._crypto_passphrase:
                 crypto_part = disk.add_partition(id='crypto_part', fs_type=FSType.CRYPTO_PARTITION,
                                                  crypto_passphrase=self._crypto_passphrase)
                 smanager.cryptsetup.add_volume(id='root', fs_type=root_fs_type,
-                                               partition=crypto_part, mount_point='/')
+                                               partition=crypto_part, mount_point='/',
+                                               mount_profile=mount_profile)
             else:
-                disk.add_partition(id='root', fs_type=root_fs_type, mount_point='/')
+                disk.add_partition(id='root', fs_type=root_fs_type, mount_point='/',
+                                   mount_profile=mount_profile)
 
         # If/when we enable user-defined storage configurations, this check
         # will go into a separate method
@@ -196,12 +224,38 @@ class StorageController(Controller):
                 res['mount_point'] = unit.mount_point
             if unit.flags:
                 res['flags'] = [str(f) for f in unit.flags]
+            if unit.mkfs_profile:
+                res['mkfs_profile'] = str(unit.mkfs_profile)
+            if unit.mkfs_opts:
+                res['mkfs_opts'] = list(unit.mkfs_opts)
+            if unit.mount_profile:
+                res['mount_profile'] = str(unit.mount_profile)
+            if unit.subvolumes:
+                res['subvolumes'] = [attrs.asdict(s, filter=lambda attr, value: value is not None)
+                                     for s in unit.subvolumes]
             return res
 
         def _part_to_dict(part: Partition) -> dict:
             res = _unit_to_dict(part)
             if part.crypto_passphrase:
                 res['crypto_passphrase'] = part.crypto_passphrase
+            if part.crypto_params:
+                res['crypto'] = part.crypto_params.to_dict()
+            return res
+
+        def _lv_to_dict(lv: LogicalVolume) -> dict:
+            res = _unit_to_dict(lv)
+            if lv.stripes:
+                res['stripes'] = lv.stripes
+                res['stripe_size'] = lv.stripe_size
+            if lv.thin_pool:
+                res['thin_pool'] = True
+            if lv.pool:
+                res['pool'] = lv.pool.id
+            if lv.cache:
+                res['cache'] = {'mode': lv.cache.mode,
+                                'size': lv.cache.size,
+                                'physical_volume': lv.cache.physical_volume.id}
             return res
 
         def _crypto_volume_to_dict(vol: CryptoVolume) -> dict:
@@ -215,6 +269,8 @@ class StorageController(Controller):
         for disk in self._smanager.get_devices_by_type(SM_Disk):
             entry = {'id': disk.block_device,
                      'partitions': []}
+            if disk.wipe_method:
+                entry['wipe'] = str(disk.wipe_method)
             for part in disk.partitions:
                 entry['partitions'].append(_part_to_dict(part))
             storage_data.setdefault('disks', []).append(entry)
@@ -227,6 +283,12 @@ class StorageController(Controller):
                      'level': raid.level,
                      'members': [m.id for m in raid.members],
                      'partitions': []}
+            if raid.chunk_size:
+                entry['chunk_size'] = raid.chunk_size
+            if raid.assume_clean:
+                entry['assume_clean'] = True
+            if raid.bitmap:
+                entry['bitmap'] = raid.bitmap
             for part in raid.partitions:
                 entry['partitions'].append(_part_to_dict(part))
             storage_data.setdefault('raids', []).append(entry)
@@ -236,7 +298,7 @@ class StorageController(Controller):
                      'physical_volumes': [pv.id for pv in vg.physical_volumes],
                      'logical_volumes': []}
             for lv in vg.logical_volumes:
-                entry['logical_volumes'].append(_unit_to_dict(lv))
+                entry['logical_volumes'].append(_lv_to_dict(lv))
             storage_data.setdefault('volume_groups', []).append(entry)
 
         data = {}
@@ -0,0 +1,235 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from __future__ import annotations
+from typing import Iterable, Optional
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger('installers.accounts')
+
+# The range adduser allocates ids of regular users from
+FIRST_UID = 1000
+LAST_UID = 60000
+# name:password:uid:gid:gecos:home:shell
+PASSWD_FIELDS = 7
+# name:password:lastchg:min:max:warn:inactive:expire:reserved
+SHADOW_FIELDS = 9
+# name:password:gid:members
+GROUP_FIELDS = 4
+# name:password:admins:members
+GSHADOW_FIELDS = 4
+
+
+def days_since_epoch() -> int:
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return (now - epoch).days
+
+
+class _Database:
+    """A colon-separated database file, lines are kept in the original order"""
+
+    def __init__(self, path: str, fields: int, optional: bool = False):
+        self.path = path
+        self._fields = fields
+        self.exists = os.path.exists(path)
+        self.changed = False
+        self._rows: list[list[str]] = []
+        if (not self.exists) and (not optional):
+            raise RuntimeError("'{}' does not exist".format(path))
+        if self.exists:
+            with open(path, 'r') as file:
+                for line in file.read().splitlines():
+                    row = line.split(':')
+                    if len(row) < fields and line.strip() and not line.startswith('#'):
+                        row.extend([''] * (fields - len(row)))
+                    self._rows.append(row)
+
+    def find(self, name: str) -> Optional[list[str]]:
+        for row in self._rows:
+            if row[0] == name:
+                return row
+        return None
+
+    def get(self, name: str) -> list[str]:
+        row = self.find(name)
+        if row is None:
+            raise RuntimeError("No '{}' found in '{}'".format(name, self.path))
+        return row
+
+    def append(self, row: list[str]):
+        if len(row) != self._fields:
+            raise ValueError('{}: {} fields expected, got {}'.format(self.path, self._fields, len(row)))
+        self._rows.append(row)
+        self.changed = True
+
+    @property
+    def rows(self) -> list[list[str]]:
+        return [r for r in self._rows if len(r) >= self._fields]
+
+    def save(self):
+        if not (self.exists and self.changed):
+            return
+        data = ''.join(':'.join(row) + '\n' for row in self._rows)
+        st = os.stat(self.path)
+        # The file is replaced at once, so a failure leaves the old one intact
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                        prefix='.{}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.changed = False
+        log.debug("Wrote '{}'".format(self.path))
+
+
+class AccountsDB:
+    """Edits /etc/passwd, /etc/shadow, /etc/group and /etc/gshadow of the target in place.
+
+    The files are loaded once and each changed file is written once by save().
+    """
+
+    def __init__(self, etc_dir: str):
+        self._etc_dir = etc_dir
+        self._passwd = _Database(os.path.join(etc_dir, 'passwd'), PASSWD_FIELDS)
+        self._shadow = _Database(os.path.join(etc_dir, 'shadow'), SHADOW_FIELDS)
+        self._group = _Database(os.path.join(etc_dir, 'group'), GROUP_FIELDS)
+        self._gshadow = _Database(os.path.join(etc_dir, 'gshadow'), GSHADOW_FIELDS, optional=True)
+
+    def _used_ids(self, db: _Database, column: int) -> set[int]:
+        res = set()
+        for row in db.rows:
+            try:
+                res.add(int(row[column]))
+            except ValueError:
+                pass
+        return res
+
+    def _free_id(self, used: set[int]) -> int:
+        for id in range(FIRST_UID, LAST_UID):
+            if id not in used:
+                return id
+        raise RuntimeError('No free ids left')
+
+    def has_user(self, name: str) -> bool:
+        return self._passwd.find(name) is not None
+
+    def has_group(self, name: str) -> bool:
+        return self._group.find(name) is not None
+
+    def user_ids(self, name: str) -> tuple[int, int]:
+        row = self._passwd.get(name)
+        return int(row[2]), int(row[3])
+
+    def user_home(self, name: str) -> str:
+        return self._passwd.get(name)[5]
+
+    def add_group(self, name: str, gid: Optional[int] = None) -> int:
+        if self.has_group(name):
+            raise ValueError("Group '{}' already exists".format(name))
+        used = self._used_ids(self._group, 2)
+        if gid is None:
+            gid = self._free_id(used)
+        elif gid in used:
+            raise ValueError('GID {} is already used'.format(gid))
+        self._group.append([name, 'x', str(gid), ''])
+        if self._gshadow.exists:
+            self._gshadow.append([name, '!', '', ''])
+        return gid
+
+    def add_user(self, name: str, gecos: str = '', shell: str = '/bin/sh',
+                 home: Optional[str] = None, uid: Optional[int] = None) -> tuple[int, int]:
+        """Adds a user with a locked password and its own primary group like 'adduser -D'"""
+        if self.has_user(name):
+            raise ValueError("User '{}' already exists".format(name))
+        used_uids = self._used_ids(self._passwd, 2)
+        if uid is None:
+            uid = self._free_id(used_uids)
+        elif uid in used_uids:
+            raise ValueError('UID {} is already used'.format(uid))
+        if self.has_group(name):
+            gid = int(self._group.get(name)[2])
+        else:
+            # The same id for the group if it's free
+            gid = self.add_group(name, gid=None if uid in self._used_ids(self._group, 2) else uid)
+        home = home or os.path.join('/home', name)
+
+        self._passwd.append([name, 'x', str(uid), str(gid), gecos, home, shell])
+        self._shadow.append([name, '!', str(days_since_epoch()), '0', '99999', '7', '', '', ''])
+        return uid, gid
+
+    def set_password(self, name: str, password_hash: str):
+        row = self._shadow.get(name)
+        row[1] = password_hash
+        # Date of last password change (number of days since the Unix epoch)
+        row[2] = str(days_since_epoch())
+        self._shadow.changed = True
+
+    def add_to_group(self, user: str, group: str):
+        for db, column in ((self._group, 3), (self._gshadow, 3)):
+            if not db.exists:
+                continue
+            row = db.get(group)
+            members = [m for m in row[column].split(',') if m]
+            if user not in members:
+                members.append(user)
+                row[column] = ','.join(members)
+                db.changed = True
+
+    def create_home(self, name: str, skel: Optional[str] = None, mode: int = 0o755):
+        """Creates the home directory of the user from skel"""
+        uid, gid = self.user_ids(name)
+        home = self._root_path(self.user_home(name))
+        if os.path.exists(home):
+            # E.g. a mount point for the home of the user, its content is left as is.
+            # Directories like /srv are shared with the system and must not change owners.
+            if os.path.dirname(os.path.normpath(self.user_home(name))) != '/home':
+                raise ValueError("Home directory '{}' of user '{}' already exists outside /home".format(
+                    self.user_home(name), name))
+            os.lchown(home, uid, gid)
+            return
+        if skel and os.path.isdir(skel):
+            shutil.copytree(skel, home, symlinks=True)
+        else:
+            os.makedirs(home)
+        os.chmod(home, mode)
+        for dir_path, dir_names, file_names in os.walk(home):
+            os.lchown(dir_path, uid, gid)
+            for entry in dir_names + file_names:
+                os.lchown(os.path.join(dir_path, entry), uid, gid)
+
+    def _root_path(self, path: str) -> str:
+        root_dir = os.path.normpath(os.path.dirname(self._etc_dir.rstrip('/')))
+        res = os.path.normpath(os.path.join(root_dir, path.lstrip('/')))
+        if os.path.commonpath([root_dir, res]) != root_dir:
+            raise ValueError("Path '{}' is outside of the target root".format(path))
+        return res
+
+    def write_authorized_keys(self, name: str, keys: Iterable[str]):
+        uid, gid = self.user_ids(name)
+        ssh_dir = os.path.join(self._root_path(self.user_home(name)), '.ssh')
+        os.makedirs(ssh_dir, mode=0o700, exist_ok=True)
+        os.chmod(ssh_dir, 0o700)
+        os.lchown(ssh_dir, uid, gid)
+        path = os.path.join(ssh_dir, 'authorized_keys')
+        # sshd ignores the file if others may write to it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            file.write(''.join(key.strip() + '\n' for key in keys))
+        os.chmod(path, 0o600)
+        os.lchown(path, uid, gid)
+
+    def save(self):
+        for db in (self._passwd, self._group, self._shadow, self._gshadow):
+            db.save()
@@ -2,21 +2,150 @@
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
 import os
+import re
+import shlex
 
-from alpaquita_installer.app.distro import DISTRO
-from alpaquita_installer.common.utils import Arch
+from alpaquita_installer.app.distro import DISTRO, DISTRO_NAME
+from alpaquita_installer.common.boot_artifacts import BootArtifacts, GRUB_CFG, kernel_versions
+from alpaquita_installer.common.utils import Arch, write_file
+from alpaquita_installer.smanager.file_system import FSType
+from alpaquita_installer.smanager.manager import StorageManager
+from alpaquita_installer.smanager.storage_unit import Partition, StorageUnit
+from alpaquita_installer.smanager.disk import Disk
 from .installer import Installer
+from .utils import read_key_or_fail
 from typing import Optional
 
 # Required for non-EFI installations
 #
 # bootloader_device: /dev/vdX
 #
+# Optional
+#
+# bootloader_config: native # optional: native or grub-mkconfig (default)
+#
+
+BOOTLOADER_CONFIGS = ('native', 'grub-mkconfig')
+# GRUB modules reading /boot
+GRUB_FS_MODULES = {
+    FSType.EXT4: 'ext2',
+    FSType.XFS: 'xfs',
+    FSType.BTRFS: 'btrfs',
+    FSType.F2FS: 'f2fs',
+    FSType.VFAT: 'fat',
+}
+# /etc/default/grub settings the native grub.cfg supports, the others need grub-mkconfig
+GRUB_DEFAULTS_SUPPORTED = ('GRUB_DEFAULT', 'GRUB_TIMEOUT', 'GRUB_TIMEOUT_STYLE', 'GRUB_DISTRIBUTOR',
+                           'GRUB_CMDLINE_LINUX', 'GRUB_CMDLINE_LINUX_DEFAULT', 'GRUB_DISABLE_RECOVERY',
+                           'GRUB_DISABLE_SUBMENU', 'GRUB_DISABLE_OS_PROBER')
+
+
+def parse_grub_defaults(data: str) -> dict[str, str]:
+    """Variables of /etc/default/grub, which is a shell script"""
+    res = {}
+    for line in data.splitlines():
+        line = line.strip()
+        if (not line) or line.startswith('#'):
+            continue
+        m = re.match(r'^(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*)$', line)
+        if not m:
+            raise ValueError('Unsupported line in /etc/default/grub: {}'.format(line))
+        value = m.group(2)
+        if '$' in value or '`' in value:
+            raise ValueError('Shell expansions in /etc/default/grub are not supported: {}'.format(line))
+        words = shlex.split(value, comments=True)
+        res[m.group(1)] = ' '.join(words)
+    return res
+
+
+def _version_key(kver: str) -> list:
+    return [(0, int(x)) if x.isdigit() else (1, x) for x in re.split(r'[.-]', kver)]
+
+
+def _is_plain_partition(unit: StorageUnit) -> bool:
+    return isinstance(unit, Partition) and isinstance(unit.storage_device, Disk) and \
+        (unit.fs_type in GRUB_FS_MODULES) and (unit.fs_uuid is not None)
+
+
+def native_grub_cfg(boot_unit: StorageUnit, boot_prefix: str, root_unit: StorageUnit,
+                    kvers: list[str], boot_files: list[str], defaults: dict[str, str]) -> str:
+    """A minimal grub.cfg booting the kernels in kvers from a plain partition.
+
+    boot_prefix is the path of /boot within boot_unit, boot_files are the names
+    of files in /boot. Raises ValueError if the configuration needs grub-mkconfig.
+    """
+    if not _is_plain_partition(boot_unit):
+        raise ValueError('/boot is not on a plain partition')
+    if boot_unit.subvolume_by_mount_point('/boot') or boot_unit.subvolume_by_mount_point('/'):
+        raise ValueError('/boot is on a btrfs subvolume')
+    if root_unit.fs_uuid is None:
+        raise ValueError('The UUID of / is unknown')
+    unsupported = [k for k, v in defaults.items()
+                   if k.startswith('GRUB_') and v and (k not in GRUB_DEFAULTS_SUPPORTED)]
+    if unsupported:
+        raise ValueError('Unsupported settings in /etc/default/grub: {}'.format(
+            ', '.join(sorted(unsupported))))
+    # The newest kernel goes first
+    if defaults.get('GRUB_DEFAULT', '0') not in ('', '0'):
+        raise ValueError('Unsupported GRUB_DEFAULT')
+
+    args = ['root=UUID={}'.format(root_unit.fs_uuid), 'ro']
+    root_subvolume = root_unit.subvolume_by_mount_point('/')
+    if root_subvolume is not None:
+        args.append('rootflags=subvol={}'.format(root_subvolume.name))
+    cmdline_linux = defaults.get('GRUB_CMDLINE_LINUX', '')
+    cmdline_default = defaults.get('GRUB_CMDLINE_LINUX_DEFAULT', '')
+    name = defaults.get('GRUB_DISTRIBUTOR', '') or DISTRO_NAME
+
+    lines = [
+        '# Generated by the installer, run grub-mkconfig -o /boot/grub/grub.cfg to regenerate\n',
+        'set default=0\n',
+        'set timeout={}\n'.format(defaults.get('GRUB_TIMEOUT', '') or '5'),
+    ]
+    if defaults.get('GRUB_TIMEOUT_STYLE', ''):
+        lines.append('set timeout_style={}\n'.format(defaults['GRUB_TIMEOUT_STYLE']))
+    lines.extend([
+        'insmod part_gpt\n',
+        'insmod part_msdos\n',
+        'insmod {}\n'.format(GRUB_FS_MODULES[boot_unit.fs_type]),
+        'search --no-floppy --fs-uuid --set=root {}\n'.format(boot_unit.fs_uuid),
+        'if [ "${grub_platform}" = "efi" ]; then\n',
+        '  insmod all_video\n',
+        'fi\n',
+    ])
+
+    ucode = sorted(f for f in boot_files if f.endswith('-ucode.img'))
+    recovery = defaults.get('GRUB_DISABLE_RECOVERY', '') != 'true'
+    for kver in sorted(kvers, key=_version_key, reverse=True):
+        kernel = f'vmlinuz-{kver}'
+        initramfs = f'initramfs-{kver}'
+        if kernel not in boot_files:
+            raise ValueError('No kernel image for {}'.format(kver))
+        initrds = [os.path.join(boot_prefix, f) for f in ucode]
+        if initramfs in boot_files:
+            initrds.append(os.path.join(boot_prefix, initramfs))
+        entries = [('{}, {}'.format(name, kver), [cmdline_linux, cmdline_default])]
+        if recovery:
+            entries.append(('{}, {} (recovery mode)'.format(name, kver), ['single', cmdline_linux]))
+        for title, extra_args in entries:
+            lines.extend([
+                "menuentry '{}' --class {} --class gnu-linux --class os {{\n".format(
+                    title.replace("'", "'\\''"), DISTRO),
+                '  insmod gzio\n',
+                '  linux {} {}\n'.format(os.path.join(boot_prefix, kernel),
+                                         ' '.join(a for a in args + extra_args if a)),
+            ])
+            if initrds:
+                lines.append('  initrd {}\n'.format(' '.join(initrds)))
+            lines.append('}\n')
+    return ''.join(lines)
 
 
 class BootloaderInstaller(Installer):
     def __init__(self, target_root: str, config: dict, event_receiver,
-                 arch: Arch, efi_mount: Optional[str]):
+                 arch: Arch, efi_mount: Optional[str],
+                 boot_artifacts: Optional[BootArtifacts] = None,
+                 smanager: Optional[StorageManager] = None):
         yaml_key = 'bootloader_device'
         super().__init__(name=yaml_key, config=config,
                          event_receiver=event_receiver,
@@ -25,6 +154,10 @@ class BootloaderInstaller(Installer):
 
         self._arch = arch
         self._efi_mount = efi_mount
+        # Without a shared tracker grub.cfg is generated right away
+        self._update_boot_artifacts = boot_artifacts is None
+        self._boot_artifacts = boot_artifacts or BootArtifacts(target_root)
+        self._smanager = smanager
         if self._efi_mount:
             self.add_package('grub', 'grub-efi')
         else:
@@ -35,12 +168,54 @@ class BootloaderInstaller(Installer):
                 raise ValueError("There must be an '{}' entry of type string".format(yaml_key))
             self.add_package('grub', 'grub-bios')
 
+        self._config_method = read_key_or_fail(config, 'bootloader_config', str,
+                                               error_label='bootloader_config') or 'grub-mkconfig'
+        if self._config_method not in BOOTLOADER_CONFIGS:
+            raise ValueError("Unknown bootloader_config '{}', supported: {}".format(
+                self._config_method, ', '.join(BOOTLOADER_CONFIGS)))
+
     def apply(self):
         pass
 
+    def _native_grub_cfg(self) -> str:
+        if self._smanager is None:
+            raise ValueError('The storage configuration is unknown')
+        boot_unit = self._smanager.get_unit_by_mount_point('/boot')
+        root_unit = self._smanager.get_unit_by_mount_point('/')
+        boot_prefix = '/'
+        if boot_unit is None:
+            boot_unit = root_unit
+            boot_prefix = '/boot'
+
+        boot_files = os.listdir(self.abs_target_path('/boot'))
+        kvers = kernel_versions(self.target_root)
+        if not kvers:
+            raise ValueError('No kernels in /boot')
+
+        defaults_path = self.abs_target_path('/etc/default/grub')
+        defaults = {}
+        if os.path.exists(defaults_path):
+            with open(defaults_path, 'r') as file:
+                defaults = parse_grub_defaults(file.read())
+        return native_grub_cfg(boot_unit=boot_unit, boot_prefix=boot_prefix, root_unit=root_unit,
+                               kvers=kvers, boot_files=boot_files, defaults=defaults)
+
+    def _make_grub_cfg(self):
+        if self._config_method == 'native':
+            try:
+                data = self._native_grub_cfg()
+            except ValueError as exc:
+                self._event_receiver.add_log_line('Falling back to grub-mkconfig: {}'.format(exc))
+            else:
+                path = self.abs_target_path(GRUB_CFG)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_file(path, 'w', data=data)
+                return
+        self.run_in_chroot(args=['grub-mkconfig', '-o', GRUB_CFG])
+
     def post_apply(self):
         self._event_receiver.start_event('Installing bootloader')
-        self.run_in_chroot(args=['grub-mkconfig', '-o', '/boot/grub/grub.cfg'])
+        self._boot_artifacts.request(GRUB_CFG, self._make_grub_cfg)
         if self._efi_mount:
             target = {Arch.X86_64: "x86_64-efi", Arch.AARCH64: "arm64-efi"}[self._arch]
             grub64_efi = {Arch.X86_64: "grubx64.efi", Arch.AARCH64: "grubaa64.efi"}[self._arch]
@@ -56,3 +231,6 @@ class BootloaderInstaller(Installer):
         else:
             self.run_in_chroot(args=['grub-install', '--target=i386-pc',
                                      '--boot-directory=/boot', self._data])
+
+        if self._update_boot_artifacts:
+            self._boot_artifacts.update(self._event_receiver)
@@ -0,0 +1,148 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from functools import partial
+from typing import Optional
+import os
+import re
+
+import attrs
+
+from alpaquita_installer.common.utils import run_cmd_live, run_concurrently
+from .installer import Installer
+from .utils import read_list
+
+# Optional
+#
+# jdk_cds:
+#   jdks: [ liberica17 ] # optional, directories in /usr/lib/jvm; all installed JDKs by default
+#   app_cds: # optional
+#     - jdk: liberica17
+#       class_list: /opt/app/classes.lst
+#       archive: /opt/app/app.jsa
+#       classpath: [ /opt/app/app.jar ] # optional
+#
+# The default CDS archive of each JDK is regenerated on the target machine.
+#
+
+JVM_DIR = '/usr/lib/jvm'
+# The first release supporting AppCDS archives of application classes without -XX:+UseAppCDS
+APP_CDS_MIN_VERSION = 11
+
+
+def java_major_version(release_data: str) -> Optional[int]:
+    """The major version from the 'release' file of a JDK: 1.8.0_392 is 8, 17.0.9 is 17"""
+    m = re.search(r'^JAVA_VERSION="?([0-9.]+)', release_data, flags=re.MULTILINE)
+    if not m:
+        return None
+    parts = m.group(1).split('.')
+    if parts[0] == '1' and len(parts) > 1:
+        return int(parts[1])
+    return int(parts[0])
+
+
+def validate_abs_path(instance, attribute, value):
+    if not (isinstance(value, str) and value.startswith('/')):
+        raise ValueError(f"'{attribute.name}' must be an absolute path")
+
+
+@attrs.define
+class AppCDSDescr:
+    jdk: str = attrs.field(validator=attrs.validators.instance_of(str))
+    class_list: str = attrs.field(validator=validate_abs_path)
+    archive: str = attrs.field(validator=validate_abs_path)
+    classpath: list[str] = attrs.field(
+        factory=list, validator=attrs.validators.deep_iterable(
+            member_validator=validate_abs_path, iterable_validator=attrs.validators.instance_of(list)))
+
+
+class JDKCDSInstaller(Installer):
+    def __init__(self, target_root: str, config: dict, event_receiver):
+        yaml_tag = 'jdk_cds'
+        super().__init__(name=yaml_tag, config=config,
+                         event_receiver=event_receiver,
+                         data_type=dict, data_is_optional=True,
+                         target_root=target_root)
+
+        self._jdks: list[str] = []
+        self._app_cds: list[AppCDSDescr] = []
+        if self._data is None:
+            return
+
+        self._jdks = read_list(self._data, key='jdks', item_type=str,
+                               error_label=f'{yaml_tag}/jdks')
+        items = read_list(self._data, key='app_cds', item_type=dict,
+                          error_label=f'{yaml_tag}/app_cds')
+        for (idx, item) in enumerate(items):
+            try:
+                app_cds = AppCDSDescr(**item)
+            except (ValueError, TypeError):
+                raise ValueError(f"Error in parsing '{yaml_tag}/app_cds/{idx}'")
+            if self._jdks and (app_cds.jdk not in self._jdks):
+                raise ValueError(f"'{yaml_tag}/app_cds/{idx}': '{app_cds.jdk}' is not in '{yaml_tag}/jdks'")
+            self._app_cds.append(app_cds)
+
+    def apply(self):
+        pass
+
+    def installed_jdks(self) -> list[str]:
+        jvm_dir = self.abs_target_path(JVM_DIR)
+        if not os.path.isdir(jvm_dir):
+            return []
+        res = []
+        for name in os.listdir(jvm_dir):
+            path = os.path.join(jvm_dir, name)
+            # E.g. default-jvm is a link to one of the JDKs
+            if os.path.islink(path):
+                continue
+            if os.path.isfile(os.path.join(path, 'bin/java')):
+                res.append(name)
+        return sorted(res)
+
+    def _java_version(self, jdk: str) -> Optional[int]:
+        path = self.abs_target_path(os.path.join(JVM_DIR, jdk, 'release'))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return java_major_version(file.read())
+
+    def _dump(self, jdk: str):
+        self._event_receiver.start_event(f'Generating CDS archive for {jdk}')
+        java = os.path.join(JVM_DIR, jdk, 'bin/java')
+        prefix = f'[{jdk}] '
+        run_cmd_live(args=['chroot', self.target_root, java, '-Xshare:dump'],
+                     event_receiver=self._event_receiver, line_prefix=prefix)
+
+        for app_cds in self._app_cds:
+            if app_cds.jdk != jdk:
+                continue
+            version = self._java_version(jdk)
+            if (version is not None) and (version < APP_CDS_MIN_VERSION):
+                raise RuntimeError('AppCDS requires Java {} or later, {} is Java {}'.format(
+                    APP_CDS_MIN_VERSION, jdk, version))
+            if not os.path.isfile(self.abs_target_path(app_cds.class_list)):
+                raise RuntimeError(f"Class list '{app_cds.class_list}' does not exist")
+            os.makedirs(os.path.dirname(self.abs_target_path(app_cds.archive)), exist_ok=True)
+            args = ['chroot', self.target_root, java, '-Xshare:dump',
+                    f'-XX:SharedClassListFile={app_cds.class_list}',
+                    f'-XX:SharedArchiveFile={app_cds.archive}']
+            if app_cds.classpath:
+                args.extend(['-cp', ':'.join(app_cds.classpath)])
+            run_cmd_live(args=args, event_receiver=self._event_receiver, line_prefix=prefix)
+
+    def post_apply(self):
+        if self._data is None:
+            return
+
+        installed = self.installed_jdks()
+        jdks = self._jdks or installed
+        missing = [jdk for jdk in jdks + [a.jdk for a in self._app_cds] if jdk not in installed]
+        if missing:
+            raise RuntimeError('JDKs not installed in {}: {}'.format(JVM_DIR, ', '.join(sorted(set(missing)))))
+        if not jdks:
+            self._event_receiver.add_log_line('No JDKs installed, no CDS archives to generate')
+            return
+
+        # Each dump is single-threaded for the most part
+        run_concurrently([(jdk, partial(self._dump, jdk)) for jdk in jdks],
+                         event_receiver=self._event_receiver)
@@ -1,22 +1,66 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
+from typing import Iterable, Optional
 import os
-import re
+import shlex
 
+from alpaquita_installer.common.boot_artifacts import BootArtifacts, initramfs_path, kernel_versions
 from alpaquita_installer.common.utils import write_file
 from .installer import Installer
-from .utils import read_list
+from .utils import read_key_or_fail, read_list
 
 # Optional
 #
 # kernel:
 #   cmdline: [ 'quiet' ]
+#   initramfs: # optional
+#     hostonly: true # optional, false by default
+#     compress: zstd # optional: zstd, xz, gzip, lz4 or none
 #
 
+# Compressor commands passed to dracut, all of them use every CPU
+COMPRESSORS = {
+    'zstd': 'zstd -q -15 -T0',
+    'xz': 'xz --check=crc32 --lzma2=dict=1MiB -T0',
+    'gzip': 'pigz -9',
+    'lz4': 'lz4 -l -9',
+    'none': 'cat',
+}
+COMPRESSOR_PACKAGES = {
+    'zstd': 'zstd',
+    'xz': 'xz',
+    'gzip': 'pigz',
+    'lz4': 'lz4',
+}
+DEFAULT_COMPRESSOR = 'zstd'
+# dracut modules of the storage stack, omitted from host-only images if not used
+STORAGE_DRACUT_MODULES = ('crypt', 'mdraid', 'lvm')
+DRACUT_CONF = '/etc/dracut.conf.d/kernel.conf'
+
+
+def _arg_name(arg: str) -> str:
+    return arg.split('=', 1)[0]
+
+
+def merge_cmdline(cmdline: list[str], extra: list[str], override: bool = True) -> list[str]:
+    """Appends extra arguments to cmdline.
+
+    With override the ones with the same name are removed from cmdline,
+    otherwise the extra arguments already set in cmdline are skipped.
+    """
+    if override:
+        names = {_arg_name(arg) for arg in extra}
+        return [arg for arg in cmdline if _arg_name(arg) not in names] + list(extra)
+    names = {_arg_name(arg) for arg in cmdline}
+    return list(cmdline) + [arg for arg in extra if _arg_name(arg) not in names]
+
 
 class KernelInstaller(Installer):
-    def __init__(self, target_root: str, config: dict, event_receiver):
+    def __init__(self, target_root: str, config: dict, event_receiver,
+                 storage_dracut_modules: Iterable[str] = (),
+                 boot_artifacts: Optional[BootArtifacts] = None,
+                 extra_cmdline: Iterable[str] = ()):
         yaml_tag = 'kernel'
         super().__init__(name=yaml_tag, config=config,
                          event_receiver=event_receiver,
@@ -24,36 +68,92 @@ class KernelInstaller(Installer):
                          target_root=target_root)
 
         self._cmdline: list[str] = []
+        self._hostonly = False
+        self._compress = DEFAULT_COMPRESSOR
         if self._data is not None:
             yaml_key = 'cmdline'
             self._cmdline = read_list(self._data, key=yaml_key, item_type=str,
                                       error_label=f'{yaml_tag}/{yaml_key}')
 
+            initramfs = read_key_or_fail(self._data, 'initramfs', dict,
+                                         error_label=f'{yaml_tag}/initramfs')
+            self._hostonly = read_key_or_fail(initramfs, 'hostonly', bool,
+                                              error_label=f'{yaml_tag}/initramfs/hostonly')
+            compress = read_key_or_fail(initramfs, 'compress', str,
+                                        error_label=f'{yaml_tag}/initramfs/compress')
+            if compress:
+                if compress not in COMPRESSORS:
+                    raise ValueError("Unknown initramfs compression '{}', supported: {}".format(
+                        compress, ', '.join(COMPRESSORS)))
+                self._compress = compress
+
+        # Arguments of other installers, added to the configured or the default cmdline
+        self._extra_cmdline = list(extra_cmdline)
+        self._storage_dracut_modules = list(storage_dracut_modules)
+        for module in self._storage_dracut_modules:
+            if module not in STORAGE_DRACUT_MODULES:
+                raise ValueError('Unknown storage dracut module: {}'.format(module))
+
+        # Without a shared tracker the images are built right away
+        self._update_boot_artifacts = boot_artifacts is None
+        self._boot_artifacts = boot_artifacts or BootArtifacts(target_root)
+
         self.add_package('linux-lts')
+        if self._compress in COMPRESSOR_PACKAGES:
+            self.add_package(COMPRESSOR_PACKAGES[self._compress])
 
     def apply(self):
         pass
 
-    def post_apply(self):
-        self._event_receiver.start_event('Regenerating initrd')
-
-        kver = None
-        for name in os.listdir(self.abs_target_path('/boot')):
-            m = re.match(r'^config-(\d+.*)$', name)
-            if m:
-                kver = m.group(1)
-                break
-        if not kver:
+    def dracut_conf_data(self) -> str:
+        lines = ['compress="{}"\n'.format(COMPRESSORS[self._compress])]
+        if self._hostonly:
+            # The installer runs on the target machine, so the loaded drivers are the right ones.
+            # The storage stack is not visible from the chroot, so it's set explicitly.
+            lines.append('hostonly="yes"\n')
+            lines.append('hostonly_cmdline="no"\n')
+            if self._storage_dracut_modules:
+                lines.append('add_dracutmodules+=" {} "\n'.format(' '.join(self._storage_dracut_modules)))
+            omitted = [m for m in STORAGE_DRACUT_MODULES if m not in self._storage_dracut_modules]
+            if omitted:
+                lines.append('omit_dracutmodules+=" {} "\n'.format(' '.join(omitted)))
+        return ''.join(lines)
+
+    def kernel_versions(self) -> list[str]:
+        res = kernel_versions(self.target_root)
+        if not res:
             raise RuntimeError('Unable to determine the installed kernel version')
-        self.run_in_chroot(args=['dracut', '-f', f'/boot/initramfs-{kver}', kver])
+        return sorted(res)
+
+    def _make_initramfs(self, kver: str):
+        self.run_in_chroot(args=['dracut', '-f', initramfs_path(kver), kver])
 
-        if self._cmdline:
+    def post_apply(self):
+        conf_path = self.abs_target_path(DRACUT_CONF)
+        os.makedirs(os.path.dirname(conf_path), exist_ok=True)
+        write_file(conf_path, 'w', data=self.dracut_conf_data())
+
+        for kver in self.kernel_versions():
+            self._boot_artifacts.request(initramfs_path(kver),
+                                         lambda kver=kver: self._make_initramfs(kver))
+
+        if self._cmdline or self._extra_cmdline:
             grub_path = self.abs_target_path('/etc/default/grub')
             data = ''
             with open(grub_path, 'r') as f:
                 for line in f.readlines():
                     if line.startswith("GRUB_CMDLINE_LINUX_DEFAULT="):
-                        line = 'GRUB_CMDLINE_LINUX_DEFAULT="{}"\n'.format(' '.join(self._cmdline))
+                        if self._cmdline:
+                            # kernel/cmdline takes precedence over the other installers
+                            cmdline = merge_cmdline(self._cmdline, self._extra_cmdline, override=False)
+                        else:
+                            # The shell value is a single quoted string of arguments
+                            cmdline = ' '.join(shlex.split(line.split('=', 1)[1])).split()
+                            cmdline = merge_cmdline(cmdline, self._extra_cmdline)
+                        line = 'GRUB_CMDLINE_LINUX_DEFAULT="{}"\n'.format(' '.join(cmdline))
                     data += line
 
             write_file(grub_path, 'w', data=data)
+
+        if self._update_boot_artifacts:
+            self._boot_artifacts.update(self._event_receiver)
@@ -0,0 +1,181 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from typing import Optional
+import glob
+import os
+import re
+import time
+
+from alpaquita_installer.common.utils import write_file
+from .installer import Installer
+from .utils import read_key_or_fail
+
+# Optional
+#
+# libc:
+#   perf: true # optional, musl only
+#   allocator: mimalloc # optional: default, mimalloc or jemalloc
+#   benchmark: true # optional, compares the allocator with the default one, musl-perf is not compared
+#
+
+# Allocator -> (package, library in the target)
+ALLOCATORS = {
+    'mimalloc': ('mimalloc2', '/usr/lib/libmimalloc.so.*'),
+    'jemalloc': ('jemalloc', '/usr/lib/libjemalloc.so.*'),
+}
+DEFAULT_ALLOCATOR = 'default'
+
+# Workload -> command run in the target
+BENCHMARKS = {
+    # Lots of small allocations and frees from a single thread
+    'malloc': ['busybox', 'awk',
+               'BEGIN { for (r = 0; r < 4; r++) { for (i = 0; i < 200000; i++) a[i] = sprintf("%d:%d", i, r); '
+               'for (k in a) delete a[k] } }'],
+    # Buffers of many small jobs allocated and freed by all CPUs
+    'threads': ['sh', '-c', 'head -c 268435456 /dev/zero | zstd -T0 -B1M -1 -q -c > /dev/null'],
+}
+BENCHMARK_RUNS = 3
+# Slower than the default allocator by more than this is reported
+REGRESSION_TOLERANCE = 0.1
+BENCHMARK_LOG = '/var/log/libc-benchmark.log'
+PROFILE_SCRIPT = '/etc/profile.d/allocator.sh'
+RC_CONF = '/etc/rc.conf'
+RC_CONF_MARKER = '# Memory allocator, set by the installer\n'
+
+
+class LibcInstaller(Installer):
+    def __init__(self, target_root: str, config: dict, event_receiver):
+        yaml_tag = 'libc'
+        super().__init__(name=yaml_tag, config=config,
+                         event_receiver=event_receiver,
+                         data_type=dict, data_is_optional=True,
+                         target_root=target_root)
+
+        self._perf = False
+        self._allocator = DEFAULT_ALLOCATOR
+        self._benchmark = False
+        if self._data is None:
+            return
+
+        self._perf = read_key_or_fail(self._data, 'perf', bool, error_label=f'{yaml_tag}/perf')
+        self._allocator = read_key_or_fail(self._data, 'allocator', str,
+                                           error_label=f'{yaml_tag}/allocator') or DEFAULT_ALLOCATOR
+        if (self._allocator != DEFAULT_ALLOCATOR) and (self._allocator not in ALLOCATORS):
+            raise ValueError("Unknown allocator '{}', supported: {}".format(
+                self._allocator, ', '.join([DEFAULT_ALLOCATOR] + list(ALLOCATORS))))
+        self._benchmark = read_key_or_fail(self._data, 'benchmark', bool,
+                                           error_label=f'{yaml_tag}/benchmark')
+
+        if self._perf:
+            # CPU features detection and optimized string functions
+            self.add_package('musl-perf')
+        if self._allocator in ALLOCATORS:
+            self.add_package(ALLOCATORS[self._allocator][0])
+        if self._benchmark:
+            self.add_package('zstd')
+
+    def apply(self):
+        pass
+
+    def is_musl(self) -> bool:
+        return bool(glob.glob(self.abs_target_path('/lib/ld-musl-*.so.1')))
+
+    def allocator_library(self) -> Optional[str]:
+        if self._allocator not in ALLOCATORS:
+            return None
+        libs = sorted(p for p in glob.glob(self.abs_target_path(ALLOCATORS[self._allocator][1]))
+                      if re.match(r'.*\.so\.\d+$', p))
+        if not libs:
+            raise RuntimeError('No {} library found in the target'.format(self._allocator))
+        return '/' + os.path.relpath(libs[0], self.target_root)
+
+    def _time_run(self, args: list[str], preload: Optional[str]) -> float:
+        env = ['env', '-u', 'LD_PRELOAD'] if preload is None else ['env', f'LD_PRELOAD={preload}']
+        best = None
+        for _ in range(BENCHMARK_RUNS):
+            start = time.monotonic()
+            self.run_in_chroot(args=env + args)
+            elapsed = time.monotonic() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def run_benchmark(self, lib: Optional[str]) -> dict[str, dict[str, float]]:
+        """Best times in seconds of each workload, with the default and with the chosen allocator"""
+        res = {}
+        for name, args in BENCHMARKS.items():
+            res[name] = {DEFAULT_ALLOCATOR: self._time_run(args, preload=None)}
+            if lib:
+                res[name][self._allocator] = self._time_run(args, preload=lib)
+        return res
+
+    def report_benchmark(self, results: dict[str, dict[str, float]]) -> list[str]:
+        """Writes the results to the benchmark log, returns the regressed workloads"""
+        lines = []
+        regressed = []
+        for name, times in results.items():
+            line = '{}: '.format(name) + ', '.join('{} {:.3f}s'.format(k, v) for k, v in times.items())
+            chosen = times.get(self._allocator, None)
+            if (chosen is not None) and (chosen > times[DEFAULT_ALLOCATOR] * (1 + REGRESSION_TOLERANCE)):
+                regressed.append(name)
+                line += ' (regression)'
+            lines.append(line + '\n')
+        path = self.abs_target_path(BENCHMARK_LOG)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, 'w', data=''.join(lines))
+        for line in lines:
+            self._event_receiver.add_log_line('libc benchmark: {}'.format(line.strip()))
+        return regressed
+
+    def _activate(self, lib: str):
+        if not self.is_musl():
+            # glibc preloads it into every process
+            path = self.abs_target_path('/etc/ld.so.preload')
+            preloaded = []
+            if os.path.exists(path):
+                with open(path, 'r') as file:
+                    preloaded = file.read().split()
+            if lib not in preloaded:
+                write_file(path, 'a', data=lib + '\n')
+            return
+
+        # musl has no ld.so.preload, so the variable is set for login shells and for the services
+        profile_path = self.abs_target_path(PROFILE_SCRIPT)
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+        write_file(profile_path, 'w',
+                   data='export LD_PRELOAD="{}${{LD_PRELOAD:+ $LD_PRELOAD}}"\n'.format(lib))
+        path = self.abs_target_path(RC_CONF)
+        lines = []
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                lines = [line for line in file.readlines()
+                         if line != RC_CONF_MARKER and not line.startswith('export LD_PRELOAD=')]
+        # rc.conf is sourced by openrc-run before starting each service
+        lines.extend([RC_CONF_MARKER, 'export LD_PRELOAD="{}"\n'.format(lib)])
+        write_file(path, 'w', data=''.join(lines))
+
+    def post_apply(self):
+        if self._data is None:
+            return
+
+        lib = self.allocator_library()
+        if self._benchmark:
+            self._event_receiver.start_event('Running libc benchmark')
+            regressed = self.report_benchmark(self.run_benchmark(lib))
+            if regressed:
+                self._event_receiver.start_event(
+                    'Warning: {} is slower than the default allocator in: {}, see {}'.format(
+                        self._allocator, ', '.join(regressed), BENCHMARK_LOG))
+
+    def activate_allocator(self):
+        """Preloads the allocator, called after all other commands have run in the target.
+
+        With glibc every later process in the chroot (dracut, grub-mkconfig, java...)
+        would get the allocator otherwise.
+        """
+        if self._data is None:
+            return
+        lib = self.allocator_library()
+        if lib:
+            self._event_receiver.start_event('Activating {}'.format(self._allocator))
+            self._activate(lib)
@@ -0,0 +1,225 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from __future__ import annotations
+from typing import Optional
+import enum
+import os
+import re
+
+import attrs
+
+from alpaquita_installer.common.utils import write_file
+from .installer import Installer
+from .utils import read_key_or_fail
+
+# Optional
+#
+# performance_profile:
+#   name: throughput # optional: throughput, latency or container-host; chosen from RAM and CPUs by default
+#   transparent_hugepages: madvise # optional: always, madvise or never
+#   hugepages: 512 # optional, the number of reserved 2M pages
+#   max_map_count: 262144 # optional
+#   nofile: 1048576 # optional
+#   swappiness: 10 # optional
+#   cpu_governor: performance # optional
+#
+
+
+class PerformanceProfile(enum.Enum):
+    # Batch and server workloads on machines with plenty of memory
+    THROUGHPUT = 1
+    # Predictable pauses, no background compaction of huge pages
+    LATENCY = 2
+    # Many JVMs in containers
+    CONTAINER_HOST = 3
+
+    @classmethod
+    def from_str(cls, value: str) -> PerformanceProfile:
+        ret = getattr(cls, value.strip().upper().replace('-', '_'), None)
+        if ret is None:
+            raise ValueError('Unknown performance profile: {}'.format(value))
+        return ret
+
+    def __str__(self) -> str:
+        return self.name.lower().replace('_', '-')
+
+
+THP_MODES = ('always', 'madvise', 'never')
+CPU_GOVERNORS = ('performance', 'schedutil', 'ondemand', 'conservative', 'powersave')
+# The default fs.nr_open, a higher nofile limit needs a higher one
+DEFAULT_NR_OPEN = 1048576
+SYSCTL_CONF = '/etc/sysctl.d/60-performance-profile.conf'
+LIMITS_CONF = '/etc/security/limits.d/60-performance-profile.conf'
+RC_CONF = '/etc/rc.conf'
+
+# YAML keys overriding the settings of the profile
+SETTING_TYPES = {
+    'transparent_hugepages': str,
+    'hugepages': int,
+    'max_map_count': int,
+    'nofile': int,
+    'swappiness': int,
+    'cpu_governor': str,
+}
+
+GiB = 1024 * 1024 * 1024
+
+
+@attrs.frozen
+class PerformanceSettings:
+    transparent_hugepages: str
+    hugepages: int
+    max_map_count: int
+    nofile: int
+    swappiness: int
+    cpu_governor: str
+
+
+PROFILES: dict[PerformanceProfile, PerformanceSettings] = {
+    PerformanceProfile.THROUGHPUT: PerformanceSettings(
+        transparent_hugepages='always', hugepages=0, max_map_count=262144,
+        nofile=1048576, swappiness=10, cpu_governor='performance'),
+    PerformanceProfile.LATENCY: PerformanceSettings(
+        transparent_hugepages='madvise', hugepages=0, max_map_count=262144,
+        nofile=1048576, swappiness=1, cpu_governor='performance'),
+    PerformanceProfile.CONTAINER_HOST: PerformanceSettings(
+        transparent_hugepages='madvise', hugepages=0, max_map_count=1048576,
+        nofile=1048576, swappiness=10, cpu_governor='schedutil'),
+}
+# Only set on the container hosts
+CONTAINER_HOST_SYSCTLS = {
+    'fs.inotify.max_user_instances': 8192,
+    'fs.inotify.max_user_watches': 524288,
+    'kernel.pid_max': 4194304,
+}
+
+
+def host_resources() -> tuple[int, int]:
+    """RAM in bytes and the number of CPUs of the machine running the installer"""
+    ram = 0
+    with open('/proc/meminfo', 'r') as file:
+        for line in file:
+            m = re.match(r'^MemTotal:\s+(\d+) kB', line)
+            if m:
+                ram = int(m.group(1)) * 1024
+                break
+    return ram, len(os.sched_getaffinity(0))
+
+
+def default_profile(ram: int, cpus: int) -> PerformanceProfile:
+    if ram >= 32 * GiB and cpus >= 16:
+        return PerformanceProfile.CONTAINER_HOST
+    if ram >= 4 * GiB and cpus >= 4:
+        return PerformanceProfile.THROUGHPUT
+    # THP=always wastes memory and khugepaged competes for CPU on small machines
+    return PerformanceProfile.LATENCY
+
+
+class PerformanceProfileInstaller(Installer):
+    def __init__(self, target_root: str, config: dict, event_receiver,
+                 resources: Optional[tuple[int, int]] = None):
+        yaml_tag = 'performance_profile'
+        super().__init__(name=yaml_tag, config=config,
+                         event_receiver=event_receiver,
+                         data_type=dict, data_is_optional=True,
+                         target_root=target_root)
+
+        self._profile: Optional[PerformanceProfile] = None
+        self._settings: Optional[PerformanceSettings] = None
+        if self._data is None:
+            return
+
+        name = read_key_or_fail(self._data, 'name', str, error_label=f'{yaml_tag}/name')
+        if name:
+            self._profile = PerformanceProfile.from_str(name)
+        else:
+            ram, cpus = resources or host_resources()
+            self._profile = default_profile(ram=ram, cpus=cpus)
+            self._event_receiver.add_log_line('Performance profile {} chosen for {} GiB of RAM and {} CPUs'.format(
+                self._profile, ram // GiB, cpus))
+
+        overrides = {}
+        for key, value_type in SETTING_TYPES.items():
+            if key not in self._data:
+                continue
+            value = read_key_or_fail(self._data, key, value_type, error_label=f'{yaml_tag}/{key}')
+            if value_type is int and (isinstance(value, bool) or value < 0):
+                raise ValueError(f"'{yaml_tag}/{key}' must be a non-negative integer")
+            overrides[key] = value
+        self._settings = attrs.evolve(PROFILES[self._profile], **overrides)
+
+        if self._settings.transparent_hugepages not in THP_MODES:
+            raise ValueError("Unknown transparent_hugepages mode '{}', supported: {}".format(
+                self._settings.transparent_hugepages, ', '.join(THP_MODES)))
+        if self._settings.cpu_governor not in CPU_GOVERNORS:
+            raise ValueError("Unknown cpu_governor '{}', supported: {}".format(
+                self._settings.cpu_governor, ', '.join(CPU_GOVERNORS)))
+        if self._settings.swappiness > 200:
+            raise ValueError(f"'{yaml_tag}/swappiness' must not exceed 200")
+        if not self._settings.nofile:
+            raise ValueError(f"'{yaml_tag}/nofile' must be positive")
+
+    @property
+    def profile(self) -> Optional[PerformanceProfile]:
+        return self._profile
+
+    @property
+    def settings(self) -> Optional[PerformanceSettings]:
+        return self._settings
+
+    @property
+    def kernel_cmdline(self) -> list[str]:
+        """Set on the kernel cmdline, so that they apply from the start of the boot"""
+        if self._settings is None:
+            return []
+        res = ['transparent_hugepage={}'.format(self._settings.transparent_hugepages),
+               'cpufreq.default_governor={}'.format(self._settings.cpu_governor)]
+        if self._settings.hugepages:
+            # Reserved before the memory gets fragmented
+            res.extend(['hugepagesz=2M', 'hugepages={}'.format(self._settings.hugepages)])
+        return res
+
+    def sysctl_conf_data(self) -> str:
+        values = {
+            'vm.max_map_count': self._settings.max_map_count,
+            'vm.swappiness': self._settings.swappiness,
+        }
+        if self._settings.nofile > DEFAULT_NR_OPEN:
+            values['fs.nr_open'] = self._settings.nofile
+        if self._profile == PerformanceProfile.CONTAINER_HOST:
+            values.update(CONTAINER_HOST_SYSCTLS)
+        return ''.join('{} = {}\n'.format(k, v) for k, v in values.items())
+
+    def limits_conf_data(self) -> str:
+        # The wildcard does not apply to root
+        return ''.join('{} {} nofile {}\n'.format(domain, kind, self._settings.nofile)
+                       for domain in ('*', 'root') for kind in ('soft', 'hard'))
+
+    def apply(self):
+        pass
+
+    def _write_rc_conf(self):
+        path = self.abs_target_path(RC_CONF)
+        lines = []
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                lines = [line for line in file.readlines() if not re.match(r'^\s*rc_ulimit=', line)]
+        # Limits of the services started by OpenRC
+        lines.append('rc_ulimit="-n {}"\n'.format(self._settings.nofile))
+        write_file(path, 'w', data=''.join(lines))
+
+    def post_apply(self):
+        if self._settings is None:
+            return
+
+        self._event_receiver.start_event('Applying performance profile {}'.format(self._profile))
+        sysctl_path = self.abs_target_path(SYSCTL_CONF)
+        os.makedirs(os.path.dirname(sysctl_path), exist_ok=True)
+        write_file(sysctl_path, 'w', data=self.sysctl_conf_data())
+        self._write_rc_conf()
+        # Login sessions get the limits only through PAM
+        if os.path.isdir(self.abs_target_path('/etc/security')):
+            limits_path = self.abs_target_path(LIMITS_CONF)
+            os.makedirs(os.path.dirname(limits_path), exist_ok=True)
+            write_file(limits_path, 'w', data=self.limits_conf_data())
@@ -1,8 +1,13 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
+from functools import partial
+from typing import Optional, Union
+import re
+
 import attrs
 
+from alpaquita_installer.common.utils import run_cmd_live, run_concurrently
 from .installer import Installer
 from .utils import read_list
 
@@ -12,6 +17,10 @@ from .utils import read_list
 #   - interpreter: /bin/sh
 #     chroot: true # Optional, true by default
 #     script: cat /etc/passwd
+#     group: setup # Optional, scripts of the same group run concurrently
+#     timeout: 600 # Optional, in seconds
+#     env: # Optional
+#       KEY: value
 #
 # The script content wil be passed to the standard input of the interpreter.
 #
@@ -22,11 +31,46 @@ def validate_empty(value: str):
         raise ValueError(f"'{value}' is an empty string")
 
 
+def convert_env(value):
+    # Numbers and booleans in YAML are passed as strings
+    if not isinstance(value, dict):
+        return value
+    res = {}
+    for k, v in value.items():
+        if isinstance(v, bool):
+            v = str(v).lower()
+        elif isinstance(v, (int, float)):
+            v = str(v)
+        res[k] = v
+    return res
+
+
+def validate_env(instance, attribute, value):
+    if not isinstance(value, dict):
+        raise ValueError(f"'{attribute.name}' must be a dict")
+    for k, v in value.items():
+        if not (isinstance(k, str) and re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', k)):
+            raise ValueError(f"Invalid environment variable name: '{k}'")
+        if not isinstance(v, str):
+            raise ValueError(f"The value of '{k}' must be a scalar")
+
+
+def validate_timeout(instance, attribute, value):
+    if value is None:
+        return
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError(f"'{attribute.name}' must be a positive number")
+
+
 @attrs.define
 class ScriptDescr:
     interpreter: str = attrs.field(validator=attrs.validators.instance_of(str))
     script: str = attrs.field(validator=attrs.validators.instance_of(str))
     chroot: bool = attrs.field(default=True, validator=attrs.validators.instance_of(bool))
+    group: Optional[Union[str, int]] = attrs.field(
+        default=None, validator=attrs.validators.optional(attrs.validators.instance_of((str, int))))
+    timeout: Optional[float] = attrs.field(default=None, validator=validate_timeout)
+    env: dict[str, str] = attrs.field(factory=dict, converter=convert_env, validator=validate_env)
 
     @interpreter.validator
     def check_interpreter(self, attribute, value):
@@ -58,17 +102,39 @@ class PostScriptsInstaller(Installer):
     def apply(self):
         pass
 
+    def _groups(self) -> list[list[tuple[int, ScriptDescr]]]:
+        """Scripts of a group run at the position of its first script"""
+        res = []
+        by_group = {}
+        for idx, script in enumerate(self._scripts):
+            if script.group is None:
+                res.append([(idx, script)])
+            elif script.group in by_group:
+                by_group[script.group].append((idx, script))
+            else:
+                by_group[script.group] = [(idx, script)]
+                res.append(by_group[script.group])
+        return res
+
+    def _run_script(self, idx: int, script: ScriptDescr, line_prefix: str = ''):
+        args = script.interpreter.split()
+        if script.chroot:
+            args = ['chroot', self.target_root] + args
+        self._event_receiver.add_log_line(
+            "{}Executing post install script. Interpreter: '{}', chroot: {}, script: '{}'".format(
+                line_prefix, script.interpreter, script.chroot, script.script))
+        run_cmd_live(args=args, input=bytes(script.script, encoding='utf-8'),
+                     timeout=script.timeout, env=script.env or None,
+                     event_receiver=self._event_receiver, line_prefix=line_prefix)
+
     def post_apply(self):
         if len(self._scripts) == 0:
             return
 
-        for script in self._scripts:
-            args = script.interpreter.split()
-            script_content = bytes(script.script, encoding='utf-8')
-            self._event_receiver.add_log_line("Executing post install script. Interpreter: '{}', chroot: {}, script: '{}'".format(
-                script.interpreter, script.chroot, script.script
-            ))
-            if script.chroot:
-                self.run_in_chroot(args=args, input=script_content)
-            else:
-                self.run(args=args, input=script_content)
+        for group in self._groups():
+            if len(group) == 1:
+                self._run_script(*group[0])
+                continue
+            # Output lines of concurrent scripts are told apart by the script index
+            run_concurrently([(str(idx), partial(self._run_script, idx, script, f'[{idx}] '))
+                              for idx, script in group], event_receiver=self._event_receiver)
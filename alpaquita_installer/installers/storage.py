@@ -3,14 +3,19 @@
 
 from __future__ import annotations
 import os
+import threading
 from typing import Optional, Union, cast
 
 import attrs
 
 from alpaquita_installer.smanager.manager import StorageManager
 from alpaquita_installer.smanager.storage_unit import Partition, StorageUnit, StorageUnitFlag, CryptoVolume
-from alpaquita_installer.smanager.file_system import FSType
-from alpaquita_installer.common.utils import run_cmd
+from alpaquita_installer.smanager.storage_device import WipeMethod
+from alpaquita_installer.smanager.luks import LUKSParams
+from alpaquita_installer.smanager.lvm import LVCache, VolumeGroup
+from alpaquita_installer.smanager.file_system import FSType, MkfsProfile, MountProfile, Subvolume
+from alpaquita_installer.smanager.utils import umount_fs_with_retries
+from alpaquita_installer.common.utils import run_cmd, write_file
 from .installer import Installer
 from .utils import read_key_or_fail, str_size_to_bytes, read_list
 
@@ -24,6 +29,7 @@ from .utils import read_key_or_fail, str_size_to_bytes, read_list
 # storage:
 #   disks:
 #     - id: /dev/vda
+#       wipe: discard # optional: zero-headers, discard or secure
 #       partitions:
 #         - id: efi
 #           size: 512M
@@ -34,12 +40,22 @@ from .utils import read_key_or_fail, str_size_to_bytes, read_list
 #           size: 1G
 #           fs_type: ext4
 #           mount_point: /boot
+#           mkfs_profile: fast-create # optional: fast-create, database, many-small-files
+#           mkfs_opts: [ '-L', 'boot' ] # optional
 #         - id: raid_vda
 #           size: 10G
 #           fs_type: raid_member
 #         - id: secret_data
 #           fs_type: crypto_partition
 #           crypto_passphrase: super-secret
+#           crypto: # optional
+#             cipher: aes-xts-plain64
+#             key_size: 512
+#             pbkdf: argon2id
+#             pbkdf_memory: 65536
+#             pbkdf_parallel: 4
+#             iter_time: 1000 # or pbkdf_iterations
+#             sector_size: 4096
 #     - id: /dev/vdb
 #       partitions:
 #         - id: raid_vdb
@@ -55,6 +71,9 @@ from .utils import read_key_or_fail, str_size_to_bytes, read_list
 #     - id: some_raid
 #       level: 1
 #       members: [ raid_vda, raid_vdb ]
+#       chunk_size: 512K # optional, RAID0/5/6/10 only
+#       assume_clean: false # optional, not for RAID0
+#       bitmap: internal # optional: internal or none, not for RAID0
 #       partitions:
 #         - id: pv1
 #           size: 5G
@@ -73,6 +92,36 @@ from .utils import read_key_or_fail, str_size_to_bytes, read_list
 #           fs_type: ext4
 #           fs_opts: [ 'noauto' ]
 #           mount_point: /home
+#           stripes: 2 # optional
+#           stripe_size: 64K # optional
+#           cache: # optional
+#             mode: writethrough # writethrough, writeback or writecache
+#             size: 1G
+#             physical_volume: pv1
+#         - id: pool
+#           size: 1G
+#           thin_pool: true
+#         - id: var
+#           size: 10G
+#           fs_type: btrfs
+#           fs_opts: [ 'compress=zstd' ]
+#           mount_point: /var
+#           subvolumes: # optional, btrfs only
+#             - name: log
+#               mount_point: /var/log
+#             - name: snapshots
+#         - id: thin
+#           size: 5G
+#           pool: pool
+#           fs_type: xfs
+#           mount_point: /srv
+#           mount_profile: throughput # optional: general or throughput
+#   raid_resync_speed_limit: 10000 # optional, KiB/s during the installation
+#   tmp_on_tmpfs: true # optional
+#   tmp_size: 2G # optional, or a percentage of RAM like 25%
+
+# Seconds between the reports of the RAID resync progress during the installation
+RAID_SYNC_REPORT_INTERVAL = 60
 
 
 @attrs.define
@@ -82,8 +131,13 @@ class UnitParams:
     fs_type: Optional[FSType]
     mount_point: Optional[str]
     crypto_passphrase: Optional[str]
+    crypto_params: Optional[LUKSParams] = None
+    mkfs_profile: Optional[MkfsProfile] = None
     fs_opts: list[str] = attrs.field(default=attrs.Factory(list))
     flags: set[StorageUnitFlag] = attrs.field(default=attrs.Factory(set))
+    mkfs_opts: list[str] = attrs.field(default=attrs.Factory(list))
+    subvolumes: list[Subvolume] = attrs.field(default=attrs.Factory(list))
+    mount_profile: Optional[MountProfile] = None
 
     @staticmethod
     def from_dict(data: dict) -> UnitParams:
@@ -102,16 +156,48 @@ class UnitParams:
         mount_point = data.get('mount_point', None)
         crypto_passphrase = data.get('crypto_passphrase', None)
 
+        crypto_params = None
+        crypto_data = read_key_or_fail(data, 'crypto', dict, error_label='crypto')
+        if crypto_data:
+            try:
+                crypto_params = LUKSParams.from_dict(crypto_data)
+            except ValueError as exc:
+                raise ValueError("Error in parsing 'crypto' of '{}': {}".format(id, exc)) from None
+
         fs_opts = read_list(data, key='fs_opts', item_type=str, error_label='fs_opts')
+        mkfs_opts = read_list(data, key='mkfs_opts', item_type=str, error_label='mkfs_opts')
+
+        mkfs_profile = read_key_or_fail(data, 'mkfs_profile', str, error_label='mkfs_profile')
+        if mkfs_profile:
+            mkfs_profile = MkfsProfile.from_str(mkfs_profile)
+        else:
+            mkfs_profile = None
+
+        mount_profile = read_key_or_fail(data, 'mount_profile', str, error_label='mount_profile')
+        if mount_profile:
+            mount_profile = MountProfile.from_str(mount_profile)
+        else:
+            mount_profile = None
 
         flags_s = read_list(data, key='flags', item_type=str, error_label='flags')
         flags = []
         for flag_s in flags_s:
             flags.append(StorageUnitFlag.from_str(flag_s))
 
+        subvolumes = []
+        for i, subvolume_item in enumerate(read_list(data, key='subvolumes', item_type=dict,
+                                                     error_label='subvolumes')):
+            name = read_key_or_fail(subvolume_item, 'name', str, error_label=f'subvolumes/{i}/name')
+            subvolume_mount_point = read_key_or_fail(subvolume_item, 'mount_point', str,
+                                                     error_label=f'subvolumes/{i}/mount_point')
+            subvolumes.append(Subvolume(name=name, mount_point=subvolume_mount_point or None))
+
         return UnitParams(id=id, size=size, fs_type=fs_type, fs_opts=fs_opts,
                           mount_point=mount_point, flags=flags,
-                          crypto_passphrase=crypto_passphrase)
+                          crypto_passphrase=crypto_passphrase,
+                          crypto_params=crypto_params,
+                          mkfs_opts=mkfs_opts, mkfs_profile=mkfs_profile,
+                          subvolumes=subvolumes, mount_profile=mount_profile)
 
 
 class StorageInstaller(Installer):
@@ -124,13 +210,17 @@ class StorageInstaller(Installer):
         # To maintain uniqueness among unit ids
         self._units: dict[str, StorageUnit] = {}
         self._bind_mounts = ('dev', 'proc', 'sys')
+        self._raid_sync_stop: Optional[threading.Event] = None
+        self._raid_sync_thread: Optional[threading.Thread] = None
 
         self._smanager = StorageManager()
         self._smanager.mount_root_base = self.target_root
+        self._parse_raid_resync_speed_limit()
         self._has_disks = self._parse_disks()
         self._has_crypto = self._parse_crypto_volumes()
         self._has_raids = self._parse_raids()
         self._has_lvm = self._parse_volume_groups()
+        self._parse_tmp_on_tmpfs()
         self._validate()
 
         if self._has_raids:
@@ -139,6 +229,10 @@ class StorageInstaller(Installer):
             self.add_package('cryptsetup', 'cryptsetup-openrc')
         if self._has_lvm:
             self.add_package('lvm2')
+            # Required by thin pools and dm-cache
+            if any(vg.uses_thin_provisioning_tools
+                   for vg in self._smanager.get_devices_by_type(VolumeGroup)):
+                self.add_package('thin-provisioning-tools')
 
         self._file_systems = set()
         for unit in self._units.values():
@@ -147,7 +241,9 @@ class StorageInstaller(Installer):
 
         fs_to_pkg = {FSType.EXT4: 'e2fsprogs',
                      FSType.XFS: 'xfsprogs',
-                     FSType.VFAT: 'dosfstools'}
+                     FSType.VFAT: 'dosfstools',
+                     FSType.BTRFS: 'btrfs-progs',
+                     FSType.F2FS: 'f2fs-tools'}
         for fs in self._file_systems:
             pkg = fs_to_pkg.get(fs, None)
             if pkg is not None:
@@ -167,7 +263,13 @@ class StorageInstaller(Installer):
     def _validate(self):
         if self._smanager.get_unit_by_mount_point('/') is None:
             raise ValueError('No / mount point defined')
-        # Probably here will be more checks
+
+        boot_unit = self._smanager.get_unit_by_mount_point('/boot') or \
+            self._smanager.get_unit_by_mount_point('/')
+        if (boot_unit.fs_type == FSType.F2FS) and \
+                any(o.startswith('compress_') for o in boot_unit.fs_opts):
+            raise ValueError('GRUB cannot read /boot from a compressed f2fs, '
+                             'put /boot on a separate partition')
 
     def _parse_disks(self) -> bool:
         yaml_key = 'disks'
@@ -176,11 +278,18 @@ class StorageInstaller(Installer):
                               error_label=error_label)
         disk_created = False
         for i, disk_item in enumerate(disk_list):
-            error_label = f'{error_label}/{i}'
+            error_label = f'{self._yaml_tag}/{yaml_key}/{i}'
             disk = self._smanager.add_disk(id=read_key_or_fail(disk_item, 'id', str,
                                                                error_label=f'{error_label}/id'))
             disk_created = True
 
+            wipe = read_key_or_fail(disk_item, 'wipe', str, error_label=f'{error_label}/wipe')
+            if wipe:
+                try:
+                    disk.wipe_method = WipeMethod.from_str(wipe)
+                except ValueError as exc:
+                    raise ValueError(f'{error_label}/wipe: {exc}') from None
+
             part_key = 'partitions'
             part_list = read_list(disk_item, key=part_key, item_type=dict,
                                   error_label=f'{error_label}/{part_key}')
@@ -189,7 +298,12 @@ class StorageInstaller(Installer):
                 unit = disk.add_partition(id=params.id, size=params.size,
                                           fs_type=params.fs_type, fs_opts=params.fs_opts,
                                           mount_point=params.mount_point, flags=params.flags,
-                                          crypto_passphrase=params.crypto_passphrase)
+                                          crypto_passphrase=params.crypto_passphrase,
+                                          crypto_params=params.crypto_params,
+                                          mkfs_opts=params.mkfs_opts,
+                                          mkfs_profile=params.mkfs_profile,
+                                          subvolumes=params.subvolumes,
+                                          mount_profile=params.mount_profile)
                 self._add_unit(unit)
         return disk_created
 
@@ -203,12 +317,27 @@ class StorageInstaller(Installer):
                               error_label=error_label)
         raid_created = False
         for i, raid_item in enumerate(raid_list):
-            error_label = f'{error_label}/{i}'
+            error_label = f'{self._yaml_tag}/{yaml_key}/{i}'
             raid_id = read_key_or_fail(raid_item, 'id', str, error_label=f'{error_label}/id')
+            if 'level' not in raid_item:
+                raise ValueError(f"'{error_label}/level' is not set")
             level = read_key_or_fail(raid_item, 'level', int, error_label=f'{error_label}/level')
+            if level == 0:
+                # RAID0 has no redundancy to resync or track
+                for key in ('assume_clean', 'bitmap'):
+                    if key in raid_item:
+                        raise ValueError(f"'{error_label}/{key}' is not applicable to RAID0")
             metadata = read_key_or_fail(raid_item, 'metadata', str, error_label=f'{error_label}/metadata')
             if not metadata:
                 metadata = '1.2'
+            assume_clean = read_key_or_fail(raid_item, 'assume_clean', bool,
+                                            error_label=f'{error_label}/assume_clean')
+            bitmap = read_key_or_fail(raid_item, 'bitmap', str, error_label=f'{error_label}/bitmap')
+            if not bitmap:
+                bitmap = None
+            chunk_size = raid_item.get('chunk_size', None)
+            if chunk_size is not None:
+                chunk_size = str_size_to_bytes(str(chunk_size))
 
             members_key = 'members'
             members_list = read_list(raid_item, key=members_key, item_type=str,
@@ -219,7 +348,9 @@ class StorageInstaller(Installer):
                 members.append(part)
 
             raid = self._smanager.add_raid(id=os.path.join('/dev/md', raid_id),
-                                           level=level, members=members, metadata=metadata)
+                                           level=level, members=members, metadata=metadata,
+                                           assume_clean=assume_clean, bitmap=bitmap,
+                                           chunk_size=chunk_size)
             raid_created = True
 
             part_key = 'partitions'
@@ -230,11 +361,43 @@ class StorageInstaller(Installer):
                 unit = raid.add_partition(id=params.id, size=params.size,
                                           fs_type=params.fs_type, fs_opts=params.fs_opts,
                                           mount_point=params.mount_point, flags=params.flags,
-                                          crypto_passphrase=params.crypto_passphrase)
+                                          crypto_passphrase=params.crypto_passphrase,
+                                          crypto_params=params.crypto_params,
+                                          mkfs_opts=params.mkfs_opts,
+                                          mkfs_profile=params.mkfs_profile,
+                                          subvolumes=params.subvolumes,
+                                          mount_profile=params.mount_profile)
                 self._add_unit(unit)
 
         return raid_created
 
+    def _parse_raid_resync_speed_limit(self):
+        yaml_key = 'raid_resync_speed_limit'
+        if yaml_key not in self._data:
+            return
+        limit = read_key_or_fail(self._data, yaml_key, int,
+                                 error_label=f'{self._yaml_tag}/{yaml_key}')
+        self._smanager.raid_resync_speed_limit = limit
+
+    def _parse_tmp_on_tmpfs(self):
+        tmp_on_tmpfs = read_key_or_fail(self._data, 'tmp_on_tmpfs', bool,
+                                        error_label=f'{self._yaml_tag}/tmp_on_tmpfs')
+        tmp_size = self._data.get('tmp_size', None)
+        if not tmp_on_tmpfs:
+            if tmp_size is not None:
+                raise ValueError(f"'{self._yaml_tag}/tmp_size' is set without 'tmp_on_tmpfs'")
+            return
+
+        self._smanager.tmp_on_tmpfs = True
+        if tmp_size is not None:
+            tmp_size = str(tmp_size).strip()
+            if not tmp_size.endswith('%'):
+                try:
+                    tmp_size = str(str_size_to_bytes(tmp_size))
+                except ValueError as exc:
+                    raise ValueError(f'{self._yaml_tag}/tmp_size: {exc}') from None
+            self._smanager.tmp_size = tmp_size
+
     def _parse_crypto_volumes(self) -> bool:
         yaml_key = 'crypto_volumes'
         if yaml_key not in self._data:
@@ -252,7 +415,11 @@ class StorageInstaller(Installer):
             part = cast(Partition, self._unit_by_id(part_id))
             unit = self._smanager.cryptsetup.add_volume(id=params.id, partition=part,
                                                         fs_type=params.fs_type, fs_opts=params.fs_opts,
-                                                        mount_point=params.mount_point)
+                                                        mount_point=params.mount_point,
+                                                        mkfs_opts=params.mkfs_opts,
+                                                        mkfs_profile=params.mkfs_profile,
+                                                        subvolumes=params.subvolumes,
+                                                        mount_profile=params.mount_profile)
             self._add_unit(unit)
             volume_created = True
 
@@ -268,7 +435,7 @@ class StorageInstaller(Installer):
                             error_label=error_label)
         vg_created = False
         for i, vg_item in enumerate(vg_list):
-            error_label = f'{error_label}/{i}'
+            error_label = f'{self._yaml_tag}/{yaml_key}/{i}'
             vg_id = read_key_or_fail(vg_item, 'id', str, error_label=f'{error_label}/id')
 
             pv_key = 'physical_volumes'
@@ -285,21 +452,117 @@ class StorageInstaller(Installer):
             lv_key = 'logical_volumes'
             lv_list = read_list(data=vg_item, key=lv_key, item_type=dict,
                                 error_label=f'{error_label}/{lv_key}')
-            for lv_item in lv_list:
+            for j, lv_item in enumerate(lv_list):
+                lv_label = f'{error_label}/{lv_key}/{j}'
                 params = UnitParams.from_dict(lv_item)
+
+                stripes = None
+                if 'stripes' in lv_item:
+                    stripes = read_key_or_fail(lv_item, 'stripes', int, error_label=f'{lv_label}/stripes')
+                    if isinstance(stripes, bool) or (stripes < 1):
+                        raise ValueError(f"'{lv_label}/stripes' must be a positive integer")
+                stripe_size = lv_item.get('stripe_size', None)
+                if stripe_size is not None:
+                    stripe_size = str_size_to_bytes(str(stripe_size))
+                thin_pool = read_key_or_fail(lv_item, 'thin_pool', bool,
+                                             error_label=f'{lv_label}/thin_pool')
+                pool = read_key_or_fail(lv_item, 'pool', str, error_label=f'{lv_label}/pool')
+
+                cache = None
+                cache_item = read_key_or_fail(lv_item, 'cache', dict, error_label=f'{lv_label}/cache')
+                if cache_item:
+                    cache_pv_id = read_key_or_fail(cache_item, 'physical_volume', str,
+                                                   error_label=f'{lv_label}/cache/physical_volume')
+                    cache_size = cache_item.get('size', None)
+                    if cache_size is None:
+                        raise ValueError(f"'{lv_label}/cache/size' is not set")
+                    try:
+                        cache = LVCache(mode=cache_item.get('mode', 'writethrough'),
+                                        size=str_size_to_bytes(str(cache_size)),
+                                        physical_volume=self._unit_by_id(cache_pv_id))
+                    except (TypeError, ValueError) as exc:
+                        raise ValueError(f"Error in parsing '{lv_label}/cache': {exc}") from None
+
                 unit = vg.add_lv(id=params.id, size=params.size,
                                  fs_type=params.fs_type, fs_opts=params.fs_opts,
-                                 mount_point=params.mount_point)
+                                 mount_point=params.mount_point,
+                                 mkfs_opts=params.mkfs_opts,
+                                 mkfs_profile=params.mkfs_profile,
+                                 stripes=stripes, stripe_size=stripe_size,
+                                 thin_pool=thin_pool, pool=pool or None, cache=cache,
+                                 subvolumes=params.subvolumes,
+                                 mount_profile=params.mount_profile)
                 self._add_unit(unit)
 
         return vg_created
 
+    @property
+    def smanager(self) -> StorageManager:
+        return self._smanager
+
     @property
     def efi_mount_point(self) -> Optional[str]:
         for unit in self._smanager.storage_units:
             if StorageUnitFlag.ESP in unit.flags:
                 return unit.mount_point
 
+    @property
+    def dracut_modules(self) -> list[str]:
+        """dracut modules required to assemble the storage stack on boot"""
+        res = []
+        if self._has_crypto:
+            res.append('crypt')
+        if self._has_raids:
+            res.append('mdraid')
+        if self._has_lvm:
+            res.append('lvm')
+        return res
+
+    @property
+    def swap_priorities(self) -> list[int]:
+        """Explicit priorities ('pri=N' in fs_opts) of swap units"""
+        res = []
+        for unit in self._units.values():
+            if unit.fs_type != FSType.SWAP:
+                continue
+            for opt in unit.fs_opts:
+                if opt.startswith('pri='):
+                    try:
+                        res.append(int(opt[len('pri='):]))
+                    except ValueError:
+                        raise ValueError("Invalid swap priority '{}' of '{}'".format(opt, unit.id)) from None
+        return res
+
+    def _report_raid_sync(self) -> bool:
+        """Returns whether any RAID is still syncing"""
+        statuses = self._smanager.raid_sync_statuses()
+        for raid_id, status in statuses.items():
+            self._event_receiver.start_event('RAID {}: {}'.format(raid_id, status))
+        return bool(statuses)
+
+    def _start_raid_sync_reports(self):
+        """Reports the resync progress periodically, while the other installers run"""
+        self._raid_sync_stop = threading.Event()
+
+        def report():
+            while not self._raid_sync_stop.wait(RAID_SYNC_REPORT_INTERVAL):
+                try:
+                    if not self._report_raid_sync():
+                        return
+                except OSError as exc:
+                    self._event_receiver.add_log_line('Unable to read the RAID sync status: {}'.format(exc))
+                    return
+
+        self._raid_sync_thread = threading.Thread(target=report, name='raid-sync-reports', daemon=True)
+        self._raid_sync_thread.start()
+
+    def stop_raid_sync_reports(self):
+        if self._raid_sync_thread is None:
+            return
+        self._raid_sync_stop.set()
+        self._raid_sync_thread.join()
+        self._raid_sync_thread = None
+
     def apply(self):
         self._event_receiver.start_event('Creating and mounting file systems')
         # busybox's mount fails if no fs-related module is loaded
@@ -308,6 +571,8 @@ class StorageInstaller(Installer):
                     event_receiver=self._event_receiver)
 
         self._smanager.create_filesystems()
+        for msg in self._smanager.alignment_warnings():
+            self._event_receiver.start_event(msg)
         self._smanager.mount()
 
         for mount in self._bind_mounts:
@@ -316,6 +581,9 @@ class StorageInstaller(Installer):
             os.makedirs(dst)
             run_cmd(args=['mount', '-o', 'bind', src, dst], event_receiver=self._event_receiver)
 
+        if self._has_raids and self._report_raid_sync():
+            self._start_raid_sync_reports()
+
     def post_apply(self):
         self._event_receiver.start_event('Updating storage configuration')
 
@@ -334,10 +602,31 @@ class StorageInstaller(Installer):
         if self._has_lvm:
             self.enable_service(service='lvm', runlevel='boot')
 
+        self._write_dracut_conf()
+
+    def _write_dracut_conf(self):
+        # dracut includes only the modules of the host's file systems,
+        # and the host is the installation environment here
+        file_systems = sorted(str(fs) for fs in self._file_systems
+                              if fs in (FSType.BTRFS, FSType.F2FS))
+        if not file_systems:
+            return
+        lines = ['filesystems+=" {} "\n'.format(' '.join(file_systems))]
+        if FSType.BTRFS in self._file_systems:
+            # Scans for all devices of a multi-device btrfs
+            lines.append('add_dracutmodules+=" btrfs "\n')
+        conf_dir = self.abs_target_path('/etc/dracut.conf.d')
+        os.makedirs(conf_dir, exist_ok=True)
+        write_file(os.path.join(conf_dir, 'storage.conf'), 'w', data=''.join(lines))
+
     def cleanup(self):
         self._event_receiver.start_event('Unmounting file systems')
         for mount in self._bind_mounts:
-            run_cmd(args=['umount', self.abs_target_path(mount)],
-                    event_receiver=self._event_receiver)
+            self._event_receiver.add_log_line('Unmounting {}'.format(self.abs_target_path(mount)))
+            umount_fs_with_retries(self.abs_target_path(mount))
         self._smanager.unmount()
+        if self._has_raids:
+            self.stop_raid_sync_reports()
+            # An interrupted resync continues on the next boot
+            self._report_raid_sync()
         self._smanager.deactivate_block_devices()
@@ -1,10 +1,9 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
-import datetime
-
 from alpaquita_installer.common.utils import write_file
 from alpaquita_installer.models.user import UserModel
+from .accounts import AccountsDB
 from .installer import Installer, InstallerException
 from .utils import read_list
 
@@ -20,6 +19,12 @@ from .utils import read_list
 #   - name: admin
 #     password: <password hash>
 #     is_admin: true
+#     shell: /bin/bash # optional, /bin/sh by default
+#     uid: 1500 # optional
+#     home: /srv/admin # optional, /home/<name> by default
+#     groups: [ 'audio', 'video' ] # optional, created if missing
+#     ssh_authorized_keys: # optional
+#       - ssh-ed25519 AAAA... admin@example.com
 #
 
 
@@ -28,9 +33,11 @@ def read_user_from_dict(data: dict) -> UserModel:
     password_hash = data.get('password', None)
     gecos = data.get('gecos', None)
     is_admin = data.get('is_admin', False)
+    optional = {key: data[key] for key in ('shell', 'uid', 'home', 'groups', 'ssh_authorized_keys')
+                if key in data}
 
     user = UserModel(name=name, gecos=gecos, is_admin=is_admin,
-                     password=password_hash)
+                     password=password_hash, **optional)
 
     # As it's a separator in /etc/shadow
     if ':' in user.password:
@@ -39,31 +46,6 @@ def read_user_from_dict(data: dict) -> UserModel:
     return user
 
 
-def update_user_hash(etc_shadow: str, user: str, password_hash: str):
-    with open(etc_shadow, 'r') as file:
-        lines = file.readlines()
-
-    found_user = False
-    for i, line in enumerate(lines):
-        tokens = line.split(':')
-        if tokens[0] != user:
-            continue
-
-        # Encrypted password
-        tokens[1] = password_hash
-        # Date of last password change (number of days since the Unix epoch)
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
-        epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
-        tokens[2] = str((now - epoch).days)
-        lines[i] = ':'.join(tokens)
-        found_user = True
-
-    if not found_user:
-        raise RuntimeError("No user '{}' found in '{}'".format(user, etc_shadow))
-
-    write_file(etc_shadow, 'w', data=''.join(lines))
-
-
 class UsersInstaller(Installer):
     def __init__(self, target_root: str, config: dict, event_receiver):
         yaml_tag = 'users'
@@ -83,6 +65,11 @@ class UsersInstaller(Installer):
                 raise InstallerException('No root user must be defined')
             self._users.append(user)
 
+        for key in ('name', 'uid'):
+            values = [getattr(u, key) for u in self._users if getattr(u, key) is not None]
+            if len(set(values)) != len(values):
+                raise InstallerException("Duplicate '{}' in '{}'".format(key, yaml_tag))
+
         # It would be strange to have a system without sudo
         self.add_package('sudo')
 
@@ -90,29 +77,30 @@ class UsersInstaller(Installer):
         write_file(self.abs_target_path('/etc/sudoers.d/00-wheel'), 'w',
                    data='%wheel ALL=(ALL) ALL\n')
 
-        etc_shadow = self.abs_target_path('/etc/shadow')
+        accounts = AccountsDB(self.abs_target_path('/etc'))
 
         # Disable the root user
-        update_user_hash(etc_shadow=etc_shadow, user='root',
-                         password_hash='!')
+        accounts.set_password('root', '!')
 
-        if not self._users:
-            return
-
-        self._event_receiver.start_event('Adding users')
+        if self._users:
+            self._event_receiver.start_event('Adding users')
 
         for user in self._users:
-            args = ['adduser', '-D']
-            if user.gecos:
-                args.extend(['-g', user.gecos])
-            # don't let host's $SHELL affect the shell choice
-            # TODO: provide ui and yaml key for this
-            args.extend(['-s', '/bin/sh'])
-            args.append(user.name)
-            self.run_in_chroot(args=args)
-
-            update_user_hash(etc_shadow=etc_shadow, user=user.name,
-                             password_hash=user.password)
-
-            if user.is_admin:
-                self.run_in_chroot(args=['addgroup', user.name, 'wheel'])
+            # The shell is always set, so that host's $SHELL doesn't affect it
+            accounts.add_user(user.name, gecos=user.gecos or '', shell=user.shell,
+                              home=user.home, uid=user.uid)
+            accounts.set_password(user.name, user.password)
+            groups = list(user.groups)
+            if user.is_admin and ('wheel' not in groups):
+                groups.append('wheel')
+            for group in groups:
+                if not accounts.has_group(group):
+                    accounts.add_group(group)
+                accounts.add_to_group(user.name, group)
+
+        # Written once for all users
+        accounts.save()
+        for user in self._users:
+            accounts.create_home(user.name, skel=self.abs_target_path('/etc/skel'))
+            if user.ssh_authorized_keys:
+                accounts.write_authorized_keys(user.name, user.ssh_authorized_keys)
@@ -0,0 +1,114 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import re
+from typing import Iterable, Optional
+
+from alpaquita_installer.common.utils import write_file
+from .installer import Installer
+from .utils import read_key_or_fail, str_size_to_bytes
+
+# Optional
+#
+# zram:
+#   size: 50% # optional, of RAM or an absolute size like 2G
+#   algorithm: zstd # optional
+#   priority: 100 # optional, must be higher than priorities of disk swap
+
+ALGORITHMS = ('lzo', 'lzo-rle', 'lz4', 'lz4hc', 'zstd', '842', 'deflate')
+DEFAULT_SIZE = '50%'
+DEFAULT_ALGORITHM = 'zstd'
+# Disk swap without an explicit priority gets a negative one from the kernel
+DEFAULT_PRIORITY = 100
+# The maximum swap priority
+MAX_PRIORITY = 32767
+# zram stores pages compressed, so it may exceed RAM
+MAX_RAM_PERCENT = 200
+
+
+class ZramInstaller(Installer):
+    def __init__(self, target_root: str, config: dict, event_receiver,
+                 disk_swap_priorities: Iterable[int] = ()):
+        yaml_tag = 'zram'
+        super().__init__(name=yaml_tag, config=config,
+                         event_receiver=event_receiver,
+                         data_type=dict, data_is_optional=True,
+                         target_root=target_root)
+
+        self._enabled = self._data is not None
+        if not self._enabled:
+            return
+
+        size = str(self._data.get('size', DEFAULT_SIZE))
+        # The percentage of RAM is kept as is and evaluated on boot
+        self._ram_percent: Optional[int] = None
+        self._size_mb: Optional[int] = None
+        m = re.match(r'^([0-9]+)%$', size)
+        if m:
+            self._ram_percent = int(m.group(1))
+            if not (0 < self._ram_percent <= MAX_RAM_PERCENT):
+                raise ValueError(f"'{yaml_tag}/size' must be between 1% and {MAX_RAM_PERCENT}% of RAM")
+        else:
+            try:
+                size_in_bytes = str_size_to_bytes(size)
+            except ValueError as exc:
+                raise ValueError(f'{yaml_tag}/size: {exc}') from None
+            self._size_mb = size_in_bytes // (1024 * 1024)
+            if not self._size_mb:
+                raise ValueError('zram size {} is less than 1M'.format(size_in_bytes))
+
+        self._algorithm = read_key_or_fail(self._data, 'algorithm', str,
+                                           error_label=f'{yaml_tag}/algorithm')
+        if not self._algorithm:
+            self._algorithm = DEFAULT_ALGORITHM
+        if self._algorithm not in ALGORITHMS:
+            raise ValueError("Unknown zram compression algorithm '{}', supported: {}".format(
+                self._algorithm, ', '.join(ALGORITHMS)))
+
+        disk_swap_priorities = list(disk_swap_priorities)
+        max_disk_priority = max(disk_swap_priorities, default=-1)
+        if 'priority' in self._data:
+            self._priority = read_key_or_fail(self._data, 'priority', int,
+                                              error_label=f'{yaml_tag}/priority')
+            if self._priority <= max_disk_priority:
+                raise ValueError('zram swap priority {} must be higher than priority {} of disk swap'.format(
+                    self._priority, max_disk_priority))
+        else:
+            self._priority = max(DEFAULT_PRIORITY, max_disk_priority + 1)
+        if self._priority > MAX_PRIORITY:
+            raise ValueError(f"'{yaml_tag}/priority' must not exceed {MAX_PRIORITY}")
+
+        self.add_package('zram-init')
+
+    def _size_expr(self) -> str:
+        if self._size_mb is not None:
+            return str(self._size_mb)
+        # conf.d files are sourced by the shell, so the size follows the RAM of the machine
+        return "$(( $(awk '/^MemTotal:/ {{ print $2 }}' /proc/meminfo) * {} / 100 / 1024 ))".format(
+            self._ram_percent)
+
+    def conf_data(self) -> str:
+        return ''.join([
+            'load_on_start=yes\n',
+            'unload_on_stop=yes\n',
+            'num_devices=1\n',
+            '\n',
+            'type0=swap\n',
+            # The swap priority for swap devices
+            'flag0={}\n'.format(self._priority),
+            'size0={}\n'.format(self._size_expr()),
+            'maxs0=1\n',
+            'algo0={}\n'.format(self._algorithm),
+            'labl0=zram_swap\n',
+        ])
+
+    def apply(self):
+        pass
+
+    def post_apply(self):
+        if not self._enabled:
+            return
+
+        self._event_receiver.start_event('Configuring zram swap')
+        write_file(self.abs_target_path('/etc/conf.d/zram-init'), 'w', data=self.conf_data())
+        self.enable_service('zram-init', runlevel='boot')
@@ -1,12 +1,19 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
-from attrs import define, field, validators
+from typing import Optional
+import os
+
+from attrs import Factory, define, field, validators
 
 # From 'man 8 useradd' in Ubuntu
 USERNAME_REGEX = r'^[a-z_][a-z0-9_-]*[$]?$'
 USERNAME_MAX_LEN = 32
 GECOS_INVALID_CHARACTERS = (':',)
+GROUP_NAME_REGEX = USERNAME_REGEX
+DEFAULT_SHELL = '/bin/sh'
+# 65534 is nobody
+MAX_UID = 65533
 
 
 def _password_not_empty(instance, attribute, value):
@@ -20,6 +27,26 @@ def validate_gecos(instance, attribute, value):
             list(GECOS_INVALID_CHARACTERS)))
 
 
+def validate_path(instance, attribute, value):
+    if (value is not None) and ((not os.path.isabs(value)) or (':' in value) or ('\n' in value)):
+        raise ValueError("'{}' must be an absolute path without ':'".format(attribute.name))
+    # The path is used relative to the target root, '..' would lead out of it
+    if (value is not None) and ((os.path.normpath(value) != value) or ('..' in value.split('/'))):
+        raise ValueError("'{}' must be a normalized path without '..'".format(attribute.name))
+
+
+def validate_uid(instance, attribute, value):
+    if isinstance(value, bool):
+        raise ValueError("'{}' must be an integer".format(attribute.name))
+    if (value is not None) and not (0 < value <= MAX_UID):
+        raise ValueError("'{}' must be between 1 and {}".format(attribute.name, MAX_UID))
+
+
+def validate_ssh_key(instance, attribute, value):
+    if (not value.strip()) or ('\n' in value):
+        raise ValueError('SSH authorized keys must be single non-empty lines')
+
+
 @define
 class UserModel:
     gecos: str = field(validator=validators.optional([validators.instance_of(str),
@@ -30,3 +57,20 @@ class UserModel:
     is_admin: bool = field(validator=validators.instance_of(bool))
     password: str = field(validator=[validators.instance_of(str),
                                      _password_not_empty])
+    shell: str = field(default=DEFAULT_SHELL, kw_only=True,
+                       validator=[validators.instance_of(str), validate_path])
+    uid: Optional[int] = field(default=None, kw_only=True,
+                               validator=validators.optional([validators.instance_of(int), validate_uid]))
+    home: Optional[str] = field(default=None, kw_only=True,
+                                validator=validators.optional([validators.instance_of(str), validate_path]))
+    groups: list[str] = field(default=Factory(list), kw_only=True,
+                              validator=validators.deep_iterable(
+                                  member_validator=[validators.instance_of(str),
+                                                    validators.max_len(USERNAME_MAX_LEN),
+                                                    validators.matches_re(GROUP_NAME_REGEX)],
+                                  iterable_validator=validators.instance_of(list)))
+    ssh_authorized_keys: list[str] = field(default=Factory(list), kw_only=True,
+                                           validator=validators.deep_iterable(
+                                               member_validator=[validators.instance_of(str),
+                                                                 validate_ssh_key],
+                                               iterable_validator=validators.instance_of(list)))
@@ -5,7 +5,7 @@ from typing import Optional, Iterable, Collection, cast
 import os
 import logging
 
-from .file_system import FSType
+from .file_system import FSType, MkfsProfile, MountProfile, Subvolume
 from .storage_unit import Partition, CryptoVolume
 from .storage_device import StorageDevice
 
@@ -27,7 +27,11 @@ class Cryptsetup(StorageDevice):
     def add_volume(self, id: str, partition: Partition,
                    fs_type: Optional[FSType] = None,
                    fs_opts: Optional[Iterable[str]] = None,
-                   mount_point: Optional[str] = None) -> CryptoVolume:
+                   mount_point: Optional[str] = None,
+                   mkfs_opts: Optional[Iterable[str]] = None,
+                   mkfs_profile: Optional[MkfsProfile] = None,
+                   subvolumes: Optional[Iterable[Subvolume]] = None,
+                   mount_profile: Optional[MountProfile] = None) -> CryptoVolume:
 
         if not isinstance(partition, Partition):
             raise ValueError('{}: must be a partition'.format(partition))
@@ -45,10 +49,13 @@ class Cryptsetup(StorageDevice):
             opts = set(fs_opts)
         volume = CryptoVolume(id=id, size=partition.size, fs_type=fs_type, fs_opts=opts,
                               mount_point=mount_point, storage_device=self,
-                              partition=partition)
+                              partition=partition, mkfs_opts=list(mkfs_opts or []),
+                              mkfs_profile=mkfs_profile, subvolumes=list(subvolumes or []),
+                              mount_profile=mount_profile)
         volume.block_device = block_device
 
         self._add_storage_unit(volume)
+        self.manager.link_devices(parent=partition.storage_device, child=self)
         log.debug('{}: added {}'.format(self, volume))
         return volume
 
@@ -56,6 +63,8 @@ class Cryptsetup(StorageDevice):
         log.debug('{}: opening volumes'.format(self))
         for volume in self.volumes:
             volume.open()
+        for volume in self.volumes:
+            volume.partition.forget_volume_key()
 
     def close_volumes(self):
         for volume in self.volumes:
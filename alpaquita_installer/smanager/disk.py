@@ -3,9 +3,11 @@
 
 from __future__ import annotations
 from typing import TYPE_CHECKING
+from functools import cached_property
 import os
 
 from .storage_device import StorageDeviceWithPartitions
+from .planner import DiskProperties, read_disk_properties
 from .utils import get_block_device_size
 
 if TYPE_CHECKING:
@@ -26,3 +28,15 @@ class Disk(StorageDeviceWithPartitions):
 
     def __str__(self) -> str:
         return 'Disk ({})'.format(self.id)
+
+    @cached_property
+    def properties(self) -> DiskProperties:
+        return read_disk_properties(os.path.basename(os.path.realpath(self.id)))
+
+    @property
+    def rotational(self) -> bool:
+        return self.properties.rotational
+
+    @property
+    def supports_discard(self) -> bool:
+        return self.properties.discard
@@ -2,8 +2,11 @@
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
 from __future__ import annotations
+from typing import Iterable, Optional
 import enum
 
+import attrs
+
 
 class FSType(enum.Enum):
     RAID_MEMBER = 1
@@ -13,6 +16,8 @@ class FSType(enum.Enum):
     XFS = 5
     VFAT = 6
     CRYPTO_PARTITION = 7
+    BTRFS = 8
+    F2FS = 9
 
     @classmethod
     def from_str(cls, value: str) -> FSType:
@@ -23,3 +28,161 @@ class FSType(enum.Enum):
 
     def __str__(self) -> str:
         return self.name.lower()
+
+
+class MkfsProfile(enum.Enum):
+    # Defer inode table and journal initialisation, skip discard
+    FAST_CREATE = 1
+    # Few large files, larger journal
+    DATABASE = 2
+    # More inodes
+    MANY_SMALL_FILES = 3
+
+    @classmethod
+    def from_str(cls, value: str) -> MkfsProfile:
+        ret = getattr(cls, value.strip().upper().replace('-', '_'), None)
+        if ret is None:
+            raise ValueError('Unknown mkfs profile: {}'.format(value))
+        return ret
+
+    def __str__(self) -> str:
+        return self.name.lower().replace('_', '-')
+
+
+# Profile arguments and ext4 extended options. The latter are kept separately,
+# as mkfs.ext4 takes into account only the last -E argument.
+MKFS_PROFILES: dict[tuple[MkfsProfile, FSType], tuple[list[str], list[str]]] = {
+    (MkfsProfile.FAST_CREATE, FSType.EXT4): ([], ['lazy_itable_init=1', 'lazy_journal_init=1', 'nodiscard']),
+    (MkfsProfile.FAST_CREATE, FSType.XFS): (['-K'], []),
+    (MkfsProfile.DATABASE, FSType.EXT4): (['-i', '65536', '-J', 'size=256'], []),
+    (MkfsProfile.DATABASE, FSType.XFS): (['-l', 'size=128m'], []),
+    (MkfsProfile.MANY_SMALL_FILES, FSType.EXT4): (['-i', '4096'], []),
+    (MkfsProfile.MANY_SMALL_FILES, FSType.XFS): (['-i', 'maxpct=50'], []),
+}
+
+
+class MountProfile(enum.Enum):
+    # Access times are updated in memory and written out lazily
+    GENERAL = 1
+    # No access times, larger log buffers and less frequent commits
+    THROUGHPUT = 2
+
+    @classmethod
+    def from_str(cls, value: str) -> MountProfile:
+        ret = getattr(cls, value.strip().upper().replace('-', '_'), None)
+        if ret is None:
+            raise ValueError('Unknown mount profile: {}'.format(value))
+        return ret
+
+    def __str__(self) -> str:
+        return self.name.lower().replace('_', '-')
+
+
+MOUNT_PROFILES: dict[tuple[MountProfile, FSType], list[str]] = {
+    (MountProfile.GENERAL, FSType.EXT4): ['lazytime'],
+    (MountProfile.GENERAL, FSType.XFS): ['lazytime'],
+    (MountProfile.GENERAL, FSType.BTRFS): ['lazytime'],
+    (MountProfile.GENERAL, FSType.F2FS): ['lazytime'],
+    (MountProfile.THROUGHPUT, FSType.EXT4): ['noatime', 'lazytime', 'commit=60'],
+    (MountProfile.THROUGHPUT, FSType.XFS): ['noatime', 'lazytime', 'logbsize=256k', 'inode64'],
+    (MountProfile.THROUGHPUT, FSType.BTRFS): ['noatime', 'lazytime', 'commit=60'],
+    (MountProfile.THROUGHPUT, FSType.F2FS): ['noatime', 'lazytime'],
+}
+
+# Added by any profile on non-rotational devices supporting discard.
+# Synchronous online discard of ext4 and xfs slows down deletes,
+# the periodic fstrim suits them better.
+MOUNT_PROFILE_SSD_OPTS: dict[FSType, list[str]] = {
+    FSType.BTRFS: ['ssd', 'discard=async'],
+}
+
+# Options that only some file systems accept, by the full option or its name
+FS_SPECIFIC_MOUNT_OPTS: dict[str, tuple[FSType, ...]] = {
+    'discard=async': (FSType.BTRFS,),
+    'ssd': (FSType.BTRFS,),
+    'autodefrag': (FSType.BTRFS,),
+    'compress': (FSType.BTRFS,),
+    'compress-force': (FSType.BTRFS,),
+    'subvol': (FSType.BTRFS,),
+    'commit': (FSType.EXT4, FSType.BTRFS),
+    'data': (FSType.EXT4,),
+    'journal_async_commit': (FSType.EXT4,),
+    'logbsize': (FSType.XFS,),
+    'logbufs': (FSType.XFS,),
+    'inode64': (FSType.XFS,),
+    'allocsize': (FSType.XFS,),
+    'compress_algorithm': (FSType.F2FS,),
+    'compress_extension': (FSType.F2FS,),
+    'umask': (FSType.VFAT,),
+}
+
+# Mutually exclusive options replacing each other
+_MOUNT_OPT_GROUPS = {
+    'atime': 'atime', 'noatime': 'atime', 'relatime': 'atime', 'strictatime': 'atime',
+    'lazytime': 'lazytime', 'nolazytime': 'lazytime',
+}
+
+
+def _mount_opt_key(opt: str) -> str:
+    name = opt.split('=', 1)[0]
+    return _MOUNT_OPT_GROUPS.get(name, name)
+
+
+def validate_mount_opts(fs_type: FSType, opts: Iterable[str]):
+    for opt in opts:
+        fs_types = FS_SPECIFIC_MOUNT_OPTS.get(opt, None) or \
+            FS_SPECIFIC_MOUNT_OPTS.get(opt.split('=', 1)[0], None)
+        if fs_types and (fs_type not in fs_types):
+            raise ValueError("Mount option '{}' is not supported on {}".format(opt, fs_type))
+
+
+def profile_mount_opts(profile: MountProfile, fs_type: FSType, rotational: bool,
+                       supports_discard: bool) -> list[str]:
+    opts = list(MOUNT_PROFILES[(profile, fs_type)])
+    if (not rotational) and supports_discard:
+        opts.extend(MOUNT_PROFILE_SSD_OPTS.get(fs_type, []))
+    return opts
+
+
+def merge_mount_opts(profile_opts: Iterable[str], opts: Iterable[str]) -> list[str]:
+    """Profile options followed by opts, which override profile options of the same kind"""
+    opts = list(opts)
+    keys = {_mount_opt_key(o) for o in opts}
+    return [o for o in profile_opts if _mount_opt_key(o) not in keys] + opts
+
+
+@attrs.define(frozen=True)
+class StripeGeometry:
+    # In bytes
+    chunk_size: int
+    # Number of disks holding data in a stripe
+    data_disks: int
+
+
+@attrs.define(frozen=True)
+class Subvolume:
+    """A btrfs subvolume, mounted with the options of its file system"""
+    name: str = attrs.field()
+    mount_point: Optional[str] = None
+
+    @name.validator
+    def check_name(self, attribute, value):
+        if (not value) or ('/' in value) or (value in ('.', '..')):
+            raise ValueError("Invalid subvolume name '{}'".format(value))
+
+
+# Options of the file system itself, as opposed to the generic ones like 'noauto'
+# or 'noatime'. They are passed to mount(2) during the installation, so that
+# the installed files get compressed too.
+MOUNT_DATA_OPTION_PREFIXES: dict[FSType, tuple[str, ...]] = {
+    FSType.BTRFS: ('compress', 'subvol'),
+    FSType.F2FS: ('compress_',),
+}
+
+
+def mount_data(fs_type: FSType, fs_opts: Iterable[str]) -> Optional[str]:
+    prefixes = MOUNT_DATA_OPTION_PREFIXES.get(fs_type, None)
+    if not prefixes:
+        return None
+    opts = sorted(o for o in fs_opts if o.startswith(prefixes))
+    return ','.join(opts) if opts else None
@@ -0,0 +1,99 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from __future__ import annotations
+from typing import Optional
+import os
+
+import attrs
+
+PBKDF_TYPES = ('argon2id', 'argon2i', 'pbkdf2')
+SECTOR_SIZES = (512, 1024, 2048, 4096)
+# The key size of the default aes-xts-plain64 cipher
+DEFAULT_KEY_SIZE = 512
+
+
+def _positive(instance, attribute, value):
+    if (value is not None) and (value <= 0):
+        raise ValueError("'{}' must be positive".format(attribute.name))
+
+
+_optional_str = attrs.validators.optional(attrs.validators.instance_of(str))
+_optional_int = attrs.validators.optional([attrs.validators.instance_of(int), _positive])
+
+
+@attrs.define(kw_only=True)
+class LUKSParams:
+    cipher: Optional[str] = attrs.field(default=None, validator=_optional_str)
+    # In bits
+    key_size: int = attrs.field(default=DEFAULT_KEY_SIZE, validator=[attrs.validators.instance_of(int),
+                                                                     _positive])
+    pbkdf: Optional[str] = attrs.field(default=None, validator=attrs.validators.optional(
+        attrs.validators.in_(PBKDF_TYPES)))
+    # In KiB, argon2 only
+    pbkdf_memory: Optional[int] = attrs.field(default=None, validator=_optional_int)
+    pbkdf_parallel: Optional[int] = attrs.field(default=None, validator=_optional_int)
+    # In milliseconds, cryptsetup benchmarks PBKDF to match it
+    iter_time: Optional[int] = attrs.field(default=None, validator=_optional_int)
+    # Skips the PBKDF benchmark
+    pbkdf_iterations: Optional[int] = attrs.field(default=None, validator=_optional_int)
+    sector_size: Optional[int] = attrs.field(default=None, validator=attrs.validators.optional(
+        attrs.validators.in_(SECTOR_SIZES)))
+
+    @key_size.validator
+    def check_key_size(self, attribute, value):
+        if value % 8:
+            raise ValueError("'key_size' must be a multiple of 8")
+
+    @pbkdf_iterations.validator
+    def check_pbkdf_iterations(self, attribute, value):
+        if (value is not None) and (self.iter_time is not None):
+            raise ValueError("'iter_time' and 'pbkdf_iterations' are mutually exclusive")
+
+    @staticmethod
+    def from_dict(data: dict) -> LUKSParams:
+        try:
+            return LUKSParams(**data)
+        except TypeError as exc:
+            raise ValueError(str(exc)) from None
+
+    def to_dict(self) -> dict:
+        return attrs.asdict(self, filter=lambda attr, value: value is not None)
+
+    def format_args(self) -> list[str]:
+        args = ['--key-size', str(self.key_size)]
+        for name, opt in (('cipher', '--cipher'),
+                          ('pbkdf', '--pbkdf'),
+                          ('pbkdf_memory', '--pbkdf-memory'),
+                          ('pbkdf_parallel', '--pbkdf-parallel'),
+                          ('iter_time', '--iter-time'),
+                          ('pbkdf_iterations', '--pbkdf-force-iterations'),
+                          ('sector_size', '--sector-size')):
+            value = getattr(self, name)
+            if value is not None:
+                args.extend([opt, str(value)])
+        return args
+
+
+class VolumeKey:
+    """A random LUKS volume key kept in an anonymous memory file.
+
+    Passing it to both 'cryptsetup luksFormat' and 'cryptsetup open' avoids
+    deriving the key from the passphrase on open.
+    """
+
+    def __init__(self, key_size: int):
+        self._fd: Optional[int] = os.memfd_create('luks-volume-key', os.MFD_CLOEXEC)
+        os.write(self._fd, os.urandom(key_size // 8))
+
+    @property
+    def path(self) -> str:
+        if self._fd is None:
+            raise RuntimeError('The volume key is already closed')
+        # cryptsetup opens the file by path, so the descriptor need not be inherited
+        return '/proc/{}/fd/{}'.format(os.getpid(), self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -3,14 +3,17 @@
 
 from __future__ import annotations
 from typing import TYPE_CHECKING, Optional, Iterable, Collection, cast
+from tempfile import NamedTemporaryFile
 import re
 import os
+import json
 import logging
 
+import attrs
+
 from .storage_unit import LogicalVolume, CryptoVolume
-from .storage_device import StorageDeviceOfLimitedSize
-from .file_system import FSType
-from .utils import get_block_device_size
+from .storage_device import StorageDevice, StorageDeviceOfLimitedSize
+from .file_system import FSType, MkfsProfile, MountProfile, StripeGeometry, Subvolume
 from alpaquita_installer.common.utils import run_cmd
 
 if TYPE_CHECKING:
@@ -19,6 +22,42 @@ if TYPE_CHECKING:
 
 log = logging.getLogger('smanager.lvm')
 
+MB = 1024 * 1024
+GB = 1024 * MB
+# The default physical extent size
+EXTENT_SIZE = 4 * MB
+DEFAULT_STRIPE_SIZE = 64 * 1024
+MIN_STRIPE_SIZE = 4 * 1024
+# writecache is dm-writecache, the rest are dm-cache modes
+CACHE_MODES = ('writethrough', 'writeback', 'writecache')
+
+
+def round_up(size: int, alignment: int) -> int:
+    return -(-size // alignment) * alignment
+
+
+def pool_metadata_size(data_size: int, min_size: int) -> int:
+    """Estimate the size of a thin or cache pool metadata volume.
+
+    lvm uses about 64 bytes per 64K chunk and keeps a spare copy
+    of the metadata volume (pmspare), which is not included here.
+    """
+    size = min(max(data_size // 1024, min_size), 16 * GB)
+    return round_up(size, EXTENT_SIZE)
+
+
+@attrs.define
+class LVCache:
+    mode: str = attrs.field(validator=attrs.validators.in_(CACHE_MODES))
+    # In bytes
+    size: int
+    # A fast physical volume of the same volume group
+    physical_volume: Partition | CryptoVolume
+
+    @property
+    def is_writecache(self) -> bool:
+        return self.mode == 'writecache'
+
 
 def contains_only_valid_lvm_chars(name: str) -> bool:
     if name in ('.', '..'):
@@ -51,6 +90,26 @@ def is_valid_lv_name(name: str) -> bool:
     return contains_only_valid_lvm_chars(name)
 
 
+def run_lvm_script(commands: Iterable[list[str]]):
+    """Run LVM commands in a single lvm process, so that devices
+    and metadata are scanned once. Execution stops on the first failed command."""
+    script = ''.join(' '.join(cmd) + '\n' for cmd in commands)
+    log.debug('Running lvm script:\n{}'.format(script))
+    with NamedTemporaryFile('w', prefix='lvm-', suffix='.sh') as file:
+        file.write(script)
+        file.flush()
+        run_cmd(args=['lvm', file.name])
+
+
+def parse_lv_sizes(data: bytes) -> dict[str, int]:
+    """Parse 'lvs --reportformat json --units b --nosuffix -o lv_name,lv_size'"""
+    res = {}
+    for report in json.loads(data)['report']:
+        for item in report.get('lv', []):
+            res[item['lv_name']] = int(item['lv_size'])
+    return res
+
+
 class VolumeGroup(StorageDeviceOfLimitedSize):
     def __init__(self, manager: StorageManager, id: str,
                  physical_volumes: Iterable[Partition | CryptoVolume]):
@@ -69,6 +128,9 @@ class VolumeGroup(StorageDeviceOfLimitedSize):
 
         self._physical_volumes = list(physical_volumes)
         self._logical_volumes: dict[str, LogicalVolume] = {}
+        # Physical volumes are created along with the volume group
+        for part in self._physical_volumes:
+            part.volume_group_id = id
 
         super().__init__(manager=manager, id=id, size=size)
 
@@ -83,37 +145,187 @@ class VolumeGroup(StorageDeviceOfLimitedSize):
     def logical_volumes(self) -> Collection[LogicalVolume]:
         return cast(Collection[LogicalVolume], self.storage_units)
 
+    @property
+    def discarded(self) -> bool:
+        return all(pv.discarded for pv in self.physical_volumes)
+
+    @property
+    def rotational(self) -> bool:
+        return any(pv.rotational for pv in self.physical_volumes)
+
+    @property
+    def supports_discard(self) -> bool:
+        return all(pv.supports_discard for pv in self.physical_volumes)
+
+    @property
+    def stripe_geometry(self) -> Optional[StripeGeometry]:
+        # Linear volumes span physical volumes one after another, so only
+        # the geometry of a single underlying device is meaningful
+        if len(self._physical_volumes) == 1:
+            return self._physical_volumes[0].stripe_geometry
+        return None
+
     def add_lv(self, id: str, fs_type: Optional[FSType] = None,
                fs_opts: Optional[Iterable[str]] = None,
-               size: int = 0, mount_point: Optional[str] = None) -> LogicalVolume:
+               size: int = 0, mount_point: Optional[str] = None,
+               mkfs_opts: Optional[Iterable[str]] = None,
+               mkfs_profile: Optional[MkfsProfile] = None,
+               stripes: Optional[int] = None, stripe_size: Optional[int] = None,
+               thin_pool: bool = False, pool: Optional[str] = None,
+               cache: Optional[LVCache] = None,
+               subvolumes: Optional[Iterable[Subvolume]] = None,
+               mount_profile: Optional[MountProfile] = None) -> LogicalVolume:
         if not is_valid_lv_name(id):
             raise ValueError('Invalid logical volume name: {}'.format(id))
         opts = set()
         if fs_opts:
             opts = set(fs_opts)
+
+        pool_lv = None
+        if pool is not None:
+            pool_lv = self.get_unit_by_id(pool)
+            if (pool_lv is None) or (not pool_lv.thin_pool):
+                raise ValueError("{}: '{}' is not a thin pool".format(self, pool))
+            if not size:
+                raise ValueError("{}: the size of thin volume '{}' is not set".format(self, id))
+            if stripes or cache or thin_pool:
+                raise ValueError("{}: thin volume '{}' cannot be striped, cached or a pool".format(
+                    self, id))
+
+        if thin_pool and (fs_type or mount_point):
+            raise ValueError("{}: thin pool '{}' cannot have a file system".format(self, id))
+
+        if stripes is not None:
+            if not (2 <= stripes <= len(self._physical_volumes)):
+                raise ValueError('{}: {} stripes requested for {} physical volumes'.format(
+                    self, stripes, len(self._physical_volumes)))
+            if stripe_size is None:
+                stripe_size = DEFAULT_STRIPE_SIZE
+            if (stripe_size < MIN_STRIPE_SIZE) or (stripe_size & (stripe_size - 1)):
+                raise ValueError('Stripe size {} is not a power of 2 or less than {}'.format(
+                    stripe_size, MIN_STRIPE_SIZE))
+        elif stripe_size is not None:
+            raise ValueError("{}: stripe size is set for non-striped '{}'".format(self, id))
+
+        if cache is not None:
+            if thin_pool:
+                raise ValueError("{}: thin pool '{}' cannot be cached".format(self, id))
+            if cache.physical_volume not in self._physical_volumes:
+                raise ValueError("{}: cache volume '{}' is not a physical volume of the group".format(
+                    self, cache.physical_volume.id))
+            if len(self._physical_volumes) - (stripes or 1) < 1:
+                raise ValueError("{}: no physical volumes left for cached '{}'".format(self, id))
+            if self.get_unit_by_id(self._cache_lv_name(id, cache)):
+                raise ValueError("{}: '{}' is already defined".format(
+                    self, self._cache_lv_name(id, cache)))
+
         lv = LogicalVolume(id=id, size=size, fs_type=fs_type, fs_opts=opts,
-                           mount_point=mount_point, storage_device=self)
-        self._add_storage_unit(lv)
+                           mount_point=mount_point, storage_device=self,
+                           mkfs_opts=list(mkfs_opts or []), mkfs_profile=mkfs_profile,
+                           stripes=stripes, stripe_size=stripe_size,
+                           thin_pool=thin_pool, pool=pool_lv, cache=cache,
+                           subvolumes=list(subvolumes or []), mount_profile=mount_profile)
+        if pool_lv is not None:
+            # Thin volumes take space from the pool, not from the group,
+            # and may overcommit it
+            StorageDevice._add_storage_unit(self, lv)
+        else:
+            self._add_storage_unit(lv)
         log.debug('{}: added {}'.format(self, lv))
         return lv
 
-    def create_logical_volumes(self):
-        log.debug('{}: creating logical volumes'.format(self))
-        args = ['vgcreate', self.id]
-        args.extend(pv.block_device for pv in self.physical_volumes)
-        run_cmd(args)
+    @staticmethod
+    def _cache_lv_name(id: str, cache: LVCache) -> str:
+        return '{}_{}'.format(id, 'cvol' if cache.is_writecache else 'cpool')
+
+    def _space_overhead(self, unit: LogicalVolume, size: int) -> int:
+        overhead = 0
+        if unit.stripes:
+            # Each stripe takes whole extents
+            overhead += round_up(size, EXTENT_SIZE * unit.stripes) - size
+        if unit.thin_pool:
+            # The metadata volume and its spare copy
+            overhead += 2 * pool_metadata_size(size, min_size=2 * MB)
+        if unit.cache:
+            overhead += round_up(unit.cache.size, EXTENT_SIZE)
+            if not unit.cache.is_writecache:
+                overhead += 2 * pool_metadata_size(unit.cache.size, min_size=8 * MB)
+        return overhead
+
+    def lvm_commands(self) -> list[list[str]]:
+        commands = []
+        for pv in self.physical_volumes:
+            # -ff replaces the existing physical volume labels, so no pvremove is needed
+            commands.append(['pvcreate', '-ff', '-y'] + list(pv.mkfs_opts) + [pv.block_device])
+
+        cmd = ['vgcreate', self.id]
+        cmd.extend(pv.block_device for pv in self.physical_volumes)
+        commands.append(cmd)
 
         for lv in self.logical_volumes:
-            args = ['lvcreate', '-y', '-n', lv.id]
+            cmd = ['lvcreate', '-y', '-n', lv.id]
+            if lv.pool is not None:
+                cmd.extend(['--virtualsize', '{}m'.format(lv.size // MB),
+                            '--thinpool', lv.pool.id, self.id])
+                commands.append(cmd)
+                continue
+
+            if lv.thin_pool:
+                cmd.extend(['--type', 'thin-pool'])
+            if lv.stripes:
+                cmd.extend(['--stripes', str(lv.stripes),
+                            '--stripesize', '{}k'.format(lv.stripe_size // 1024)])
+
+            # The cache goes to its own physical volume, the origin to the rest
+            origin_pvs = []
+            if lv.cache:
+                origin_pvs = [pv.block_device for pv in self.physical_volumes
+                              if pv is not lv.cache.physical_volume]
+
             if lv.use_all_available_space:
-                args.extend(['--extents', '100%FREE'])
+                cmd.extend(['--extents', '100%PVS' if origin_pvs else '100%FREE'])
             else:
-                args.extend(['--size', '{}m'.format(lv.size // (1024*1024))])
-            args.append(self.id)
-            run_cmd(args)
+                cmd.extend(['--size', '{}m'.format(lv.size // MB)])
+            cmd.append(self.id)
+            cmd.extend(origin_pvs)
+            commands.append(cmd)
+
+            if lv.cache:
+                commands.extend(self._cache_commands(lv))
+        return commands
 
+    def _cache_commands(self, lv: LogicalVolume) -> list[list[str]]:
+        cache = lv.cache
+        cache_name = self._cache_lv_name(lv.id, cache)
+        size = '{}m'.format(cache.size // MB)
+        origin = '{}/{}'.format(self.id, lv.id)
+
+        if cache.is_writecache:
+            return [['lvcreate', '-y', '-n', cache_name, '--size', size,
+                     self.id, cache.physical_volume.block_device],
+                    ['lvconvert', '-y', '--type', 'writecache', '--cachevol', cache_name, origin]]
+        return [['lvcreate', '-y', '--type', 'cache-pool', '-n', cache_name, '--size', size,
+                 self.id, cache.physical_volume.block_device],
+                ['lvconvert', '-y', '--type', 'cache', '--cachepool', cache_name,
+                 '--cachemode', cache.mode, origin]]
+
+    @property
+    def uses_thin_provisioning_tools(self) -> bool:
+        return any(lv.thin_pool or (lv.cache and not lv.cache.is_writecache)
+                   for lv in self.logical_volumes)
+
+    def create_logical_volumes(self):
+        log.debug('{}: creating logical volumes'.format(self))
+        run_lvm_script(self.lvm_commands())
+
+        res = run_cmd(args=['lvs', '--reportformat', 'json', '--units', 'b', '--nosuffix',
+                            '-o', 'lv_name,lv_size', self.id])
+        sizes = parse_lv_sizes(res.stdout)
+        for lv in self.logical_volumes:
+            if lv.id not in sizes:
+                raise RuntimeError('{}: logical volume {} was not created'.format(self, lv.id))
             lv.block_device = '/dev/{}/{}'.format(self.id, lv.id)
-            lv.size = get_block_device_size(lv.block_device)
+            lv.size = sizes[lv.id]
 
     def deactivate(self):
         run_cmd(args=['vgchange', '--activate', 'n', self.id])
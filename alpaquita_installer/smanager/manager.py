@@ -4,16 +4,19 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING, Optional, Iterable, TypeVar, Type
 from collections.abc import Collection
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 import os
 import logging
+import re
 
 from .disk import Disk
 from .lvm import VolumeGroup
-from .raid import RAID
+from .raid import RAID, RAIDSyncStatus, read_speed_limits, write_speed_limits
 from .cryptsetup import Cryptsetup
 from .storage_unit import Partition
-from .file_system import FSType
+from .file_system import FSType, mount_data
+from .utils import mount_fs, mount_levels, umount_fs_with_retries
 from alpaquita_installer.common.utils import run_cmd, write_file
 
 if TYPE_CHECKING:
@@ -24,21 +27,32 @@ log = logging.getLogger('smanager.manager')
 
 _DEVICE_TYPE = TypeVar('_DEVICE_TYPE')
 
+TMP_MOUNT_POINT = '/tmp'
+
 
 class StorageManager:
     def __init__(self):
         self._devices: dict[str, StorageDevice] = dict()
         self._mount_root_base: Optional[str] = None
+        self._units_by_mount_point: dict[str, StorageUnit] = dict()
+        self._mounted: set[str] = set()
+        # Device id -> ids of devices built on its units and vice versa
+        self._child_devices: dict[str, dict[str, None]] = dict()
+        self._parent_devices: dict[str, dict[str, None]] = dict()
+        # In KiB/s, applied while RAIDs are being created
+        self._raid_resync_speed_limit: Optional[int] = None
+        self._saved_raid_speed_limits: Optional[tuple[int, int]] = None
+        self._tmp_on_tmpfs = False
+        # The tmpfs size= option: in bytes or a percentage of RAM
+        self._tmp_size: Optional[str] = None
 
         self._cryptsetup = Cryptsetup(id='__cryptsetup__', manager=self)
-        self._devices[self._cryptsetup.id] = self._cryptsetup
+        self._add_device(self._cryptsetup)
 
-    def _get_unit_by_mount_point(self, mount_point: str) -> Optional[StorageUnit]:
-        for device in self._devices.values():
-            for unit in device.storage_units:
-                if unit.mount_point == mount_point:
-                    return unit
-        return None
+    def _add_device(self, device: StorageDevice, parents: Iterable[StorageDevice] = ()):
+        self._devices[device.id] = device
+        for parent in parents:
+            self.link_devices(parent=parent, child=device)
 
     def _path_relative_to_mount_root_base(self, path: str):
         if self.mount_root_base:
@@ -52,9 +66,30 @@ class StorageManager:
         if not os.path.isabs(mount_point):
             raise ValueError('{}: must be an absolute path'.format(mount_point))
 
-        if self._get_unit_by_mount_point(mount_point):
+        if (mount_point in self._units_by_mount_point) or \
+                (self._tmp_on_tmpfs and (mount_point == TMP_MOUNT_POINT)):
             raise ValueError("Mount point '{}' is already defined".format(mount_point))
 
+    def register_unit(self, unit: StorageUnit):
+        """Called by storage devices for every added unit"""
+        if unit.mount_point:
+            self._units_by_mount_point[unit.mount_point] = unit
+        # Subvolumes are mounted from the block device of their unit
+        for subvolume in unit.subvolumes:
+            if subvolume.mount_point:
+                self._units_by_mount_point[subvolume.mount_point] = unit
+
+    def link_devices(self, parent: StorageDevice, child: StorageDevice):
+        """Record that child is built on units of parent"""
+        self._child_devices.setdefault(parent.id, {})[child.id] = None
+        self._parent_devices.setdefault(child.id, {})[parent.id] = None
+
+    def get_child_devices(self, device: StorageDevice) -> Collection[StorageDevice]:
+        return tuple(self._devices[x] for x in self._child_devices.get(device.id, ()))
+
+    def get_parent_devices(self, device: StorageDevice) -> Collection[StorageDevice]:
+        return tuple(self._devices[x] for x in self._parent_devices.get(device.id, ()))
+
     @property
     def mount_root_base(self) -> Optional[str]:
         return self._mount_root_base
@@ -63,35 +98,55 @@ class StorageManager:
     def mount_root_base(self, value):
         self._mount_root_base = value
 
+    @property
+    def tmp_on_tmpfs(self) -> bool:
+        return self._tmp_on_tmpfs
+
+    @tmp_on_tmpfs.setter
+    def tmp_on_tmpfs(self, value: bool):
+        if value and (not self._tmp_on_tmpfs):
+            self.check_can_mount_to(TMP_MOUNT_POINT)
+        self._tmp_on_tmpfs = value
+
+    @property
+    def tmp_size(self) -> Optional[str]:
+        return self._tmp_size
+
+    @tmp_size.setter
+    def tmp_size(self, value: Optional[str]):
+        if (value is not None) and (not re.match(r'^([1-9][0-9]*|([1-9][0-9]?|100)%)$', value)):
+            raise ValueError("Invalid tmpfs size '{}'".format(value))
+        self._tmp_size = value
+
+    @property
+    def raid_resync_speed_limit(self) -> Optional[int]:
+        return self._raid_resync_speed_limit
+
+    @raid_resync_speed_limit.setter
+    def raid_resync_speed_limit(self, value: Optional[int]):
+        if (value is not None) and (value <= 0):
+            raise ValueError('RAID resync speed limit must be positive')
+        self._raid_resync_speed_limit = value
+
     @property
     def devices(self) -> set[StorageDevice]:
         return set(self._devices.values())
 
     @property
     def storage_units(self) -> Collection[StorageUnit]:
-        res = []
-        for device in self.devices:
-            for unit in device.storage_units:
-                res.append(unit)
-        return res
+        return [unit for device in self._devices.values() for unit in device.storage_units]
 
     @property
     def mount_points(self) -> Collection[tuple[str, StorageUnit]]:
-        res = []
-        for unit in self.storage_units:
-            if unit.mount_point:
-                res.append((unit.mount_point, unit))
-        return res
+        # A read-only view of the index
+        return self._units_by_mount_point.items()
 
     @property
     def cryptsetup(self) -> Cryptsetup:
         return self._cryptsetup
 
     def get_unit_by_mount_point(self, mount_point: str) -> Optional[StorageUnit]:
-        for mnt, unit in self.mount_points:
-            if mount_point == mnt:
-                return unit
-        return None
+        return self._units_by_mount_point.get(mount_point, None)
 
     def get_device_by_id(self, id: str) -> Optional[StorageDevice]:
         return self._devices.get(id, None)
@@ -104,7 +159,7 @@ class StorageManager:
         if device:
             raise ValueError("{} already exists".format(device))
         disk = Disk(manager=self, id=id)
-        self._devices[id] = disk
+        self._add_device(disk)
         log.debug('Added {}'.format(disk))
         return disk
 
@@ -112,23 +167,37 @@ class StorageManager:
         device = self.get_device_by_id(id)
         if device:
             raise ValueError("{} already exists".format(device))
+        physical_volumes = list(physical_volumes)
         vg = VolumeGroup(manager=self, id=id, physical_volumes=physical_volumes)
-        self._devices[id] = vg
+        self._add_device(vg, parents=[pv.storage_device for pv in physical_volumes])
         log.debug('Added {}'.format(vg))
         return vg
 
     def add_raid(self, id: str, level: int, members: Iterable[Partition | CryptoVolume],
-                 metadata: str = '1.2') -> RAID:
+                 metadata: str = '1.2', assume_clean: bool = False,
+                 bitmap: Optional[str] = None, chunk_size: Optional[int] = None) -> RAID:
         device = self.get_device_by_id(id)
         if device:
             raise ValueError('{} already exists'.format(device))
-        raid = RAID(manager=self, id=id, metadata=metadata, level=level, members=members)
-        self._devices[id] = raid
+        raid = RAID(manager=self, id=id, metadata=metadata, level=level, members=members,
+                    assume_clean=assume_clean, bitmap=bitmap, chunk_size=chunk_size)
+        self._add_device(raid, parents=[m.storage_device for m in raid.members])
         log.debug('Added {}'.format(raid))
         return raid
 
+    def wipe_disks(self):
+        disks = [d for d in self.get_devices_by_type(Disk) if d.wipe_method is not None]
+        if not disks:
+            return
+        log.debug('Wiping disks')
+        # Discarding a large device may take a while, so we process all disks at once
+        with ThreadPoolExecutor(max_workers=len(disks)) as executor:
+            for future in [executor.submit(disk.wipe) for disk in disks]:
+                future.result()
+
     def create_filesystems(self):
         log.debug('Creating file systems')
+        self.wipe_disks()
         for disk in self.get_devices_by_type(Disk):
             disk.create_partitions()
             for part in disk.partitions:
@@ -138,7 +207,10 @@ class StorageManager:
         for volume in self.cryptsetup.volumes:
             volume.make_fs()
 
-        for raid in self.get_devices_by_type(RAID):
+        raids = self.get_devices_by_type(RAID)
+        if raids:
+            self.limit_raid_resync_speed()
+        for raid in raids:
             raid.create_partitions()
             for part in raid.partitions:
                 part.make_fs()
@@ -148,21 +220,80 @@ class StorageManager:
             for lv in vg.logical_volumes:
                 lv.make_fs()
 
+    def alignment_warnings(self) -> list[str]:
+        res = []
+        for device in chain(self.get_devices_by_type(Disk), self.get_devices_by_type(RAID)):
+            res.extend(device.alignment_warnings)
+        return res
+
+    def limit_raid_resync_speed(self):
+        """Lower the resync speed, so it doesn't compete for I/O with the installation"""
+        if (self.raid_resync_speed_limit is None) or self._saved_raid_speed_limits:
+            return
+        self._saved_raid_speed_limits = read_speed_limits()
+        min_limit, _ = self._saved_raid_speed_limits
+        limit = self.raid_resync_speed_limit
+        log.debug('Limiting RAID resync speed to {} KiB/s'.format(limit))
+        write_speed_limits(min_limit=min(min_limit, limit), max_limit=limit)
+
+    def restore_raid_resync_speed(self):
+        if not self._saved_raid_speed_limits:
+            return
+        min_limit, max_limit = self._saved_raid_speed_limits
+        log.debug('Restoring RAID resync speed limits: {}, {}'.format(min_limit, max_limit))
+        write_speed_limits(min_limit=min_limit, max_limit=max_limit)
+        self._saved_raid_speed_limits = None
+
+    def raid_sync_statuses(self) -> dict[str, RAIDSyncStatus]:
+        res = {}
+        for raid in self.get_devices_by_type(RAID):
+            status = raid.sync_status()
+            if status:
+                res[raid.id] = status
+        return res
+
+    def _mount_unit(self, mount_point: str):
+        unit = self._units_by_mount_point[mount_point]
+        mnt_dir = self._path_relative_to_mount_root_base(mount_point)
+        os.makedirs(mnt_dir, exist_ok=True)
+        mount_fs(source=unit.block_device, target=mnt_dir, fs_type=str(unit.fs_type),
+                 options=mount_data(unit.fs_type, unit.mount_opts(mount_point)))
+        self._mounted.add(mount_point)
+
+    def _unmount_unit(self, mount_point: str):
+        umount_fs_with_retries(self._path_relative_to_mount_root_base(mount_point))
+        self._mounted.discard(mount_point)
+
     def mount(self):
         log.debug('Mounting')
-        items = sorted(self.mount_points, key=lambda x: x[0])
-        for mount_point, unit in items:
-            mnt_dir = self._path_relative_to_mount_root_base(mount_point)
-
-            run_cmd(args=['mkdir', '-p', mnt_dir])
-            run_cmd(args=['mount', '-t', str(unit.fs_type), unit.block_device, mnt_dir])
+        levels = mount_levels(self._units_by_mount_point.keys())
+        if not levels:
+            return
+        # Siblings don't depend on each other, so every level of the mount tree
+        # is mounted at once after its parents
+        with ThreadPoolExecutor(max_workers=max(len(x) for x in levels)) as executor:
+            for level in levels:
+                for future in [executor.submit(self._mount_unit, x) for x in level]:
+                    future.result()
 
     def unmount(self):
         log.debug('Unmounting')
-        items = sorted(self.mount_points, key=lambda x: x[0], reverse=True)
-        for mount_point, _ in items:
-            mnt_dir = self._path_relative_to_mount_root_base(mount_point)
-            run_cmd(args=['umount', mnt_dir])
+        # Only what is actually mounted, e.g. after a failed mount()
+        levels = mount_levels(self._mounted)
+        if not levels:
+            return
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(len(x) for x in levels)) as executor:
+            for level in reversed(levels):
+                futures = [executor.submit(self._unmount_unit, x) for x in level]
+                # Keep unmounting the rest, so that a failure doesn't leave everything mounted
+                for future in futures:
+                    try:
+                        future.result()
+                    except OSError as exc:
+                        errors.append(str(exc))
+        if errors:
+            raise RuntimeError('Unable to unmount file systems: {}'.format('; '.join(errors)))
 
     def deactivate_block_devices(self):
         for vg in self.get_devices_by_type(VolumeGroup):
@@ -184,35 +315,38 @@ class StorageManager:
     def write_fstab(self, path: str):
         log.debug('Writing {}'.format(path))
         swap_units = [u for u in self.storage_units if u.fs_type == FSType.SWAP]
-        mount_units = [x[1] for x in sorted(self.mount_points, key=lambda x: x[0])]
+        mount_points = sorted(self.mount_points, key=lambda x: x[0])
 
         lines = []
-        for unit in chain(mount_units, swap_units):
+        for mount_point, unit in chain(mount_points, [('none', u) for u in swap_units]):
             fs_spec = unit.fs_uuid
-
-            if unit.fs_type == FSType.SWAP:
-                fs_file = 'none'
-            else:
-                fs_file = unit.mount_point
-
+            fs_file = mount_point
             fs_vfstype = str(unit.fs_type)
 
-            if (unit.fs_type == FSType.SWAP) or (not unit.fs_opts):
+            mount_opts = unit.mount_opts(mount_point)
+            if not mount_opts:
                 fs_mntopts = 'defaults'
             else:
-                fs_mntopts = ','.join(unit.fs_opts)
+                fs_mntopts = ','.join(mount_opts)
 
             fs_freq = 0
 
-            if unit.fs_type == FSType.SWAP:
+            # fsck.btrfs does nothing, btrfs checks itself on mount
+            if unit.fs_type in (FSType.SWAP, FSType.BTRFS):
                 fs_passno = 0
-            elif unit.mount_point == '/':
+            elif mount_point == '/':
                 fs_passno = 1
             else:
                 fs_passno = 2
 
             lines.append('UUID={} {} {} {} {} {}\n'.format(
                 fs_spec, fs_file, fs_vfstype, fs_mntopts, fs_freq, fs_passno))
+
+        if self._tmp_on_tmpfs:
+            tmp_opts = ['mode=1777', 'nosuid', 'nodev']
+            if self._tmp_size:
+                tmp_opts.append('size={}'.format(self._tmp_size))
+            lines.append('tmpfs {} tmpfs {} 0 0\n'.format(TMP_MOUNT_POINT, ','.join(tmp_opts)))
         write_file(path, 'w', data=''.join(lines))
 
     def write_dmcrypt(self, path: str):
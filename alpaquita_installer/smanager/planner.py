@@ -0,0 +1,275 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+from __future__ import annotations
+from typing import Iterable, Optional
+import logging
+import os
+import time
+
+import attrs
+
+log = logging.getLogger('smanager.planner')
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+SYS_BLOCK = '/sys/block'
+# Size of /boot/efi for EFI installations
+BOOT_EFI_SIZE = 512 * MB
+# Size of the bios_boot partition for non-EFI installations
+BIOS_BOOT_SIZE = MB
+# Size of /boot
+BOOT_SIZE = 512 * MB
+ROOT_MIN_SIZE = 4 * GB
+# Where the bulk data disks get mounted
+DATA_MOUNT_POINT = '/srv'
+
+PROBE_SIZE = 64 * MB
+PROBE_BLOCK_SIZE = MB
+PROBE_TIMEOUT = 5.0
+
+
+@attrs.define
+class DiskProperties:
+    name: str
+    size: int
+    rotational: bool
+    # 'nvme', 'sata', 'sas', 'virtio', 'usb' or None if unknown
+    transport: Optional[str]
+    discard: bool
+    optimal_io_size: int
+    logical_block_size: int
+    physical_block_size: int
+    queue_depth: Optional[int]
+    numa_node: Optional[int]
+    removable: bool
+    read_only: bool
+    # Bytes per second, only if probed
+    throughput: Optional[float] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join('/dev', self.name)
+
+    @property
+    def media(self) -> str:
+        if self.transport == 'nvme':
+            return 'nvme'
+        return 'hdd' if self.rotational else 'ssd'
+
+    @property
+    def speed_key(self) -> tuple:
+        # The measured throughput wins, the media type and size break ties
+        return (self.throughput or 0.0, {'nvme': 2, 'ssd': 1, 'hdd': 0}[self.media], self.size)
+
+
+def _read_sysfs(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def _read_sysfs_int(path: str) -> Optional[int]:
+    value = _read_sysfs(path)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _transport(name: str, device_path: str) -> Optional[str]:
+    if name.startswith('nvme'):
+        return 'nvme'
+    parts = device_path.split('/')
+    if any(p.startswith('usb') for p in parts):
+        return 'usb'
+    if any(p.startswith('ata') for p in parts):
+        return 'sata'
+    if any(p.startswith('end_device') for p in parts):
+        return 'sas'
+    if any(p.startswith('virtio') for p in parts):
+        return 'virtio'
+    return None
+
+
+def read_disk_properties(name: str, sys_block: str = SYS_BLOCK) -> DiskProperties:
+    base = os.path.join(sys_block, name)
+    queue = os.path.join(base, 'queue')
+    device = os.path.join(base, 'device')
+
+    numa_node = None
+    # NVMe namespaces keep the PCI device one level deeper
+    for path in (os.path.join(device, 'numa_node'), os.path.join(device, 'device', 'numa_node')):
+        numa_node = _read_sysfs_int(path)
+        if numa_node is not None:
+            break
+    if (numa_node is not None) and (numa_node < 0):
+        numa_node = None
+
+    return DiskProperties(
+        name=name,
+        # Always in 512-byte sectors
+        size=(_read_sysfs_int(os.path.join(base, 'size')) or 0) * 512,
+        # Assume the worst if unknown, like StorageDevice.rotational
+        rotational=_read_sysfs(os.path.join(queue, 'rotational')) != '0',
+        transport=_transport(name, os.path.realpath(device)),
+        discard=(_read_sysfs_int(os.path.join(queue, 'discard_max_bytes')) or 0) > 0,
+        optimal_io_size=_read_sysfs_int(os.path.join(queue, 'optimal_io_size')) or 0,
+        logical_block_size=_read_sysfs_int(os.path.join(queue, 'logical_block_size')) or 512,
+        physical_block_size=_read_sysfs_int(os.path.join(queue, 'physical_block_size')) or 512,
+        queue_depth=(_read_sysfs_int(os.path.join(device, 'queue_depth')) or
+                     _read_sysfs_int(os.path.join(queue, 'nr_requests'))),
+        numa_node=numa_node,
+        removable=_read_sysfs(os.path.join(base, 'removable')) == '1',
+        read_only=_read_sysfs(os.path.join(base, 'ro')) == '1')
+
+
+def scan_disks(sys_block: str = SYS_BLOCK) -> list[DiskProperties]:
+    """Properties of all physical disks, virtual block devices (loop, zram, dm, md...) are skipped"""
+    res = []
+    for name in sorted(os.listdir(sys_block)):
+        if not os.path.exists(os.path.join(sys_block, name, 'device')):
+            continue
+        disk = read_disk_properties(name, sys_block=sys_block)
+        log.debug('Disk properties: {}'.format(disk))
+        res.append(disk)
+    return res
+
+
+def probe_throughput(path: str, size: int = PROBE_SIZE, block_size: int = PROBE_BLOCK_SIZE,
+                     timeout: float = PROBE_TIMEOUT) -> float:
+    """Measure the sequential read throughput of a device in bytes per second.
+
+    Only reads the device, the page cache is dropped for the range first
+    so that the result reflects the media.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_DONTNEED)
+        done = 0
+        start = time.monotonic()
+        elapsed = 0.0
+        while (done < size) and (elapsed < timeout):
+            data = os.read(fd, block_size)
+            if not data:
+                break
+            done += len(data)
+            elapsed = time.monotonic() - start
+    finally:
+        os.close(fd)
+    return done / elapsed if elapsed > 0 else 0.0
+
+
+def _mounted_disks() -> set[str]:
+    res = set()
+    try:
+        with open('/proc/mounts', 'r') as file:
+            sources = [line.split()[0] for line in file if line.strip()]
+    except OSError:
+        return res
+    for source in sources:
+        if not source.startswith('/dev/'):
+            continue
+        # /sys/class/block/<part> of a partition points into its disk's directory
+        real = os.path.realpath(os.path.join('/sys/class/block', os.path.basename(source)))
+        if os.path.exists(os.path.join(real, 'partition')):
+            real = os.path.dirname(real)
+        res.add(os.path.basename(real))
+    return res
+
+
+def candidate_disks(disks: Iterable[DiskProperties]) -> list[DiskProperties]:
+    """Disks that are safe to propose: not removable, writable and not in use"""
+    mounted = _mounted_disks()
+    return [d for d in disks
+            if not (d.removable or d.read_only or (d.transport == 'usb') or (d.name in mounted))]
+
+
+def _disk_entry(disk: DiskProperties) -> dict:
+    entry = {'id': disk.path, 'partitions': []}
+    if disk.discard:
+        # Trimming the whole disk upfront spares the FTL from tracking stale data
+        entry['wipe'] = 'discard'
+    return entry
+
+
+def plan_layout(disks: Iterable[DiskProperties], efi: bool, file_system: str = 'xfs',
+                swap_size: Optional[int] = None) -> dict:
+    """Propose a multi-disk layout as the configuration StorageInstaller consumes.
+
+    / and /boot go to the fastest disk which is large enough, swap to the
+    fastest non-rotational disk, and all the remaining disks are joined
+    for bulk data mounted to DATA_MOUNT_POINT.
+    """
+    disks = sorted(disks, key=lambda d: d.speed_key, reverse=True)
+
+    system_min_size = ROOT_MIN_SIZE + BOOT_SIZE + (BOOT_EFI_SIZE if efi else BIOS_BOOT_SIZE)
+    system_disk = next((d for d in disks if d.size >= system_min_size), None)
+    if system_disk is None:
+        raise ValueError('No disk has at least {} bytes for the system'.format(system_min_size))
+
+    entries = {system_disk.name: _disk_entry(system_disk)}
+    system_parts = entries[system_disk.name]['partitions']
+    if efi:
+        system_parts.append({'id': 'efi', 'size': BOOT_EFI_SIZE, 'mount_point': '/boot/efi',
+                             'fs_type': 'vfat', 'fs_opts': ['umask=0077'], 'flags': ['esp']})
+    else:
+        system_parts.append({'id': 'bios_boot', 'size': BIOS_BOOT_SIZE, 'flags': ['bios_boot']})
+    system_parts.append({'id': 'boot', 'size': BOOT_SIZE, 'mount_point': '/boot',
+                         'fs_type': file_system, 'mount_profile': 'general'})
+
+    data_disks = [d for d in disks if d is not system_disk]
+
+    swap_disk = None
+    if swap_size:
+        fast_disks = [d for d in disks if not d.rotational]
+        swap_disk = fast_disks[0] if fast_disks else system_disk
+        if swap_disk is system_disk:
+            system_min_size += swap_size
+            if system_disk.size < system_min_size:
+                raise ValueError("Not enough space on '{}' for swap".format(system_disk.path))
+        elif swap_disk.size <= swap_size:
+            raise ValueError("Not enough space on '{}' for swap".format(swap_disk.path))
+        entry = entries.setdefault(swap_disk.name, _disk_entry(swap_disk))
+        entry['partitions'].append({'id': 'swap', 'size': swap_size, 'fs_type': 'swap'})
+
+    system_parts.append({'id': 'root', 'mount_point': '/', 'fs_type': file_system,
+                         'mount_profile': 'general'})
+
+    if len(data_disks) == 1:
+        disk = data_disks[0]
+        entry = entries.setdefault(disk.name, _disk_entry(disk))
+        entry['partitions'].append({'id': 'data', 'mount_point': DATA_MOUNT_POINT,
+                                    'fs_type': file_system, 'mount_profile': 'throughput'})
+
+    storage = {'disks': list(entries.values())}
+    if len(data_disks) > 1:
+        pvs = []
+        for i, disk in enumerate(data_disks):
+            entry = entries.setdefault(disk.name, _disk_entry(disk))
+            pv_id = 'data_pv{}'.format(i)
+            entry['partitions'].append({'id': pv_id, 'fs_type': 'physical_volume'})
+            pvs.append(pv_id)
+        storage['disks'] = list(entries.values())
+        storage['volume_groups'] = [{
+            'id': 'data_vg',
+            'physical_volumes': pvs,
+            'logical_volumes': [{'id': 'data', 'mount_point': DATA_MOUNT_POINT,
+                                 'fs_type': file_system, 'mount_profile': 'throughput'}]}]
+
+    res = {'storage': storage}
+    if not efi:
+        res['bootloader_device'] = system_disk.path
+    return res
+
+
+def plan_host_layout(efi: bool, probe: bool = False, swap_size: Optional[int] = None) -> dict:
+    disks = candidate_disks(scan_disks())
+    if probe:
+        for disk in disks:
+            disk.throughput = probe_throughput(disk.path)
+            log.debug('{}: {:.1f} MB/s'.format(disk.path, disk.throughput / MB))
+    return plan_layout(disks, efi=efi, swap_size=swap_size)
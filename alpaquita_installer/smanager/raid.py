@@ -2,15 +2,17 @@
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
 from __future__ import annotations
-from typing import TYPE_CHECKING, Iterable, Collection
+from typing import TYPE_CHECKING, Iterable, Collection, Optional
 import os
 import re
 import logging
 
+import attrs
+
 from .storage_device import StorageDeviceWithPartitions
 from .storage_unit import Partition, CryptoVolume
-from .file_system import FSType
-from alpaquita_installer.common.utils import run_cmd
+from .file_system import FSType, StripeGeometry
+from alpaquita_installer.common.utils import run_cmd, write_file
 
 if TYPE_CHECKING:
     from .manager import StorageManager
@@ -18,19 +20,82 @@ if TYPE_CHECKING:
 log = logging.getLogger('smanager.raid')
 
 RAID_ID_PATTERN = r'/dev/md/[a-z0-9-_]+'
+BITMAP_TYPES = ('internal', 'none')
+# Minimal number of members per RAID level
+RAID_LEVELS = {0: 2, 1: 2, 5: 3, 6: 4, 10: 4}
+DEFAULT_CHUNK_SIZE = 512 * 1024
+MIN_CHUNK_SIZE = 4 * 1024
+MDSTAT_PATH = '/proc/mdstat'
+SPEED_LIMIT_MIN_PATH = '/proc/sys/dev/raid/speed_limit_min'
+SPEED_LIMIT_MAX_PATH = '/proc/sys/dev/raid/speed_limit_max'
+
+
+@attrs.define
+class RAIDSyncStatus:
+    # resync, recovery, reshape or check
+    action: str
+    # None for delayed and pending actions
+    progress: Optional[float] = None
+    finish: Optional[str] = None
+    speed: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.progress is None:
+            return '{} pending'.format(self.action)
+        return '{} {:.1f}% (finish={}, speed={})'.format(self.action, self.progress,
+                                                         self.finish, self.speed)
+
+
+def parse_mdstat(data: str) -> dict[str, RAIDSyncStatus]:
+    """Returns sync statuses of md devices with an ongoing sync action"""
+    res = {}
+    device = None
+    for line in data.splitlines():
+        m = re.match(r'^(md\S+) : ', line)
+        if m:
+            device = m.group(1)
+            continue
+        if device is None:
+            continue
+
+        m = re.search(r'(resync|recovery|reshape|check)\s*=\s*([0-9.]+)%.*'
+                      r'finish=(\S+)\s+speed=(\S+)', line)
+        if m:
+            res[device] = RAIDSyncStatus(action=m.group(1), progress=float(m.group(2)),
+                                         finish=m.group(3), speed=m.group(4))
+            continue
+
+        m = re.search(r'(resync|recovery|reshape|check)\s*=\s*(DELAYED|PENDING)', line)
+        if m:
+            res[device] = RAIDSyncStatus(action=m.group(1))
+    return res
+
+
+def read_speed_limits() -> tuple[int, int]:
+    with open(SPEED_LIMIT_MIN_PATH, 'r') as file:
+        min_limit = int(file.read())
+    with open(SPEED_LIMIT_MAX_PATH, 'r') as file:
+        max_limit = int(file.read())
+    return min_limit, max_limit
+
+
+def write_speed_limits(min_limit: int, max_limit: int):
+    # The kernel guarantees at least speed_limit_min even under
+    # load, so both limits have to be set
+    write_file(SPEED_LIMIT_MIN_PATH, 'w', str(min_limit))
+    write_file(SPEED_LIMIT_MAX_PATH, 'w', str(max_limit))
 
 
 class RAID(StorageDeviceWithPartitions):
     def __init__(self, manager: StorageManager, id: str,
                  level: int, members: Iterable[Partition | CryptoVolume],
-                 metadata: str = '1.2'):
+                 metadata: str = '1.2', assume_clean: bool = False,
+                 bitmap: Optional[str] = None, chunk_size: Optional[int] = None):
         """id must be of format /dev/md/<raid_name>"""
 
-        # Note, that other levels will require implementing
-        # stride and stripe-width attributes plus a more
-        # sophisticated logic for determining the available size.
-        if level != 1:
-            raise ValueError('Only RAID1 is supported')
+        if level not in RAID_LEVELS:
+            raise ValueError('RAID level {} is not supported, supported levels: {}'.format(
+                level, ', '.join(str(x) for x in RAID_LEVELS)))
         self._level = level
 
         if not re.match(RAID_ID_PATTERN, id):
@@ -40,14 +105,35 @@ class RAID(StorageDeviceWithPartitions):
             raise ValueError("Metadata {} is not supported".format(metadata))
         self._metadata = metadata
 
+        if (bitmap is not None) and (bitmap not in BITMAP_TYPES):
+            raise ValueError('Bitmap {} is not supported'.format(bitmap))
+        self._bitmap = bitmap
+        self._assume_clean = assume_clean
+
         self._members = list(members)
-        if len(self._members) < 2:
-            raise ValueError('Provide at least 2 RAID members')
+        min_members = RAID_LEVELS[level]
+        if len(self._members) < min_members:
+            raise ValueError('Provide at least {} RAID{} members'.format(min_members, level))
         if any(m.fs_type != FSType.RAID_MEMBER for m in members):
             raise ValueError('All members must be of the RAID type')
         if any(not isinstance(m, (Partition, CryptoVolume)) for m in members):
             raise ValueError('All members must be of the Partition or CryptoVolume types')
-        size = min(m.size for m in members)
+
+        if level == 1:
+            if chunk_size is not None:
+                raise ValueError('Chunk size is not applicable to RAID1')
+        else:
+            if chunk_size is None:
+                chunk_size = DEFAULT_CHUNK_SIZE
+            # Must be a power of 2
+            if (chunk_size < MIN_CHUNK_SIZE) or (chunk_size & (chunk_size - 1)):
+                raise ValueError('Chunk size {} is not a power of 2 or less than {}'.format(
+                    chunk_size, MIN_CHUNK_SIZE))
+        self._chunk_size = chunk_size
+
+        size = self._usable_size()
+        if size <= 0:
+            raise ValueError('RAID members are smaller than the chunk size {}'.format(chunk_size))
 
         self._raid_created = False
 
@@ -69,6 +155,69 @@ class RAID(StorageDeviceWithPartitions):
     def metadata(self) -> str:
         return self._metadata
 
+    @property
+    def chunk_size(self) -> Optional[int]:
+        return self._chunk_size
+
+    @property
+    def data_disks(self) -> int:
+        """Number of members holding distinct data in a stripe"""
+        count = len(self._members)
+        if self.level == 0:
+            return count
+        elif self.level == 1:
+            return 1
+        elif self.level == 5:
+            return count - 1
+        elif self.level == 6:
+            return count - 2
+        else:
+            # RAID10 with the default near=2 layout
+            return count // 2
+
+    def _usable_size(self) -> int:
+        # md uses equal space on every member, except for RAID0 with its zones.
+        # The superblock and the bitmap take space too, but the exact size is
+        # determined by create_partitions() anyway.
+        if self.level == 1:
+            return min(m.size for m in self._members)
+
+        def round_down(size: int) -> int:
+            return size - size % self._chunk_size
+
+        if self.level == 0:
+            return sum(round_down(m.size) for m in self._members)
+        member_size = round_down(min(m.size for m in self._members))
+        if self.level == 10:
+            return member_size * len(self._members) // 2
+        return member_size * self.data_disks
+
+    @property
+    def stripe_geometry(self) -> Optional[StripeGeometry]:
+        if self.level == 1:
+            return None
+        return StripeGeometry(chunk_size=self._chunk_size, data_disks=self.data_disks)
+
+    @property
+    def assume_clean(self) -> bool:
+        return self._assume_clean
+
+    @property
+    def bitmap(self) -> Optional[str]:
+        return self._bitmap
+
+    @property
+    def discarded(self) -> bool:
+        return all(m.discarded for m in self.members)
+
+    @property
+    def rotational(self) -> bool:
+        return any(m.rotational for m in self.members)
+
+    @property
+    def supports_discard(self) -> bool:
+        return all(m.supports_discard for m in self.members)
+
     def create(self):
         if self._raid_created:
             return
@@ -78,8 +227,16 @@ class RAID(StorageDeviceWithPartitions):
                 '--metadata={}'.format(self.metadata),
                 '--run', '--homehost=any',
                 '--level={}'.format(self.level),
-                '--raid-devices={}'.format(len(self.members)),
-                self.id]
+                '--raid-devices={}'.format(len(self.members))]
+        if self.chunk_size:
+            args.append('--chunk={}K'.format(self.chunk_size // 1024))
+        if self.bitmap:
+            args.append('--bitmap={}'.format(self.bitmap))
+        # Skips the initial resync. Safe for freshly wiped members only,
+        # RAID5/6 parity is not valid otherwise.
+        if self.assume_clean:
+            args.append('--assume-clean')
+        args.append(self.id)
         args.extend(m.block_device for m in self.members)
         run_cmd(args)
 
@@ -90,5 +247,12 @@ class RAID(StorageDeviceWithPartitions):
         self.create()
         super().create_partitions()
 
+    def sync_status(self) -> Optional[RAIDSyncStatus]:
+        if self._block_device is None:
+            return None
+        with open(MDSTAT_PATH, 'r') as file:
+            statuses = parse_mdstat(file.read())
+        return statuses.get(os.path.basename(self._block_device), None)
+
     def stop(self):
         run_cmd(args=['mdadm', '--stop', self.id])
@@ -7,11 +7,14 @@ import time
 import os
 import json
 import abc
+import enum
 import logging
+import math
 
-from .file_system import FSType
+from .file_system import FSType, MkfsProfile, MountProfile, StripeGeometry, Subvolume, validate_mount_opts
 from .storage_unit import Partition, StorageUnitFlag
-from .utils import get_block_device_size
+from .luks import LUKSParams
+from .utils import BlockDeviceTopology, get_block_device_size, get_block_device_topology
 from alpaquita_installer.common.utils import run_cmd
 
 if TYPE_CHECKING:
@@ -22,12 +25,82 @@ log = logging.getLogger('smanager.storage_device')
 
 DEVICE_CREATION_TIMEOUT = 10.0
 
+MB = 1024 * 1024
+# The default partition alignment of sfdisk and parted
+DEFAULT_ALIGNMENT = MB
+# An alignment above it would waste too much space, so only optimal_io_size is honored then
+MAX_ALIGNMENT = 64 * MB
+# Kept free at the end of the device for the backup GPT
+GPT_BACKUP_SIZE = MB
+
+
+def alignment_grain(topology: BlockDeviceTopology) -> int:
+    """The granularity of partition starts and sizes on a device"""
+    opt = topology.optimal_io_size
+    # Some USB bridges report bogus values like 0xFFFF sectors
+    if (opt <= 0) or (opt % max(topology.physical_block_size, 4096)):
+        return math.lcm(DEFAULT_ALIGNMENT, topology.physical_block_size)
+    grain = math.lcm(DEFAULT_ALIGNMENT, opt)
+    return grain if grain <= MAX_ALIGNMENT else opt
+
+
+def align_up(value: int, grain: int, offset: int = 0) -> int:
+    return -((offset - value) // grain) * grain + offset
+
+
+def align_down(value: int, grain: int, offset: int = 0) -> int:
+    return ((value - offset) // grain) * grain + offset
+
+
+def partition_layout(device_size: int, sizes: Iterable[Optional[int]],
+                     grain: int, offset: int = 0) -> list[tuple[int, int]]:
+    """Starts and sizes in bytes of partitions placed one after another.
+
+    Every start is at offset modulo grain and every size is a multiple of grain.
+    A size of None takes the rest of the device.
+    """
+    offset %= grain
+    end = align_down(device_size - GPT_BACKUP_SIZE, grain, offset)
+    start = align_up(DEFAULT_ALIGNMENT, grain, offset)
+    res = []
+    for size in sizes:
+        if size is None:
+            size = end - start
+        else:
+            size = max(align_down(size, grain), grain)
+        if (size <= 0) or (start + size > end):
+            raise ValueError('Partitions do not fit the device when aligned to {} bytes'.format(grain))
+        res.append((start, size))
+        start += size
+    return res
+
+
+class WipeMethod(enum.Enum):
+    # Remove signatures of file systems, RAID, LVM and LUKS
+    ZERO_HEADERS = 1
+    # ZERO_HEADERS plus discard of the whole device
+    DISCARD = 2
+    # ZERO_HEADERS plus secure discard of the whole device
+    SECURE = 3
+
+    @classmethod
+    def from_str(cls, value: str) -> WipeMethod:
+        ret = getattr(cls, value.strip().upper().replace('-', '_'), None)
+        if ret is None:
+            raise ValueError("Unknown wipe method '{}', supported: {}".format(
+                value, ', '.join(str(x) for x in cls)))
+        return ret
+
+    def __str__(self) -> str:
+        return self.name.lower().replace('_', '-')
+
 
 class StorageDevice(abc.ABC):
     def __init__(self, manager: StorageManager, id: str):
         self._manager = manager
         self._id = id
-        self._storage_units: list[StorageUnit] = []
+        # Insertion ordered, doubles as the id index
+        self._storage_units: dict[str, StorageUnit] = {}
 
     def __str__(self) -> str:
         return 'Storage device {}'.format(self.id)
@@ -35,12 +108,28 @@ class StorageDevice(abc.ABC):
     def __repr__(self) -> str:
         return str(self)
 
-    def get_unit_by_id(self, id: str) -> Optional[StorageUnit]:
-        for unit in self.storage_units:
-            if unit.id == id:
-                return unit
+    @property
+    def discarded(self) -> bool:
+        """Whether all blocks of the device were discarded by wipe()"""
+        return False
+
+    @property
+    def stripe_geometry(self) -> Optional[StripeGeometry]:
+        """Set for devices striping data over several disks"""
         return None
 
+    @property
+    def rotational(self) -> bool:
+        # Assume the worst if unknown
+        return True
+
+    @property
+    def supports_discard(self) -> bool:
+        return False
+
+    def get_unit_by_id(self, id: str) -> Optional[StorageUnit]:
+        return self._storage_units.get(id, None)
+
     @property
     def manager(self) -> StorageManager:
         return self._manager
@@ -51,7 +140,8 @@ class StorageDevice(abc.ABC):
 
     @property
     def storage_units(self) -> Collection[StorageUnit]:
-        return self._storage_units[:]
+        # A read-only view, so that callers don't pay for copying
+        return self._storage_units.values()
 
     def _add_storage_unit(self, unit: StorageUnit):
         if self.get_unit_by_id(unit.id):
@@ -64,7 +154,40 @@ class StorageDevice(abc.ABC):
         if unit.mount_point is not None:
             self.manager.check_can_mount_to(unit.mount_point)
 
-        self._storage_units.append(unit)
+        if unit.subvolumes:
+            if unit.fs_type != FSType.BTRFS:
+                raise ValueError("{}: subvolumes are supported only on btrfs, '{}' is {}".format(
+                    self, unit.id, unit.fs_type))
+            names = [s.name for s in unit.subvolumes]
+            if len(set(names)) != len(names):
+                raise ValueError("{}: duplicate subvolume names in '{}'".format(self, unit.id))
+            mount_points = [unit.mount_point] if unit.mount_point else []
+            for subvolume in unit.subvolumes:
+                if subvolume.mount_point is None:
+                    continue
+                if subvolume.mount_point in mount_points:
+                    raise ValueError("Mount point '{}' is already defined".format(subvolume.mount_point))
+                self.manager.check_can_mount_to(subvolume.mount_point)
+                mount_points.append(subvolume.mount_point)
+
+        if unit.mkfs_opts and (unit.fs_type in (None, FSType.CRYPTO_PARTITION)):
+            raise ValueError("{}: mkfs opts are set for '{}' without a file system".format(
+                self, unit.id))
+        if unit.mkfs_profile and (unit.fs_type not in (FSType.EXT4, FSType.XFS)):
+            raise ValueError("{}: mkfs profile '{}' is supported only on ext4 and xfs".format(
+                self, unit.mkfs_profile))
+        if unit.mount_profile and \
+                (unit.fs_type not in (FSType.EXT4, FSType.XFS, FSType.BTRFS, FSType.F2FS)):
+            raise ValueError("{}: mount profile '{}' is supported only on ext4, xfs, btrfs and f2fs".format(
+                self, unit.mount_profile))
+        if unit.fs_opts and unit.fs_type:
+            try:
+                validate_mount_opts(unit.fs_type, unit.fs_opts)
+            except ValueError as exc:
+                raise ValueError("{}: '{}': {}".format(self, unit.id, exc)) from None
+
+        self._storage_units[unit.id] = unit
+        self.manager.register_unit(unit)
 
 
 class StorageDeviceOfLimitedSize(StorageDevice):
@@ -87,14 +210,20 @@ class StorageDeviceOfLimitedSize(StorageDevice):
     def available(self) -> int:
         return self._available
 
-    def _add_storage_unit(self, unit: StorageUnit):
-        if (self.available == 0) or (self.available < unit.size):
-            raise ValueError('{}: not enough free space'.format(self))
+    def _space_overhead(self, unit: StorageUnit, size: int) -> int:
+        """Space taken by a unit of the given size in addition to the size"""
+        return 0
 
+    def _add_storage_unit(self, unit: StorageUnit):
+        overhead = self._space_overhead(unit, unit.size or self.available)
         if unit.size == 0:
-            unit.size = self.available
+            if self.available <= overhead:
+                raise ValueError('{}: not enough free space'.format(self))
+            unit.size = self.available - overhead
             unit.use_all_available_space = True
-        self._available -= unit.size
+        elif self.available < unit.size + overhead:
+            raise ValueError('{}: not enough free space'.format(self))
+        self._available -= unit.size + overhead
 
         super()._add_storage_unit(unit)
 
@@ -104,7 +233,10 @@ class StorageDeviceWithPartitions(StorageDeviceOfLimitedSize):
         super().__init__(manager=manager, id=id, size=size)
         self._partitions_created = False
         self._block_device = id
+        self._alignment_warnings: list[str] = []
         self._esp_defined = False
+        self._wipe_method: Optional[WipeMethod] = None
+        self._discarded = False
 
     @property
     def partitions(self) -> Collection[Partition]:
@@ -114,11 +246,54 @@ class StorageDeviceWithPartitions(StorageDeviceOfLimitedSize):
     def block_device(self) -> str:
         return self._block_device
 
+    @property
+    def wipe_method(self) -> Optional[WipeMethod]:
+        return self._wipe_method
+
+    @wipe_method.setter
+    def wipe_method(self, value: Optional[WipeMethod]):
+        self._wipe_method = value
+
+    @property
+    def discarded(self) -> bool:
+        return self._discarded
+
+    @property
+    def alignment_warnings(self) -> Collection[str]:
+        """Partitions sfdisk placed off the alignment requested in create_partitions()"""
+        return self._alignment_warnings[:]
+
+    def wipe(self):
+        if self.wipe_method is None:
+            return
+        log.debug('{}: wiping with {}'.format(self, self.wipe_method))
+
+        # Signatures inside the old partitions (RAID superblocks, LVM and LUKS
+        # headers) survive 'wipefs -a' on the whole device and show up again
+        # once partitions with the same offsets are created, so wipe them first.
+        res = run_cmd(args=['lsblk', '-n', '-p', '-l', '-o', 'PATH', self.block_device])
+        children = res.stdout.decode().split()[1:]
+        for child in reversed(children):
+            run_cmd(args=['wipefs', '-a', child])
+        run_cmd(args=['wipefs', '-a', self.block_device])
+
+        if self.wipe_method == WipeMethod.DISCARD:
+            run_cmd(args=['blkdiscard', self.block_device])
+            self._discarded = True
+        elif self.wipe_method == WipeMethod.SECURE:
+            run_cmd(args=['blkdiscard', '-s', self.block_device])
+            self._discarded = True
+
     def add_partition(self, id: str, fs_type: Optional[FSType] = None,
                       size: int = 0, mount_point: Optional[str] = None,
                       fs_opts: Optional[Iterable[str]] = None,
                       flags: Optional[Iterable[StorageUnitFlag]] = None,
-                      crypto_passphrase: Optional[str] = None) -> Partition:
+                      crypto_passphrase: Optional[str] = None,
+                      crypto_params: Optional[LUKSParams] = None,
+                      mkfs_opts: Optional[Iterable[str]] = None,
+                      mkfs_profile: Optional[MkfsProfile] = None,
+                      subvolumes: Optional[Iterable[Subvolume]] = None,
+                      mount_profile: Optional[MountProfile] = None) -> Partition:
         if not id:
             raise ValueError('Cannot create a partition without an id')
 
@@ -127,6 +302,8 @@ class StorageDeviceWithPartitions(StorageDeviceOfLimitedSize):
                 raise ValueError('Cannot create a crypto partition without a passphrase')
             if fs_opts or mount_point:
                 raise ValueError('fs opts or mount point is set')
+        elif crypto_params:
+            raise ValueError('Crypto parameters are set for a non crypto partition')
 
         opts = set()
         if fs_opts:
@@ -144,7 +321,10 @@ class StorageDeviceWithPartitions(StorageDeviceOfLimitedSize):
 
         part = Partition(id=id, size=size, fs_type=fs_type, fs_opts=opts,
                          mount_point=mount_point, storage_device=self,
-                         flags=flags[:], crypto_passphrase=crypto_passphrase)
+                         flags=flags[:], crypto_passphrase=crypto_passphrase,
+                         crypto_params=crypto_params,
+                         mkfs_opts=list(mkfs_opts or []), mkfs_profile=mkfs_profile,
+                         subvolumes=list(subvolumes or []), mount_profile=mount_profile)
 
         self._add_storage_unit(part)
         log.debug('{}: added {}'.format(self, part))
@@ -154,19 +334,26 @@ class StorageDeviceWithPartitions(StorageDeviceOfLimitedSize):
         log.debug('{}: creating partitions'.format(self))
         run_cmd(args=['wipefs', '-a', self.block_device])
 
-        # We use sfdisk, as it doesn't require to manually specify start and end
-        # partition offsets (with alignment and etc).
+        # We place partitions ourselves, aligned to the device topology, and let
+        # sfdisk write the partition table.
         # Later we recreate the same partitions with parted, as parted knows
         # some magic and properly informs the system of updates in block
         # devices (especially loopback devices).
         # TODO: it would be good to use only one partitioning tool
 
+        topology = get_block_device_topology(self.block_device)
+        grain = alignment_grain(topology)
+        sector_size = topology.logical_block_size
+        layout = partition_layout(device_size=get_block_device_size(self.block_device),
+                                  sizes=[None if p.use_all_available_space else p.size
+                                         for p in self.partitions],
+                                  grain=grain, offset=topology.alignment_offset)
+        log.debug('{}: {}, aligning partitions to {} bytes'.format(self, topology, grain))
+
         script = ['label: gpt']
-        for part in self.partitions:
-            line = 'name={}'.format(part.id)
-            if not part.use_all_available_space:
-                line = 'size={}KiB,{}'.format(part.size // 1024, line)
-            script.append(line)
+        for part, (start, size) in zip(self.partitions, layout):
+            script.append('start={},size={},name={}'.format(
+                start // sector_size, size // sector_size, part.id))
         script = '\n'.join(script)
 
         args = ['sfdisk', '--lock', '--wipe', 'always',
@@ -181,8 +368,17 @@ class StorageDeviceWithPartitions(StorageDeviceOfLimitedSize):
             raise RuntimeError("{}: {} elements defined in the partition table, {} expected".format(
                 self, len(items), len(self.partitions)))
 
+        sector_size = ptable.get('sectorsize', sector_size)
+        self._alignment_warnings = []
         for i, part in enumerate(self.partitions):
             part.block_device = items[i]['node']
+            start = items[i]['start'] * sector_size
+            size = items[i]['size'] * sector_size
+            if ((start - topology.alignment_offset) % grain) or (size % grain):
+                msg = '{}: {} (start {}, size {}) is not aligned to {} bytes'.format(
+                    self, part.block_device, start, size, grain)
+                log.warning(msg)
+                self._alignment_warnings.append(msg)
 
         res = run_cmd(args=['parted', '-s', '-m', self.block_device, 'unit s', 'print'])
         data = res.stdout.decode().splitlines()
@@ -3,16 +3,21 @@
 
 from __future__ import annotations
 from typing import TYPE_CHECKING, Optional
+from tempfile import TemporaryDirectory
 import enum
+import os
 
 import attrs
 
-from .file_system import FSType
-from .utils import get_fs_uuid, get_block_device_size
+from .file_system import FSType, MkfsProfile, MKFS_PROFILES, MountProfile, StripeGeometry, Subvolume, \
+    merge_mount_opts, mount_data, profile_mount_opts
+from .luks import LUKSParams, VolumeKey
+from .utils import get_fs_uuid, get_block_device_size, mount_fs, umount_fs
 from alpaquita_installer.common.utils import run_cmd
 
 if TYPE_CHECKING:
     from .storage_device import StorageDevice
+    from .lvm import LVCache
 
 
 class StorageUnitFlag(enum.Enum):
@@ -40,38 +45,102 @@ class StorageUnit:
     fs_opts: list[str] = attrs.field(default=attrs.Factory(list))
     # esp, boot flags
     flags: set[StorageUnitFlag] = attrs.field(default=attrs.Factory(set))
+    # Passed to mkfs after the profile arguments
+    mkfs_opts: list[str] = attrs.field(default=attrs.Factory(list))
+    mkfs_profile: Optional[MkfsProfile] = None
+    # Mount options chosen by the workload and the media, fs_opts override them
+    mount_profile: Optional[MountProfile] = None
+    # btrfs only
+    subvolumes: list[Subvolume] = attrs.field(default=attrs.Factory(list))
 
     block_device: Optional[str] = None
     fs_uuid: Optional[str] = None  # Updated by make_fs()
 
     # Used internally
     use_all_available_space: bool = False
+    # Set for physical volumes of a volume group
+    volume_group_id: Optional[str] = None
 
     def is_flag_set(self, flag: StorageUnitFlag):
         return flag in self.flags
 
-    def make_fs(self):
-        if self.fs_type is None:
-            return
-        if self.block_device is None:
-            raise RuntimeError('{}: no block device associated'.format(self))
+    @property
+    def discarded(self) -> bool:
+        return self.storage_device.discarded
+
+    @property
+    def stripe_geometry(self) -> Optional[StripeGeometry]:
+        return self.storage_device.stripe_geometry
+
+    @property
+    def rotational(self) -> bool:
+        return self.storage_device.rotational
+
+    @property
+    def supports_discard(self) -> bool:
+        return self.storage_device.supports_discard
+
+    def mkfs_args(self) -> list[str]:
+        profile_args, profile_ext_opts = MKFS_PROFILES.get((self.mkfs_profile, self.fs_type), ([], []))
+        geometry = self.stripe_geometry
 
         if self.fs_type == FSType.PHYSICAL_VOLUME:
-            run_cmd(['pvremove', '-ff', '-y', self.block_device])
             args = ['pvcreate', '-f', '-y']
         elif self.fs_type == FSType.RAID_MEMBER:
             args = ['mdadm', '--misc', '-f', '--zero-superblock']
         elif self.fs_type == FSType.SWAP:
             args = ['mkswap']
         elif self.fs_type == FSType.EXT4:
-            args = ['mkfs.ext4', '-F']
+            args = ['mkfs.ext4', '-F'] + profile_args
+            ext_opts = list(profile_ext_opts)
+            # No need to discard blocks once again
+            if self.discarded and ('nodiscard' not in ext_opts):
+                ext_opts.append('nodiscard')
+            if geometry:
+                # In 4K file system blocks
+                stride = max(geometry.chunk_size // 4096, 1)
+                ext_opts.extend(['stride={}'.format(stride),
+                                 'stripe_width={}'.format(stride * geometry.data_disks)])
+            if ext_opts:
+                args.extend(['-E', ','.join(ext_opts)])
         elif self.fs_type == FSType.XFS:
-            args = ['mkfs.xfs', '-f']
+            args = ['mkfs.xfs', '-f'] + profile_args
+            if self.discarded and ('-K' not in args):
+                args.append('-K')
+            if geometry:
+                args.extend(['-d', 'su={}k,sw={}'.format(geometry.chunk_size // 1024,
+                                                          geometry.data_disks)])
+        elif self.fs_type == FSType.BTRFS:
+            args = ['mkfs.btrfs', '-f']
+            if self.discarded:
+                args.append('-K')
+        elif self.fs_type == FSType.F2FS:
+            args = ['mkfs.f2fs', '-f']
+            if self.discarded:
+                args.extend(['-t', '0'])
+            # Compression must be enabled at mkfs time
+            if any(o.startswith('compress_') for o in self.fs_opts):
+                args.extend(['-O', 'extra_attr,compression'])
         elif self.fs_type == FSType.VFAT:
             args = ['mkfs.fat', '-F32']
         else:
             raise RuntimeError("Don't know how to create a file system on {}".format(self.block_device))
+        args.extend(self.mkfs_opts)
         args.append(self.block_device)
+        return args
+
+    def make_fs(self):
+        if self.fs_type is None:
+            return
+        if self.block_device is None:
+            raise RuntimeError('{}: no block device associated'.format(self))
+
+        if self.fs_type == FSType.PHYSICAL_VOLUME:
+            if self.volume_group_id is not None:
+                # VolumeGroup.create_logical_volumes() creates it in a batch
+                return
+            run_cmd(['pvremove', '-ff', '-y', self.block_device])
+        args = self.mkfs_args()
         run_cmd(args)
 
         if self.fs_type == FSType.RAID_MEMBER:
@@ -79,10 +148,47 @@ class StorageUnit:
 
         self.fs_uuid = get_fs_uuid(self.block_device)
 
+        if self.subvolumes:
+            self._create_subvolumes()
+
+    def _create_subvolumes(self):
+        with TemporaryDirectory() as tmpdir:
+            mount_fs(source=self.block_device, target=tmpdir, fs_type=str(self.fs_type),
+                     options=mount_data(self.fs_type, self.fs_opts))
+            try:
+                for subvolume in self.subvolumes:
+                    run_cmd(args=['btrfs', 'subvolume', 'create',
+                                  os.path.join(tmpdir, subvolume.name)])
+            finally:
+                umount_fs(tmpdir)
+
+    def subvolume_by_mount_point(self, mount_point: str) -> Optional[Subvolume]:
+        for subvolume in self.subvolumes:
+            if subvolume.mount_point == mount_point:
+                return subvolume
+        return None
+
+    def mount_opts(self, mount_point: str) -> list[str]:
+        """fs_opts for mounting the unit or one of its subvolumes to mount_point"""
+        opts = sorted(self.fs_opts)
+        if self.mount_profile is not None:
+            opts = merge_mount_opts(profile_mount_opts(self.mount_profile, self.fs_type,
+                                                       rotational=self.rotational,
+                                                       supports_discard=self.supports_discard),
+                                    opts)
+        subvolume = self.subvolume_by_mount_point(mount_point)
+        if subvolume is not None:
+            opts.insert(0, 'subvol={}'.format(subvolume.name))
+        return opts
+
 
 @attrs.define
 class Partition(StorageUnit):
     crypto_passphrase: Optional[str] = None
+    crypto_params: Optional[LUKSParams] = None
+
+    # Set by make_fs() for crypto partitions until the volume is opened
+    volume_key: Optional[VolumeKey] = None
 
     @property
     def parted_flag(self) -> Optional[str]:
@@ -106,16 +212,42 @@ class Partition(StorageUnit):
             if not self.block_device:
                 raise RuntimeError('{}: no block device associated'.format(self))
 
-            run_cmd(['cryptsetup', 'luksFormat', self.block_device],
-                    input=self.crypto_passphrase.encode())
+            params = self.crypto_params or LUKSParams()
+            self.forget_volume_key()
+            self.volume_key = VolumeKey(key_size=params.key_size)
+
+            args = ['cryptsetup', 'luksFormat']
+            args.extend(params.format_args())
+            args.extend(['--volume-key-file', self.volume_key.path, self.block_device])
+            run_cmd(args, input=self.crypto_passphrase.encode())
             self.fs_uuid = get_fs_uuid(self.block_device)
         else:
             super().make_fs()
 
+    def forget_volume_key(self):
+        if self.volume_key is not None:
+            self.volume_key.close()
+            self.volume_key = None
+
 
 @attrs.define
 class LogicalVolume(StorageUnit):
-    pass
+    stripes: Optional[int] = None
+    # In bytes
+    stripe_size: Optional[int] = None
+    # The volume is a thin pool
+    thin_pool: bool = False
+    # The volume is a thin volume in this pool
+    pool: Optional[LogicalVolume] = None
+    cache: Optional[LVCache] = None
+
+    @property
+    def stripe_geometry(self) -> Optional[StripeGeometry]:
+        if self.stripes:
+            return StripeGeometry(chunk_size=self.stripe_size, data_disks=self.stripes)
+        if self.pool:
+            return self.pool.stripe_geometry
+        return super().stripe_geometry
 
 
 @attrs.define
@@ -123,9 +255,31 @@ class CryptoVolume(StorageUnit):
     # Default value here is a workaround for attrs inheritance
     partition: Partition = None
 
+    @property
+    def discarded(self) -> bool:
+        return self.partition.discarded
+
+    @property
+    def stripe_geometry(self) -> Optional[StripeGeometry]:
+        return self.partition.stripe_geometry
+
+    @property
+    def rotational(self) -> bool:
+        return self.partition.rotational
+
+    @property
+    def supports_discard(self) -> bool:
+        return self.partition.supports_discard
+
     def open(self):
-        run_cmd(['cryptsetup', 'open', self.partition.block_device, self.id],
-                input=self.partition.crypto_passphrase.encode())
+        volume_key = self.partition.volume_key
+        if volume_key is not None:
+            # The key is known since luksFormat, no need to derive it again
+            run_cmd(['cryptsetup', 'open', '--volume-key-file', volume_key.path,
+                     self.partition.block_device, self.id])
+        else:
+            run_cmd(['cryptsetup', 'open', self.partition.block_device, self.id],
+                    input=self.partition.crypto_passphrase.encode())
         self.size = get_block_device_size(self.block_device)
 
     def close(self):
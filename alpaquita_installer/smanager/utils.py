@@ -1,11 +1,27 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
+from __future__ import annotations
+from typing import Iterable, Optional
+import ctypes
+import errno
+import logging
 import os
 import time
 
+import attrs
+
 from alpaquita_installer.common.utils import run_cmd
 
+log = logging.getLogger('smanager.utils')
+
+MNT_DETACH = 2
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                        ctypes.c_ulong, ctypes.c_char_p)
+_libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
+
 
 def get_block_device_size(device_path: str) -> int:
     res = run_cmd(['blockdev', '--getsize64', device_path])
@@ -37,3 +53,91 @@ def wait_path_created(path: str, timeout=10.0):
     if not created:
         raise RuntimeError('{}: not created in {} seconds'.format(
             path, timeout))
+
+
+def _raise_os_error(what: str, path: str):
+    err = ctypes.get_errno()
+    raise OSError(err, '{}: {}'.format(what, os.strerror(err)), path)
+
+
+def mount_fs(source: str, target: str, fs_type: str, options: Optional[str] = None):
+    """Mount a file system with the mount(2) syscall, without spawning mount(8)"""
+    log.debug("Mounting {} ({}) to '{}', options: {}".format(source, fs_type, target, options))
+    data = options.encode() if options else None
+    if _libc.mount(source.encode(), target.encode(), fs_type.encode(), 0, data) != 0:
+        _raise_os_error('Unable to mount {}'.format(source), target)
+
+
+def umount_fs(target: str, lazy: bool = False):
+    log.debug("Unmounting '{}'{}".format(target, ' lazily' if lazy else ''))
+    if _libc.umount2(target.encode(), MNT_DETACH if lazy else 0) != 0:
+        _raise_os_error('Unable to unmount', target)
+
+
+def umount_fs_with_retries(target: str, retries: int = 5, retry_interval: float = 0.2):
+    """Unmount target, retrying while it is busy and detaching it lazily as a last resort"""
+    for _ in range(retries):
+        try:
+            umount_fs(target)
+            return
+        except OSError as exc:
+            if exc.errno != errno.EBUSY:
+                raise
+        time.sleep(retry_interval)
+    log.warning("'{}' is still busy, detaching it lazily".format(target))
+    umount_fs(target, lazy=True)
+
+
+def mount_levels(mount_points: Iterable[str]) -> list[list[str]]:
+    """Split mount points into levels of the mount tree.
+
+    Every mount point is nested into the closest mount point above it, so
+    that all mount points of a level can be mounted concurrently once the
+    previous levels are mounted, and unmounted concurrently in the reverse order.
+    """
+    depths: dict[str, int] = {}
+    for mount_point in sorted(set(mount_points), key=lambda x: (x.count('/'), x)):
+        depth = 0
+        parent = mount_point
+        while parent != '/':
+            parent = os.path.dirname(parent)
+            if parent in depths:
+                depth = depths[parent] + 1
+                break
+        depths[mount_point] = depth
+
+    levels: list[list[str]] = [[] for _ in range(max(depths.values(), default=-1) + 1)]
+    for mount_point, depth in depths.items():
+        levels[depth].append(mount_point)
+    return levels
+
+
+@attrs.define(frozen=True)
+class BlockDeviceTopology:
+    logical_block_size: int = 512
+    physical_block_size: int = 512
+    # 0 if the device doesn't report it
+    optimal_io_size: int = 0
+    # Bytes the device start is off its natural alignment
+    alignment_offset: int = 0
+
+
+def _read_int(path: str, default: int) -> int:
+    try:
+        with open(path, 'r') as file:
+            return int(file.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def get_block_device_topology(device_path: str) -> BlockDeviceTopology:
+    name = os.path.basename(os.path.realpath(device_path))
+    base = os.path.join('/sys/class/block', name)
+    queue = os.path.join(base, 'queue')
+    alignment_offset = _read_int(os.path.join(base, 'alignment_offset'), 0)
+    return BlockDeviceTopology(
+        logical_block_size=_read_int(os.path.join(queue, 'logical_block_size'), 512),
+        physical_block_size=_read_int(os.path.join(queue, 'physical_block_size'), 512),
+        optimal_io_size=_read_int(os.path.join(queue, 'optimal_io_size'), 0),
+        # -1 means the device can't be aligned at all
+        alignment_offset=max(alignment_offset, 0))
@@ -8,6 +8,7 @@ from subiquitycore.ui.form import (
     SubForm,
     SubFormField,
     BooleanField,
+    ChoiceField,
     NO_HELP
 )
 
@@ -35,6 +36,10 @@ class JavaForm(SubForm):
 class LibcForm(SubForm):
     perf = BooleanField('Install musl-perf with CPU features detection and optimized asm functions',
                         help=NO_HELP)
+    allocator = ChoiceField('Memory allocator:', choices=['default', 'mimalloc', 'jemalloc'],
+                            help=('info_minor', (
+                                'An alternative allocator may speed up multi-threaded native programs. '
+                                'It is preloaded into the services and login sessions.')))
 
 
 class OtherForm(SubForm):
@@ -8,7 +8,8 @@ import attrs
 import urwid
 
 from subiquitycore.view import BaseView
-from subiquitycore.ui.form import Form, SubForm, BooleanField, ChoiceField, PasswordField, SubFormField
+from subiquitycore.ui.form import Form, SubForm, BooleanField, ChoiceField, PasswordField, SubFormField, \
+    StringField
 from subiquitycore.ui.selector import Option
 
 if TYPE_CHECKING:
@@ -32,6 +33,8 @@ class StorageForm(Form):
     ok_label = 'Next'
     cancel_label = 'Back'
 
+    disk_filter = StringField('Filter disks:', help='Part of a path, model, serial or type (hdd, ssd, nvme)')
+    disk_sort = ChoiceField('Sort disks by:', choices=['path', 'size', 'type'])
     disk = ChoiceField('Disk:', choices=['dummy'])
     file_system = ChoiceField('File system:', choices=['xfs', 'ext4'])
     use_lvm = BooleanField('Set up this disk as an LVM group')
@@ -48,6 +51,14 @@ class StorageForm(Form):
             return 'Confirm and Passphrase fields do not match'
 
 
+DISK_SORT_KEYS = {
+    'path': lambda disk: disk.path,
+    'size': lambda disk: -disk.size,
+    # The fastest media first
+    'type': lambda disk: ({'nvme': 0, 'ssd': 1, 'hdd': 2}.get(disk.media, 3), disk.path),
+}
+
+
 class StorageView(BaseView):
     title = 'Installation Destination'
     excerpt = ('info_minor', (
@@ -63,6 +74,8 @@ class StorageView(BaseView):
         self._form = StorageForm()
         self._form.use_lvm.value = data.use_lvm
         self._init_disks_list()
+        urwid.connect_signal(self._form.disk_filter.widget, 'change', self._disk_filter_change)
+        urwid.connect_signal(self._form.disk_sort.widget, 'select', self._disk_sort_change)
 
         self._form.file_system.value = data.file_system
 
@@ -97,20 +110,49 @@ class StorageView(BaseView):
 
         size = disk.size / (1024 * 1024 * 1024)
 
-        return '{}{} {:.2f} GB'.format(disk.path, model, size)
+        details = []
+        if disk.media:
+            details.append(disk.media.upper())
+        if disk.transport and disk.transport != disk.media:
+            details.append(disk.transport)
+        if disk.logical_block_size:
+            details.append('{}/{}'.format(disk.logical_block_size, disk.physical_block_size))
+        if disk.queue_depth:
+            details.append('QD {}'.format(disk.queue_depth))
+
+        return '{}{} {:.2f} GB{}'.format(disk.path, model, size,
+                                         ' [{}]'.format(', '.join(details)) if details else '')
+
+    def _init_disks_list(self, filter_text: str = '', sort_by: str = 'path'):
+        disks = sorted(self._available_disks, key=DISK_SORT_KEYS[sort_by])
+        shown = [dev for dev in disks if dev.matches(filter_text)]
+        if not shown:
+            self._form.disk_filter.help = ('info_error', 'No disks match, showing all')
+            shown = disks
+        elif filter_text:
+            self._form.disk_filter.help = '{} of {} disks shown'.format(len(shown), len(disks))
+        else:
+            self._form.disk_filter.help = self._form.disk_filter.field.help
 
-    def _init_disks_list(self):
         disk_opts = []
         dev_to_select = None
-        for dev in self._available_disks:
+        for dev in shown:
             disk_opts.append(Option((self._disk_label(dev), True, dev)))
-            if dev.path == self._selected_disk:
+            if (self._selected_disk is not None) and (dev.path == self._selected_disk.path):
                 dev_to_select = dev
         self._form.disk.widget.options = disk_opts
         if not dev_to_select:
             dev_to_select = disk_opts[0].value
         self._form.disk.widget.value = dev_to_select
 
+    def _disk_filter_change(self, sender, text: str):
+        self._selected_disk = self._form.disk.value
+        self._init_disks_list(filter_text=text, sort_by=self._form.disk_sort.value)
+
+    def _disk_sort_change(self, sender, sort_by: str):
+        self._selected_disk = self._form.disk.value
+        self._init_disks_list(filter_text=self._form.disk_filter.value, sort_by=sort_by)
+
     def done(self, sender):
         passphrase = None
         if self._form.encrypt.value:
@@ -38,3 +38,30 @@ def test_write_read_repo_file(tmp_path):
         assert read_data == data
 
     assert apk.read_repo_file() == data
+
+
+def test_add_with_cached_indexes(tmp_path, monkeypatch):
+    from alpaquita_installer.common import apk as apk_module
+    from alpaquita_installer.common.apk_index import APKIndexCache
+
+    url = 'https://packages.example.com/alpaquita/musl/stream/core'
+    index = tmp_path / 'APKINDEX.1234abcd.tar.gz'
+    index.write_bytes(b'index')
+    root_dir = tmp_path / 'root'
+    root_dir.mkdir()
+
+    commands = []
+    monkeypatch.setattr(apk_module, 'run_cmd_live', lambda args, **kwargs: commands.append(args))
+    apk = APKManager(event_receiver=StubEventReceiver())
+    apk.root_dir = str(root_dir)
+    apk.keys_dir = None
+    apk.write_repo_file(data=f'/media/disk/apks\n{url}\n')
+
+    apk.add(['musl'])
+    assert '--update-cache' in commands[-1]
+
+    apk.index_cache = APKIndexCache(str(tmp_path / 'cache'))
+    apk.index_cache.add(url, str(index))
+    apk.add(['musl'])
+    assert '--update-cache' not in commands[-1]
+    assert (root_dir / 'var/cache/apk/APKINDEX.1234abcd.tar.gz').read_bytes() == b'index'
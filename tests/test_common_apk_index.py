@@ -0,0 +1,84 @@
+#  SPDX-FileCopyrightText: 2023 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import io
+import os
+import tarfile
+import threading
+
+import pytest
+
+from alpaquita_installer.common import apk_index, utils
+from alpaquita_installer.common.apk_index import APKIndexCache, check_apk_index
+from alpaquita_installer.common.utils import validate_apk_repos
+
+URL = 'https://packages.example.com/alpaquita/musl/stream/core'
+KEY = 'alpaquita-1.rsa.pub'
+
+
+def make_index(path, key=KEY, index=b'C:Q1abc=\nP:musl\nV:1.2.4-r0\n\n'):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in ((f'.SIGN.RSA.{key}', b'signature'), ('DESCRIPTION', b'core'),
+                           ('APKINDEX', index)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_check_apk_index(tmp_path):
+    keys_dir = tmp_path / 'keys'
+    keys_dir.mkdir()
+    (keys_dir / KEY).write_text('')
+    path = str(tmp_path / 'APKINDEX.1234abcd.tar.gz')
+
+    make_index(path)
+    check_apk_index(path, url=URL, keys_dir=str(keys_dir))
+
+    make_index(path, key='other.rsa.pub')
+    with pytest.raises(ValueError, match='signed with an unknown key other.rsa.pub'):
+        check_apk_index(path, url=URL, keys_dir=str(keys_dir))
+
+    make_index(path, index=b'')
+    with pytest.raises(ValueError, match='contains no packages'):
+        check_apk_index(path, url=URL, keys_dir=str(keys_dir))
+
+    with open(path, 'wb') as file:
+        file.write(b'not an index')
+    with pytest.raises(ValueError, match='invalid index'):
+        check_apk_index(path, url=URL, keys_dir=str(keys_dir))
+
+
+def test_index_cache(tmp_path, monkeypatch):
+    path = tmp_path / 'APKINDEX.1234abcd.tar.gz'
+    make_index(str(path))
+    cache = APKIndexCache(str(tmp_path / 'cache'))
+    assert not cache.covers([URL])
+    # Local repositories are never downloaded
+    assert cache.covers(['/media/disk/apks'])
+
+    cache.add(URL, str(path))
+    assert cache.covers(['/media/disk/apks', URL])
+    cache.install(['/media/disk/apks', URL], root_dir=str(tmp_path / 'root'))
+    assert (tmp_path / 'root/var/cache/apk/APKINDEX.1234abcd.tar.gz').read_bytes() == path.read_bytes()
+
+    monkeypatch.setattr(apk_index, 'INDEX_MAX_AGE', -1)
+    assert not cache.covers([URL])
+
+
+def test_validate_apk_repos_concurrently(monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+    cache = APKIndexCache()
+
+    def validate(url, keys_dir, timeout, index_cache):
+        assert index_cache is cache
+        # Fails unless all repositories are checked at the same time
+        barrier.wait()
+        if url.endswith('bad'):
+            raise ValueError(f'{url} is bad')
+
+    monkeypatch.setattr(utils, 'validate_apk_repo', validate)
+    validate_apk_repos(['url1', 'url2', 'url3'], keys_dir='keys', timeout=5, index_cache=cache)
+
+    barrier.reset()
+    with pytest.raises(ValueError, match='url2-bad is bad'):
+        validate_apk_repos(['url1', 'url2-bad', 'url3-bad'], keys_dir='keys', timeout=5, index_cache=cache)
@@ -0,0 +1,71 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import os
+
+from alpaquita_installer.common.boot_artifacts import BootArtifacts, GRUB_CFG, initramfs_path, kernel_versions
+
+KVER = '6.1.2-0-lts'
+
+
+def make_target(root):
+    (root / 'boot/grub').mkdir(parents=True)
+    (root / 'etc/default').mkdir(parents=True)
+    (root / 'etc/default/grub').write_text('GRUB_CMDLINE_LINUX_DEFAULT=""\n')
+    (root / f'boot/vmlinuz-{KVER}').write_text('')
+
+
+def test_rebuilt_once(tmp_path):
+    make_target(tmp_path)
+    artifacts = BootArtifacts(str(tmp_path))
+    builds = []
+
+    def build(path):
+        def _build():
+            builds.append(path)
+            (tmp_path / path.lstrip('/')).write_text('built')
+        return _build
+
+    def request_all():
+        artifacts.request(initramfs_path(KVER), build(initramfs_path(KVER)))
+        artifacts.request(GRUB_CFG, build(GRUB_CFG))
+
+    # A package trigger builds both artifacts before the configuration is written
+    with artifacts.track_external_builds():
+        build(initramfs_path(KVER))()
+        build(GRUB_CFG)()
+    builds.clear()
+    assert not artifacts.is_stale(GRUB_CFG)
+
+    (tmp_path / 'etc/fstab').write_text('UUID=1 / ext4 defaults 0 1\n')
+    request_all()
+    # fstab is an input of the initramfs only
+    assert artifacts.update() == [initramfs_path(KVER)]
+    assert builds == [initramfs_path(KVER)]
+
+    builds.clear()
+    request_all()
+    assert artifacts.update() == []
+    assert not builds
+
+    # Triggers not touching the artifacts do not make them up to date
+    (tmp_path / 'etc/default/grub').write_text('GRUB_CMDLINE_LINUX_DEFAULT="quiet"\n')
+    with artifacts.track_external_builds():
+        pass
+    request_all()
+    assert artifacts.update() == [GRUB_CFG]
+
+    # A removed artifact is built again
+    os.unlink(tmp_path / 'boot/grub/grub.cfg')
+    builds.clear()
+    request_all()
+    assert artifacts.update() == [GRUB_CFG]
+    assert builds == [GRUB_CFG]
+
+
+def test_kernel_versions(tmp_path):
+    make_target(tmp_path)
+    assert kernel_versions(str(tmp_path)) == []
+    for name in ('config-6.1.2-0-lts', 'config-5.10.1-0-lts', 'config-custom', 'System.map-6.1.2-0-lts'):
+        (tmp_path / 'boot' / name).write_text('')
+    assert kernel_versions(str(tmp_path)) == ['5.10.1-0-lts', '6.1.2-0-lts']
@@ -9,11 +9,27 @@ import pytest_httpserver
 
 from alpaquita_installer.common.events import EventReceiver
 from alpaquita_installer.common.utils import (
-    run_cmd, run_cmd_live, write_file, button_width_for_label,
+    run_cmd, run_cmd_live, run_concurrently, write_file, button_width_for_label,
     validate_proxy_url, validate_apk_repo)
 from .utils import StubEventReceiver
 
 
+def test_run_concurrently():
+    receiver = StubEventReceiver()
+    done = []
+    run_concurrently([('a', lambda: done.append('a')), ('b', lambda: done.append('b'))],
+                     event_receiver=receiver)
+    assert sorted(done) == ['a', 'b']
+    assert receiver.log_lines == []
+
+    def fail(msg):
+        raise RuntimeError(msg)
+    with pytest.raises(RuntimeError, match='^first$'):
+        run_concurrently([('a', lambda: fail('first')), ('b', lambda: None), ('c', lambda: fail('second'))],
+                         event_receiver=receiver)
+    assert receiver.log_lines == ['[a] Failed: first', '[c] Failed: second']
+
+
 def test_run_cmd_timeout():
     receiver = StubEventReceiver()
     with pytest.raises(RuntimeError, match=r'(?i)did not complete'):
@@ -6,8 +6,11 @@ from typing import Optional
 import pytest
 
 from alpaquita_installer.installers.installer import InstallerException
-from alpaquita_installer.installers.bootloader import BootloaderInstaller
+from alpaquita_installer.installers.bootloader import BootloaderInstaller, native_grub_cfg, parse_grub_defaults
 from alpaquita_installer.common.utils import Arch
+from alpaquita_installer.smanager.disk import Disk
+from alpaquita_installer.smanager.file_system import FSType, Subvolume
+from alpaquita_installer.smanager.manager import StorageManager
 from .utils import new_installer
 
 
@@ -46,3 +49,83 @@ def test_added_package_non_efi():
     installer = create_installer(config={'bootloader_device': '/dev/vda'}, arch=Arch.X86_64)
     for pkg in ('grub', 'grub-bios'):
         assert pkg in installer.packages
+
+
+def test_invalid_bootloader_config():
+    with pytest.raises(ValueError, match="Unknown bootloader_config 'fast'"):
+        create_installer(config={'bootloader_config': 'fast'}, arch=Arch.X86_64, efi_mount='/boot/efi')
+
+
+def test_parse_grub_defaults():
+    assert parse_grub_defaults('''
+# comment
+GRUB_TIMEOUT=2
+GRUB_CMDLINE_LINUX_DEFAULT="modules=sd-mod quiet" # trailing comment
+export GRUB_DISTRIBUTOR='Alpaquita'
+''') == {'GRUB_TIMEOUT': '2', 'GRUB_CMDLINE_LINUX_DEFAULT': 'modules=sd-mod quiet',
+         'GRUB_DISTRIBUTOR': 'Alpaquita'}
+    for data in ('GRUB_CMDLINE_LINUX="$EXTRA"', 'if true; then', 'GRUB_X=`uname`'):
+        with pytest.raises(ValueError):
+            parse_grub_defaults(data)
+
+
+def test_native_grub_cfg(monkeypatch):
+    def init(self: Disk, manager: StorageManager, id: str):
+        super(Disk, self).__init__(manager=manager, id=id, size=10 * 1024 ** 3)
+
+    monkeypatch.setattr('alpaquita_installer.smanager.disk.Disk.__init__', init)
+    smanager = StorageManager()
+    disk = smanager.add_disk('/dev/vda')
+    boot = disk.add_partition(id='boot', size=512 * 1024 ** 2, fs_type=FSType.EXT4, mount_point='/boot')
+    crypto_part = disk.add_partition(id='crypto', fs_type=FSType.CRYPTO_PARTITION, crypto_passphrase='x')
+    root = smanager.cryptsetup.add_volume(id='root', partition=crypto_part, fs_type=FSType.XFS,
+                                          mount_point='/')
+    boot.fs_uuid = 'boot-uuid'
+    root.fs_uuid = 'root-uuid'
+
+    boot_files = ['vmlinuz-6.1.10-0-lts', 'initramfs-6.1.10-0-lts', 'vmlinuz-6.1.9-0-lts',
+                  'intel-ucode.img']
+    defaults = {'GRUB_TIMEOUT': '2', 'GRUB_DISABLE_RECOVERY': 'true',
+                'GRUB_CMDLINE_LINUX_DEFAULT': 'quiet'}
+    data = native_grub_cfg(boot_unit=boot, boot_prefix='/', root_unit=root,
+                           kvers=['6.1.9-0-lts', '6.1.10-0-lts'], boot_files=boot_files, defaults=defaults)
+    assert 'set timeout=2\n' in data
+    assert 'search --no-floppy --fs-uuid --set=root boot-uuid\n' in data
+    assert 'insmod ext2\n' in data
+    entries = data[data.index('menuentry'):]
+    assert entries == (
+        "menuentry 'Alpaquita Linux, 6.1.10-0-lts' --class alpaquita --class gnu-linux --class os {\n"
+        "  insmod gzio\n"
+        "  linux /vmlinuz-6.1.10-0-lts root=UUID=root-uuid ro quiet\n"
+        "  initrd /intel-ucode.img /initramfs-6.1.10-0-lts\n"
+        "}\n"
+        "menuentry 'Alpaquita Linux, 6.1.9-0-lts' --class alpaquita --class gnu-linux --class os {\n"
+        "  insmod gzio\n"
+        "  linux /vmlinuz-6.1.9-0-lts root=UUID=root-uuid ro quiet\n"
+        "  initrd /intel-ucode.img\n"
+        "}\n")
+
+    del defaults['GRUB_DISABLE_RECOVERY']
+    data = native_grub_cfg(boot_unit=boot, boot_prefix='/', root_unit=root,
+                           kvers=['6.1.10-0-lts'], boot_files=boot_files, defaults=defaults)
+    assert "  linux /vmlinuz-6.1.10-0-lts root=UUID=root-uuid ro single\n" in data
+
+    # / on a subvolume and /boot in the root file system
+    smanager = StorageManager()
+    root_part = smanager.add_disk('/dev/vdb').add_partition(
+        id='root2', fs_type=FSType.BTRFS, mount_point='/srv', subvolumes=[Subvolume(name='@', mount_point='/')])
+    root_part.fs_uuid = 'root2-uuid'
+    with pytest.raises(ValueError, match='btrfs subvolume'):
+        native_grub_cfg(boot_unit=root_part, boot_prefix='/boot', root_unit=root_part,
+                        kvers=['6.1.10-0-lts'], boot_files=boot_files, defaults=defaults)
+
+    # The cases grub-mkconfig handles
+    for kwargs, match in (({'boot_unit': root}, 'not on a plain partition'),
+                          ({'defaults': {'GRUB_ENABLE_CRYPTODISK': 'y'}}, 'GRUB_ENABLE_CRYPTODISK'),
+                          ({'defaults': {'GRUB_DEFAULT': 'saved'}}, 'GRUB_DEFAULT'),
+                          ({'kvers': ['6.2.0']}, 'No kernel image')):
+        args = dict(boot_unit=boot, boot_prefix='/', root_unit=root, kvers=['6.1.10-0-lts'],
+                    boot_files=boot_files, defaults={})
+        args.update(kwargs)
+        with pytest.raises(ValueError, match=match):
+            native_grub_cfg(**args)
@@ -0,0 +1,99 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import os
+
+import pytest
+
+from alpaquita_installer.installers import jdk_cds
+from alpaquita_installer.installers.installer import InstallerException
+from alpaquita_installer.installers.jdk_cds import JDKCDSInstaller, java_major_version
+from .utils import new_installer, StubEventReceiver
+
+
+def create_installer(config: dict) -> JDKCDSInstaller:
+    return new_installer(JDKCDSInstaller, config=config)
+
+
+def make_jdk(root, name, version):
+    jdk = root / 'usr/lib/jvm' / name
+    (jdk / 'bin').mkdir(parents=True)
+    (jdk / 'bin/java').write_text('')
+    (jdk / 'release').write_text(f'IMPLEMENTOR="BellSoft"\nJAVA_VERSION="{version}"\n')
+
+
+def test_no_jdk_cds():
+    installer = create_installer({})
+    installer.post_apply()
+
+
+def test_java_major_version():
+    assert java_major_version('JAVA_VERSION="1.8.0_392"\n') == 8
+    assert java_major_version('IMPLEMENTOR="BellSoft"\nJAVA_VERSION="17.0.9"\n') == 17
+    assert java_major_version('JAVA_VERSION="22"\n') == 22
+    assert java_major_version('') is None
+
+
+def test_invalid_config():
+    with pytest.raises(InstallerException):
+        create_installer({'jdk_cds': []})
+    with pytest.raises(ValueError, match="'jdk_cds/jdks'"):
+        create_installer({'jdk_cds': {'jdks': [17]}})
+    app_cds = {'jdk': 'liberica17', 'class_list': '/classes.lst', 'archive': '/app.jsa'}
+    for item in ({'class_list': 'classes.lst'}, {'archive': None}, {'classpath': 'app.jar'},
+                 {'classpath': ['app.jar']}, {'unknown': 1}):
+        with pytest.raises(ValueError, match='jdk_cds/app_cds/0'):
+            create_installer({'jdk_cds': {'app_cds': [dict(app_cds, **item)]}})
+    with pytest.raises(ValueError, match="'liberica17' is not in 'jdk_cds/jdks'"):
+        create_installer({'jdk_cds': {'jdks': ['liberica21'], 'app_cds': [app_cds]}})
+
+
+def test_dump(tmp_path, monkeypatch):
+    make_jdk(tmp_path, 'liberica8', '1.8.0_392')
+    make_jdk(tmp_path, 'liberica17', '17.0.9')
+    os.symlink('liberica17', tmp_path / 'usr/lib/jvm/default-jvm')
+    (tmp_path / 'classes.lst').write_text('java/lang/Object\n')
+
+    commands = []
+    monkeypatch.setattr(jdk_cds, 'run_cmd_live', lambda args, **kwargs: commands.append(args))
+    receiver = StubEventReceiver()
+    app_cds = {'jdk': 'liberica17', 'class_list': '/classes.lst', 'archive': '/opt/app/app.jsa',
+               'classpath': ['/opt/app/app.jar']}
+    installer = new_installer(JDKCDSInstaller, config={'jdk_cds': {'app_cds': [app_cds]}},
+                              target_root=str(tmp_path), event_receiver=receiver)
+    assert installer.installed_jdks() == ['liberica17', 'liberica8']
+    installer.post_apply()
+
+    root = str(tmp_path)
+    assert sorted(commands) == [
+        ['chroot', root, '/usr/lib/jvm/liberica17/bin/java', '-Xshare:dump'],
+        ['chroot', root, '/usr/lib/jvm/liberica17/bin/java', '-Xshare:dump',
+         '-XX:SharedClassListFile=/classes.lst', '-XX:SharedArchiveFile=/opt/app/app.jsa',
+         '-cp', '/opt/app/app.jar'],
+        ['chroot', root, '/usr/lib/jvm/liberica8/bin/java', '-Xshare:dump'],
+    ]
+    assert (tmp_path / 'opt/app').is_dir()
+    assert sorted(receiver.event_lines) == ['Generating CDS archive for liberica17',
+                                            'Generating CDS archive for liberica8']
+
+    installer = new_installer(JDKCDSInstaller, config={'jdk_cds': {'jdks': ['liberica21']}},
+                              target_root=str(tmp_path))
+    with pytest.raises(RuntimeError, match='JDKs not installed'):
+        installer.post_apply()
+
+    installer = new_installer(JDKCDSInstaller, config={'jdk_cds': {'app_cds': [dict(app_cds, jdk='liberica8')]}},
+                              target_root=str(tmp_path))
+    with pytest.raises(RuntimeError, match='AppCDS requires Java 11 or later'):
+        installer.post_apply()
+
+    def fail(args, **kwargs):
+        raise RuntimeError('{} failed'.format(args[2]))
+    monkeypatch.setattr(jdk_cds, 'run_cmd_live', fail)
+    receiver = StubEventReceiver()
+    installer = new_installer(JDKCDSInstaller, config={'jdk_cds': {}},
+                              target_root=str(tmp_path), event_receiver=receiver)
+    with pytest.raises(RuntimeError, match='failed'):
+        installer.post_apply()
+    assert sorted(receiver.log_lines) == [
+        '[liberica17] Failed: /usr/lib/jvm/liberica17/bin/java failed',
+        '[liberica8] Failed: /usr/lib/jvm/liberica8/bin/java failed']
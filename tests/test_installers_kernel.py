@@ -31,3 +31,68 @@ def test_invalid_cmdline():
 def test_added_packages():
     installer = create_installer({'kernel': {'cmdline': ['opt1', 'opt2']}})
     assert 'linux-lts' in installer.packages
+
+
+def test_initramfs_config():
+    installer = create_installer({})
+    assert 'zstd' in installer.packages
+    assert installer.dracut_conf_data() == 'compress="zstd -q -15 -T0"\n'
+
+    installer = create_installer({'kernel': {'initramfs': {'hostonly': True, 'compress': 'xz'}}})
+    assert 'xz' in installer.packages
+    assert 'hostonly="yes"\n' in installer.dracut_conf_data()
+    assert 'omit_dracutmodules+=" crypt mdraid lvm "\n' in installer.dracut_conf_data()
+
+    installer = new_installer(KernelInstaller, config={'kernel': {'initramfs': {'hostonly': True}}},
+                              storage_dracut_modules=['crypt', 'lvm'])
+    data = installer.dracut_conf_data()
+    assert 'add_dracutmodules+=" crypt lvm "\n' in data
+    assert 'omit_dracutmodules+=" mdraid "\n' in data
+
+    for initramfs, match in (({'hostonly': 'yes'}, 'kernel/initramfs/hostonly'),
+                             ({'compress': 'bzip2'}, 'Unknown initramfs compression'),
+                             (False, 'kernel/initramfs')):
+        with pytest.raises(ValueError, match=match):
+            create_installer({'kernel': {'initramfs': initramfs}})
+
+
+def test_initramfs_for_all_kernels(tmp_path, monkeypatch):
+    boot = tmp_path / 'boot'
+    boot.mkdir()
+    for name in ('config-6.1.2-0-lts', 'config-5.10.1-0-lts', 'vmlinuz-lts'):
+        (boot / name).write_text('')
+
+    installer = new_installer(KernelInstaller, config={}, target_root=str(tmp_path))
+    assert installer.kernel_versions() == ['5.10.1-0-lts', '6.1.2-0-lts']
+
+    commands = []
+    monkeypatch.setattr(installer, 'run_in_chroot', lambda args, input=None: commands.append(args))
+    installer.post_apply()
+    assert sorted(commands) == [['dracut', '-f', f'/boot/initramfs-{kver}', kver]
+                                for kver in ('5.10.1-0-lts', '6.1.2-0-lts')]
+    assert (tmp_path / 'etc/dracut.conf.d/kernel.conf').read_text() == installer.dracut_conf_data()
+
+
+def test_extra_cmdline(tmp_path, monkeypatch):
+    (tmp_path / 'boot').mkdir()
+    (tmp_path / 'boot/config-6.1.2-0-lts').write_text('')
+    (tmp_path / 'etc/default').mkdir(parents=True)
+    grub = tmp_path / 'etc/default/grub'
+    grub.write_text('GRUB_TIMEOUT=2\nGRUB_CMDLINE_LINUX_DEFAULT="quiet transparent_hugepage=never"\n')
+
+    installer = new_installer(KernelInstaller, config={}, target_root=str(tmp_path),
+                              extra_cmdline=['transparent_hugepage=always', 'hugepages=16'])
+    monkeypatch.setattr(installer, 'run_in_chroot', lambda args, input=None: None)
+    installer.post_apply()
+    assert grub.read_text() == \
+        'GRUB_TIMEOUT=2\nGRUB_CMDLINE_LINUX_DEFAULT="quiet transparent_hugepage=always hugepages=16"\n'
+
+    # Explicit kernel/cmdline arguments are kept
+    installer = new_installer(KernelInstaller,
+                              config={'kernel': {'cmdline': ['console=ttyS0', 'transparent_hugepage=never']}},
+                              target_root=str(tmp_path),
+                              extra_cmdline=['transparent_hugepage=always', 'hugepages=32'])
+    monkeypatch.setattr(installer, 'run_in_chroot', lambda args, input=None: None)
+    installer.post_apply()
+    assert grub.read_text() == \
+        'GRUB_TIMEOUT=2\nGRUB_CMDLINE_LINUX_DEFAULT="console=ttyS0 transparent_hugepage=never hugepages=32"\n'
@@ -0,0 +1,101 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import pytest
+
+from alpaquita_installer.installers.installer import InstallerException
+from alpaquita_installer.installers.libc import LibcInstaller, BENCHMARKS, BENCHMARK_RUNS
+from .utils import new_installer, StubEventReceiver
+
+
+def create_installer(config: dict, **kwargs) -> LibcInstaller:
+    return new_installer(LibcInstaller, config=config, **kwargs)
+
+
+def make_target(root, musl: bool):
+    (root / 'lib').mkdir()
+    (root / 'usr/lib').mkdir(parents=True)
+    (root / 'etc').mkdir()
+    (root / 'lib' / ('ld-musl-x86_64.so.1' if musl else 'ld-linux-x86-64.so.2')).write_text('')
+    (root / 'usr/lib/libmimalloc.so.2').write_text('')
+    (root / 'usr/lib/libmimalloc.so.2.1').write_text('')
+
+
+def test_no_libc():
+    installer = create_installer({})
+    assert installer.packages == set()
+    installer.post_apply()
+
+
+def test_invalid_config():
+    with pytest.raises(InstallerException):
+        create_installer({'libc': True})
+    for data, match in (({'perf': 'yes'}, 'libc/perf'),
+                        ({'allocator': 'tcmalloc'}, 'Unknown allocator'),
+                        ({'allocator': 1}, 'libc/allocator'),
+                        ({'benchmark': 1}, 'libc/benchmark')):
+        with pytest.raises(ValueError, match=match):
+            create_installer({'libc': data})
+
+
+def test_added_packages():
+    installer = create_installer({'libc': {'perf': True, 'allocator': 'jemalloc', 'benchmark': True}})
+    assert installer.packages == {'musl-perf', 'jemalloc', 'zstd'}
+    installer = create_installer({'libc': {'allocator': 'default'}})
+    assert installer.packages == set()
+
+
+def test_activate_musl(tmp_path):
+    make_target(tmp_path, musl=True)
+    (tmp_path / 'etc/rc.conf').write_text('rc_parallel="NO"\n')
+    installer = create_installer({'libc': {'allocator': 'mimalloc'}}, target_root=str(tmp_path))
+    assert installer.allocator_library() == '/usr/lib/libmimalloc.so.2'
+    installer.post_apply()
+    assert not (tmp_path / 'etc/profile.d').exists()
+    for _ in range(2):
+        installer.activate_allocator()
+
+    assert (tmp_path / 'etc/rc.conf').read_text() == \
+        'rc_parallel="NO"\n# Memory allocator, set by the installer\nexport LD_PRELOAD="/usr/lib/libmimalloc.so.2"\n'
+    assert '/usr/lib/libmimalloc.so.2' in (tmp_path / 'etc/profile.d/allocator.sh').read_text()
+    assert not (tmp_path / 'etc/ld.so.preload').exists()
+
+
+def test_activate_glibc(tmp_path):
+    make_target(tmp_path, musl=False)
+    installer = create_installer({'libc': {'allocator': 'mimalloc'}}, target_root=str(tmp_path))
+    installer.post_apply()
+    assert not (tmp_path / 'etc/ld.so.preload').exists()
+    for _ in range(2):
+        installer.activate_allocator()
+    assert (tmp_path / 'etc/ld.so.preload').read_text() == '/usr/lib/libmimalloc.so.2\n'
+
+    installer = create_installer({'libc': {'allocator': 'jemalloc'}}, target_root=str(tmp_path))
+    with pytest.raises(RuntimeError, match='No jemalloc library'):
+        installer.post_apply()
+
+
+def test_benchmark(tmp_path, monkeypatch):
+    make_target(tmp_path, musl=True)
+    receiver = StubEventReceiver()
+    installer = create_installer({'libc': {'allocator': 'mimalloc', 'benchmark': True}},
+                                 target_root=str(tmp_path), event_receiver=receiver)
+    commands = []
+    monkeypatch.setattr(installer, 'run_in_chroot', lambda args, input=None: commands.append(args))
+    results = installer.run_benchmark('/usr/lib/libmimalloc.so.2')
+    assert list(results) == list(BENCHMARKS)
+    assert all(list(times) == ['default', 'mimalloc'] for times in results.values())
+    assert len(commands) == 2 * len(BENCHMARKS) * BENCHMARK_RUNS
+    assert commands[0][:3] == ['env', '-u', 'LD_PRELOAD']
+    assert commands[-1][:2] == ['env', 'LD_PRELOAD=/usr/lib/libmimalloc.so.2']
+
+    monkeypatch.setattr(installer, 'run_benchmark', lambda lib: {
+        'malloc': {'default': 1.0, 'mimalloc': 0.5},
+        'threads': {'default': 1.0, 'mimalloc': 1.5},
+    })
+    installer.post_apply()
+    assert (tmp_path / 'var/log/libc-benchmark.log').read_text() == \
+        'malloc: default 1.000s, mimalloc 0.500s\nthreads: default 1.000s, mimalloc 1.500s (regression)\n'
+    assert 'Warning: mimalloc is slower than the default allocator in: threads, ' \
+           'see /var/log/libc-benchmark.log' in receiver.event_lines
+    assert not (tmp_path / 'etc/rc.conf').exists()
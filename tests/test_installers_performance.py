@@ -0,0 +1,66 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import pytest
+
+from alpaquita_installer.installers.installer import InstallerException
+from alpaquita_installer.installers.performance import PerformanceProfileInstaller, PerformanceProfile, \
+    default_profile, GiB
+from .utils import new_installer
+
+
+def create_installer(config: dict, **kwargs) -> PerformanceProfileInstaller:
+    return new_installer(PerformanceProfileInstaller, config=config, **kwargs)
+
+
+def test_no_profile():
+    installer = create_installer({})
+    assert installer.profile is None
+    assert installer.kernel_cmdline == []
+    installer.post_apply()
+
+
+def test_default_profile():
+    assert default_profile(ram=64 * GiB, cpus=32) == PerformanceProfile.CONTAINER_HOST
+    assert default_profile(ram=64 * GiB, cpus=8) == PerformanceProfile.THROUGHPUT
+    assert default_profile(ram=8 * GiB, cpus=4) == PerformanceProfile.THROUGHPUT
+    assert default_profile(ram=2 * GiB, cpus=4) == PerformanceProfile.LATENCY
+
+    installer = create_installer({'performance_profile': {}}, resources=(1 * GiB, 1))
+    assert installer.profile == PerformanceProfile.LATENCY
+
+
+def test_invalid_config():
+    with pytest.raises(InstallerException):
+        create_installer({'performance_profile': 'throughput'})
+    for data, match in (({'name': 'fast'}, 'Unknown performance profile'),
+                        ({'name': 1}, 'performance_profile/name'),
+                        ({'hugepages': -1}, 'performance_profile/hugepages'),
+                        ({'nofile': '1024'}, 'performance_profile/nofile'),
+                        ({'nofile': 0}, 'performance_profile/nofile'),
+                        ({'max_map_count': True}, 'performance_profile/max_map_count'),
+                        ({'swappiness': 201}, 'performance_profile/swappiness'),
+                        ({'transparent_hugepages': 'yes'}, 'Unknown transparent_hugepages'),
+                        ({'cpu_governor': 'turbo'}, 'Unknown cpu_governor')):
+        with pytest.raises(ValueError, match=match):
+            create_installer({'performance_profile': dict({'name': 'latency'}, **data)})
+
+
+def test_profile_files(tmp_path):
+    (tmp_path / 'etc/security').mkdir(parents=True)
+    (tmp_path / 'etc/rc.conf').write_text('rc_parallel="NO"\nrc_ulimit="-n 1024"\n')
+    installer = create_installer({'performance_profile': {'name': 'container-host', 'hugepages': 512,
+                                                          'nofile': 2097152}},
+                                 target_root=str(tmp_path))
+    assert installer.kernel_cmdline == ['transparent_hugepage=madvise', 'cpufreq.default_governor=schedutil',
+                                        'hugepagesz=2M', 'hugepages=512']
+    installer.post_apply()
+
+    sysctl = (tmp_path / 'etc/sysctl.d/60-performance-profile.conf').read_text()
+    assert 'vm.max_map_count = 1048576\n' in sysctl
+    assert 'fs.nr_open = 2097152\n' in sysctl
+    assert 'kernel.pid_max = 4194304\n' in sysctl
+    assert (tmp_path / 'etc/rc.conf').read_text() == 'rc_parallel="NO"\nrc_ulimit="-n 2097152"\n'
+    limits = (tmp_path / 'etc/security/limits.d/60-performance-profile.conf').read_text()
+    assert '* hard nofile 2097152\n' in limits
+    assert 'root soft nofile 2097152\n' in limits
@@ -32,7 +32,7 @@ def test_sh_script():
     ]}, event_receiver=receiver)
     installer.post_apply()
 
-    assert receiver.log_lines[2] == 'Command output: Hello\nShell\n'
+    assert receiver.log_lines[2:] == ['Hello', 'Shell']
 
 
 def test_python_script():
@@ -45,7 +45,68 @@ def test_python_script():
     ]}, event_receiver=receiver)
     installer.post_apply()
 
-    assert receiver.log_lines[2] == 'Command output: Hello\nPython\n'
+    assert receiver.log_lines[2:] == ['Hello', 'Python']
+
+
+def test_groups():
+    receiver = StubEventReceiver()
+
+    installer = new_installer(PostScriptsInstaller, config={'post_scripts': [
+        {'interpreter': '/bin/sh', 'chroot': False, 'group': 'a',
+         'script': 'sleep 0.5; echo first'},
+        {'interpreter': '/bin/sh', 'chroot': False,
+         'script': 'echo alone'},
+        {'interpreter': '/bin/sh', 'chroot': False, 'group': 'a',
+         'script': 'echo second'},
+    ]}, event_receiver=receiver)
+    installer.post_apply()
+
+    output = [line for line in receiver.log_lines
+              if not ('Running command' in line or 'Executing' in line)]
+    # Both scripts of the group run before the next script, concurrently
+    assert output == ['[2] second', '[0] first', 'alone']
+
+
+def test_group_failures():
+    receiver = StubEventReceiver()
+
+    installer = new_installer(PostScriptsInstaller, config={'post_scripts': [
+        {'interpreter': '/bin/sh', 'chroot': False, 'group': 'a', 'script': 'exit 3'},
+        {'interpreter': '/bin/sh', 'chroot': False, 'group': 'a', 'script': 'exit 4'},
+    ]}, event_receiver=receiver)
+    with pytest.raises(RuntimeError):
+        installer.post_apply()
+
+    failures = [line for line in receiver.log_lines if 'Failed' in line]
+    assert [line[:len('[0] Failed')] for line in failures] == ['[0] Failed', '[1] Failed']
+
+
+def test_env_and_timeout():
+    receiver = StubEventReceiver()
+
+    installer = new_installer(PostScriptsInstaller, config={'post_scripts': [
+        {'interpreter': '/bin/sh', 'chroot': False,
+         'env': {'GREETING': 'hello', 'COUNT': 2, 'FLAG': True},
+         'script': 'echo $GREETING $COUNT $FLAG'}
+    ]}, event_receiver=receiver)
+    installer.post_apply()
+    assert receiver.log_lines[-1] == 'hello 2 true'
+
+    installer = new_installer(PostScriptsInstaller, config={'post_scripts': [
+        {'interpreter': '/bin/sh', 'chroot': False, 'timeout': 0.5,
+         'script': 'sleep 10'}
+    ]}, event_receiver=receiver)
+    with pytest.raises(RuntimeError, match='did not complete in 0.5 seconds'):
+        installer.post_apply()
+
+
+def test_invalid_group_timeout_env():
+    for item in [{'group': []}, {'timeout': 0}, {'timeout': '10'}, {'timeout': True},
+                 {'env': []}, {'env': {'1A': 'x'}}, {'env': {'A': []}}]:
+        with pytest.raises(ValueError, match='post_scripts/0'):
+            create_installer({'post_scripts': [
+                dict({'interpreter': '/bin/sh', 'script': 'echo hello'}, **item),
+            ]})
 
 
 def test_valid_format_wo_chroot():
@@ -3,14 +3,21 @@
 
 from __future__ import annotations
 from typing import TYPE_CHECKING
+import errno
+import os
 
 import yaml
 import pytest
 
 from alpaquita_installer.installers.installer import InstallerException
+from alpaquita_installer.installers import storage
 from alpaquita_installer.installers.storage import StorageInstaller
 from alpaquita_installer.smanager.disk import Disk
-from .utils import new_installer
+from alpaquita_installer.smanager.lvm import parse_lv_sizes, VolumeGroup
+from alpaquita_installer.smanager.planner import DiskProperties, plan_layout
+from alpaquita_installer.smanager.raid import RAIDSyncStatus
+from alpaquita_installer.smanager.file_system import mount_data
+from .utils import new_installer, StubEventReceiver
 
 if TYPE_CHECKING:
     from alpaquita_installer.smanager.manager import StorageManager
@@ -286,9 +293,24 @@ storage:
         assert pkg in installer.packages
 
     del raid['level']
-    with pytest.raises(ValueError, match="RAID1"):
+    with pytest.raises(ValueError, match="'storage/raids/0/level'"):
         create_installer(config)
 
+    raid['level'] = 3
+    with pytest.raises(ValueError, match=r'(?i)level 3 is not supported'):
+        create_installer(config)
+
+    for level in (5, 6, 10):
+        raid['level'] = level
+        with pytest.raises(ValueError, match=f'at least . RAID{level} members'):
+            create_installer(config)
+
+    raid['level'] = 1
+    raid['chunk_size'] = '64K'
+    with pytest.raises(ValueError, match=r'(?i)chunk size'):
+        create_installer(config)
+    del raid['chunk_size']
+
     raid['level'] = 1
     del raid['members']
     with pytest.raises(ValueError, match="members"):
@@ -299,6 +321,144 @@ storage:
         create_installer(config)
 
 
+def test_striped_raids(mock_host_disks):
+    config = {'storage': {
+        'disks': [{'id': f'/dev/vd{x}',
+                   'partitions': [{'id': f'raid_vd{x}', 'fs_type': 'raid_member'}]}
+                  for x in 'abcd'],
+        'raids': [{'id': 'some_raid',
+                   'level': 0,
+                   'members': [f'raid_vd{x}' for x in 'abcd'],
+                   'partitions': [{'id': 'root', 'fs_type': 'xfs', 'mount_point': '/'}]}]}}
+    raid_item = config['storage']['raids'][0]
+
+    for level, chunk_size, data_disks, size in ((0, None, 4, 4 * DISK_SIZE),
+                                                (5, '64K', 3, 3 * DISK_SIZE),
+                                                (6, '1M', 2, 2 * DISK_SIZE),
+                                                (10, '128K', 2, 2 * DISK_SIZE)):
+        raid_item['level'] = level
+        raid_item.pop('chunk_size', None)
+        if chunk_size:
+            raid_item['chunk_size'] = chunk_size
+
+        installer = create_installer(config)
+        raid = installer._smanager.get_device_by_id('/dev/md/some_raid')
+        assert raid.size == size
+        geometry = raid.stripe_geometry
+        assert geometry.data_disks == data_disks
+
+        root = installer._unit_by_id('root')
+        root.block_device = '/dev/md127p1'
+        assert root.mkfs_args() == ['mkfs.xfs', '-f', '-d', 'su={}k,sw={}'.format(
+            geometry.chunk_size // 1024, data_disks), '/dev/md127p1']
+
+    assert installer._smanager.get_device_by_id('/dev/md/some_raid').chunk_size == 128 * 1024
+
+    for chunk_size in ('1K', '96K'):
+        raid_item['chunk_size'] = chunk_size
+        with pytest.raises(ValueError, match=r'(?i)chunk size'):
+            create_installer(config)
+
+
+def test_raid_resync_options(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: raid_vda
+      fs_type: raid_member
+  - id: /dev/vdb
+    partitions:
+    - id: raid_vdb
+      fs_type: raid_member
+  raids:
+  - id: some_raid
+    level: 1
+    members: [ raid_vda, raid_vdb ]
+    assume_clean: true
+    bitmap: internal
+    partitions:
+    - id: root
+      fs_type: ext4
+      mount_point: /
+  raid_resync_speed_limit: 10000
+    '''
+    config = yaml.safe_load(config_yaml)
+    raid_item = config['storage']['raids'][0]
+
+    installer = create_installer(config)
+    raid = installer._smanager.get_device_by_id('/dev/md/some_raid')
+    assert raid.assume_clean
+    assert raid.bitmap == 'internal'
+    assert installer._smanager.raid_resync_speed_limit == 10000
+
+    raid_item['bitmap'] = 'external'
+    with pytest.raises(ValueError, match=r'(?i)bitmap'):
+        create_installer(config)
+
+    raid_item['bitmap'] = 'none'
+    raid_item['assume_clean'] = 'yes'
+    with pytest.raises(ValueError, match="'storage/raids/0/assume_clean'"):
+        create_installer(config)
+
+    raid_item['assume_clean'] = False
+    raid_item['level'] = 0
+    for key in ('assume_clean', 'bitmap'):
+        with pytest.raises(ValueError, match=f"'storage/raids/0/{key}' is not applicable to RAID0"):
+            create_installer(config)
+        del raid_item[key]
+    create_installer(config)
+
+    raid_item['level'] = 1
+    for limit in (0, '10M'):
+        config['storage']['raid_resync_speed_limit'] = limit
+        with pytest.raises(ValueError, match=r'(?i)speed.limit'):
+            create_installer(config)
+
+
+def test_raid_sync_reports(mock_host_disks, monkeypatch):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: raid_vda
+      fs_type: raid_member
+  - id: /dev/vdb
+    partitions:
+    - id: raid_vdb
+      fs_type: raid_member
+  raids:
+  - id: some_raid
+    level: 1
+    members: [ raid_vda, raid_vdb ]
+    partitions:
+    - id: root
+      fs_type: ext4
+      mount_point: /
+    '''
+    receiver = StubEventReceiver()
+    installer = new_installer(StorageInstaller, config=yaml.safe_load(config_yaml), event_receiver=receiver)
+    progress = iter([10.0, 20.0, 30.0])
+
+    def statuses():
+        value = next(progress, None)
+        return {} if value is None else {'md127': RAIDSyncStatus(action='resync', progress=value,
+                                                                 finish='1.0min', speed='1000K/sec')}
+    monkeypatch.setattr(installer._smanager, 'raid_sync_statuses', statuses)
+    monkeypatch.setattr(storage, 'RAID_SYNC_REPORT_INTERVAL', 0.01)
+
+    installer._start_raid_sync_reports()
+    # Stops by itself when the resync is over
+    installer._raid_sync_thread.join(timeout=5)
+    installer.stop_raid_sync_reports()
+    assert receiver.event_lines == ['RAID md127: resync {}% (finish=1.0min, speed=1000K/sec)'.format(x)
+                                    for x in ('10.0', '20.0', '30.0')]
+    # Does nothing when not started or already stopped
+    installer.stop_raid_sync_reports()
+
+
 def test_volume_groups(mock_host_disks):
     config_yaml = '''
 storage:
@@ -334,6 +494,162 @@ storage:
         create_installer(config)
 
 
+def test_volume_group_lvm_commands(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: pv1
+      size: 4G
+      fs_type: physical_volume
+    - id: pv2
+      fs_type: physical_volume
+  volume_groups:
+  - id: some_vg
+    physical_volumes: [pv1, pv2]
+    logical_volumes:
+    - id: root
+      size: 2G
+      fs_type: ext4
+      mount_point: /
+    - id: home
+      fs_type: ext4
+      mount_point: /home
+    '''
+    installer = create_installer(yaml.safe_load(config_yaml))
+    pv1 = installer._unit_by_id('pv1')
+    pv2 = installer._unit_by_id('pv2')
+    pv1.block_device = '/dev/vda1'
+    pv2.block_device = '/dev/vda2'
+    assert pv1.volume_group_id == 'some_vg'
+    smanager = installer._smanager
+    vda = smanager.get_device_by_id('/dev/vda')
+    vg = smanager.get_device_by_id('some_vg')
+    assert smanager.get_child_devices(vda) == (vg,)
+    assert smanager.get_parent_devices(vg) == (vda,)
+
+    vg = installer._smanager.get_device_by_id('some_vg')
+    assert vg.lvm_commands() == [['pvcreate', '-ff', '-y', '/dev/vda1'],
+                                 ['pvcreate', '-ff', '-y', '/dev/vda2'],
+                                 ['vgcreate', 'some_vg', '/dev/vda1', '/dev/vda2'],
+                                 ['lvcreate', '-y', '-n', 'root', '--size', '2048m', 'some_vg'],
+                                 ['lvcreate', '-y', '-n', 'home', '--extents', '100%FREE', 'some_vg']]
+
+
+def test_striped_cached_and_thin_volumes(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: root
+      size: 4G
+      fs_type: ext4
+      mount_point: /
+    - id: pv1
+      fs_type: physical_volume
+  - id: /dev/vdb
+    partitions:
+    - id: pv2
+      fs_type: physical_volume
+  - id: /dev/vdc
+    partitions:
+    - id: pv3
+      fs_type: physical_volume
+  volume_groups:
+  - id: some_vg
+    physical_volumes: [pv1, pv2, pv3]
+    logical_volumes:
+    - id: data
+      size: 8G
+      fs_type: xfs
+      mount_point: /data
+      stripes: 2
+      cache:
+        mode: writeback
+        size: 1G
+        physical_volume: pv3
+    - id: pool
+      size: 1G
+      thin_pool: true
+    - id: thin
+      size: 20G
+      pool: pool
+      fs_type: ext4
+      mount_point: /thin
+    '''
+    config = yaml.safe_load(config_yaml)
+    lvs = config['storage']['volume_groups'][0]['logical_volumes']
+
+    installer = create_installer(config)
+    assert 'thin-provisioning-tools' in installer.packages
+
+    for i, pv_id in enumerate(('pv1', 'pv2', 'pv3')):
+        installer._unit_by_id(pv_id).block_device = f'/dev/vd{"abc"[i]}1'
+    vg = installer._smanager.get_device_by_id('some_vg')
+    assert vg.lvm_commands()[4:] == [
+        ['lvcreate', '-y', '-n', 'data', '--stripes', '2', '--stripesize', '64k',
+         '--size', '8192m', 'some_vg', '/dev/vda1', '/dev/vdb1'],
+        ['lvcreate', '-y', '--type', 'cache-pool', '-n', 'data_cpool', '--size', '1024m',
+         'some_vg', '/dev/vdc1'],
+        ['lvconvert', '-y', '--type', 'cache', '--cachepool', 'data_cpool',
+         '--cachemode', 'writeback', 'some_vg/data'],
+        ['lvcreate', '-y', '-n', 'pool', '--type', 'thin-pool', '--size', '1024m', 'some_vg'],
+        ['lvcreate', '-y', '-n', 'thin', '--virtualsize', '20480m', '--thinpool', 'pool', 'some_vg']]
+
+    # 8G data, 1G cache with 2 * 8M metadata, 1G pool with 2 * 4M metadata
+    assert vg.available == vg.size - 10 * GB - 24 * MB
+    assert installer._unit_by_id('thin').stripe_geometry is None
+    assert installer._unit_by_id('data').stripe_geometry.data_disks == 2
+
+    lvs[0]['stripes'] = 4
+    with pytest.raises(ValueError, match=r'(?i)4 stripes'):
+        create_installer(config)
+    lvs[0]['stripes'] = 3
+    with pytest.raises(ValueError, match=r'(?i)no physical volumes left'):
+        create_installer(config)
+    lvs[0]['stripes'] = '2'
+    with pytest.raises(ValueError, match="'storage/volume_groups/0/logical_volumes/0/stripes' must be of type"):
+        create_installer(config)
+    for stripes in (True, 0, -2):
+        lvs[0]['stripes'] = stripes
+        with pytest.raises(ValueError,
+                           match="'storage/volume_groups/0/logical_volumes/0/stripes' must be a positive integer"):
+            create_installer(config)
+    lvs[0]['stripes'] = 2
+
+    lvs[0]['cache']['mode'] = 'writearound'
+    with pytest.raises(ValueError, match="'storage/volume_groups/0/logical_volumes/0/cache'"):
+        create_installer(config)
+    lvs[0]['cache']['mode'] = 'writecache'
+
+    lvs[2]['pool'] = 'data'
+    with pytest.raises(ValueError, match=r'(?i)not a thin pool'):
+        create_installer(config)
+    lvs[2]['pool'] = 'pool'
+
+    del lvs[2]['size']
+    with pytest.raises(ValueError, match=r'(?i)size of thin volume'):
+        create_installer(config)
+
+
+def test_parse_lv_sizes():
+    data = b'''
+  {
+      "report": [
+          {
+              "lv": [
+                  {"lv_name":"home", "lv_size":"8581545984"},
+                  {"lv_name":"root", "lv_size":"2147483648"}
+              ]
+          }
+      ]
+  }
+'''
+    assert parse_lv_sizes(data) == {'home': 8581545984, 'root': 2147483648}
+
+
 def test_invalid_size(mock_host_disks):
     config_yaml = '''
 storage:
@@ -430,3 +746,514 @@ storage:
     bios_part['flags'] = ['esp']
     with pytest.raises(ValueError, match='ESP'):
         create_installer(config)
+
+
+def test_wipe(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    wipe: discard
+    partitions:
+    - id: root
+      fs_type: ext4
+      mount_point: /
+    '''
+    config = yaml.safe_load(config_yaml)
+    disk = config['storage']['disks'][0]
+
+    for wipe in ('zero-headers', 'discard', 'secure'):
+        disk['wipe'] = wipe
+        installer = create_installer(config)
+        vda = installer._smanager.get_device_by_id('/dev/vda')
+        assert str(vda.wipe_method) == wipe
+
+    disk['wipe'] = 'unknown'
+    with pytest.raises(ValueError, match="storage/disks/0/wipe: Unknown wipe method 'unknown', "
+                                         "supported: zero-headers, discard, secure"):
+        create_installer(config)
+
+    disk['wipe'] = ['discard']
+    with pytest.raises(ValueError, match="'storage/disks/0/wipe'"):
+        create_installer(config)
+
+    del disk['wipe']
+    config['storage']['disks'].append({'id': '/dev/vdb', 'wipe': 'unknown'})
+    with pytest.raises(ValueError, match='^storage/disks/1/wipe: Unknown wipe method'):
+        create_installer(config)
+
+
+def test_mkfs_args_on_discarded_disk(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: boot
+      size: 512M
+      fs_type: ext4
+      mount_point: /boot
+    - id: root
+      fs_type: xfs
+      mount_point: /
+    '''
+    installer = create_installer(yaml.safe_load(config_yaml))
+    vda = installer._smanager.get_device_by_id('/dev/vda')
+    boot, root = vda.partitions
+    boot.block_device = '/dev/vda1'
+    root.block_device = '/dev/vda2'
+
+    assert boot.mkfs_args() == ['mkfs.ext4', '-F', '/dev/vda1']
+    assert root.mkfs_args() == ['mkfs.xfs', '-f', '/dev/vda2']
+
+    vda._discarded = True
+    assert boot.mkfs_args() == ['mkfs.ext4', '-F', '-E', 'nodiscard', '/dev/vda1']
+    assert root.mkfs_args() == ['mkfs.xfs', '-f', '-K', '/dev/vda2']
+
+
+def test_crypto_params(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: boot
+      size: 512M
+      fs_type: ext4
+      mount_point: /boot
+    - id: crypto_part
+      fs_type: crypto_partition
+      crypto_passphrase: super-secret
+      crypto:
+        pbkdf: argon2id
+        pbkdf_memory: 65536
+        pbkdf_iterations: 4
+        sector_size: 4096
+  crypto_volumes:
+  - id: root
+    on_partition: crypto_part
+    fs_type: ext4
+    mount_point: /
+    '''
+    config = yaml.safe_load(config_yaml)
+    crypto = config['storage']['disks'][0]['partitions'][1]['crypto']
+
+    installer = create_installer(config)
+    part = installer._unit_by_id('crypto_part')
+    assert part.crypto_params.format_args() == ['--key-size', '512',
+                                                '--pbkdf', 'argon2id',
+                                                '--pbkdf-memory', '65536',
+                                                '--pbkdf-force-iterations', '4',
+                                                '--sector-size', '4096']
+    assert part.crypto_params.to_dict() == dict(crypto, key_size=512)
+
+    for key, value in (('pbkdf', 'scrypt'), ('sector_size', 300),
+                       ('pbkdf_memory', -1), ('key_size', 13),
+                       ('iter_time', 1000), ('unknown_key', 1)):
+        invalid = dict(crypto)
+        invalid[key] = value
+        config['storage']['disks'][0]['partitions'][1]['crypto'] = invalid
+        with pytest.raises(ValueError, match="'crypto'"):
+            create_installer(config)
+
+    config['storage']['disks'][0]['partitions'][1]['crypto'] = crypto
+    config['storage']['disks'][0]['partitions'][0]['crypto'] = crypto
+    with pytest.raises(ValueError, match=r'(?i)non crypto partition'):
+        create_installer(config)
+
+
+def test_mkfs_profile_and_opts(mock_host_disks):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: boot
+      size: 512M
+      fs_type: ext4
+      mount_point: /boot
+      mkfs_profile: fast-create
+      mkfs_opts: ['-L', 'boot']
+    - id: root
+      fs_type: xfs
+      mount_point: /
+      mkfs_profile: database
+    '''
+    config = yaml.safe_load(config_yaml)
+    boot_item, root_item = config['storage']['disks'][0]['partitions']
+
+    installer = create_installer(config)
+    vda = installer._smanager.get_device_by_id('/dev/vda')
+    boot, root = vda.partitions
+    boot.block_device = '/dev/vda1'
+    root.block_device = '/dev/vda2'
+
+    assert boot.mkfs_args() == ['mkfs.ext4', '-F', '-E', 'lazy_itable_init=1,lazy_journal_init=1,nodiscard',
+                                '-L', 'boot', '/dev/vda1']
+    assert root.mkfs_args() == ['mkfs.xfs', '-f', '-l', 'size=128m', '/dev/vda2']
+
+    # Not added twice
+    vda._discarded = True
+    assert boot.mkfs_args() == ['mkfs.ext4', '-F', '-E', 'lazy_itable_init=1,lazy_journal_init=1,nodiscard',
+                                '-L', 'boot', '/dev/vda1']
+
+    root_item['mkfs_profile'] = 'unknown'
+    with pytest.raises(ValueError, match=r'(?i)unknown mkfs profile'):
+        create_installer(config)
+
+    root_item['mkfs_profile'] = 'many-small-files'
+    root_item['fs_type'] = 'vfat'
+    with pytest.raises(ValueError, match=r'(?i)only on ext4 and xfs'):
+        create_installer(config)
+
+    root_item['fs_type'] = 'xfs'
+    boot_item['mkfs_opts'] = '-L boot'
+    with pytest.raises(ValueError, match="'mkfs_opts'"):
+        create_installer(config)
+
+
+def test_parse_1000_units(mock_host_disks, monkeypatch):
+    # Lookups by id and mount point must not make parsing of a JBOD-like
+    # layout quadratic in the number of units: scans of all units are counted.
+    from alpaquita_installer.smanager.manager import StorageManager
+
+    scans = []
+    all_units = StorageManager.storage_units.fget
+
+    def count_scans(self):
+        scans.append(1)
+        return all_units(self)
+    monkeypatch.setattr(StorageManager, 'storage_units', property(count_scans))
+
+    disks_count = 100
+    parts_per_disk = 10
+    disks = []
+    for i in range(disks_count):
+        parts = [{'id': f'data{i}_{j}', 'size': '512M', 'fs_type': 'xfs',
+                  'mount_point': f'/srv/disk{i}/part{j}'} for j in range(parts_per_disk)]
+        disks.append({'id': f'/dev/disk{i}', 'partitions': parts})
+    disks[0]['partitions'][-1]['mount_point'] = '/'
+    config = {'storage': {'disks': disks}}
+
+    installer = create_installer(config)
+    assert len(scans) <= disks_count, f'{len(scans)} scans of all units'
+
+    smanager = installer._smanager
+    assert len(smanager.storage_units) == disks_count * parts_per_disk
+    assert smanager.get_unit_by_mount_point('/srv/disk99/part9').id == 'data99_9'
+    assert smanager.get_device_by_id('/dev/disk42').get_unit_by_id('data42_3').size == 512 * MB
+
+
+def test_mount_and_unmount(mock_host_disks, monkeypatch, tmp_path):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: root
+      size: 2G
+      fs_type: ext4
+      mount_point: /
+    - id: var
+      size: 2G
+      fs_type: xfs
+      mount_point: /var
+    - id: log
+      size: 2G
+      fs_type: xfs
+      mount_point: /var/log
+    - id: home
+      fs_type: ext4
+      mount_point: /home
+    '''
+    installer = create_installer(yaml.safe_load(config_yaml))
+    smanager = installer._smanager
+    smanager.mount_root_base = str(tmp_path)
+    for i, unit in enumerate(smanager.storage_units, start=1):
+        unit.block_device = '/dev/vda{}'.format(i)
+
+    mounted = []
+
+    def mount_fs(source: str, target: str, fs_type: str, options=None):
+        assert os.path.isdir(target)
+        assert (not mounted) or (os.path.dirname(target) in mounted) or (target == str(tmp_path))
+        if target.endswith('/log'):
+            raise OSError(errno.EIO, 'I/O error', target)
+        mounted.append(target.rstrip('/'))
+
+    def umount_fs(target: str, lazy: bool = False):
+        mounted.remove(target.rstrip('/'))
+
+    monkeypatch.setattr('alpaquita_installer.smanager.manager.mount_fs', mount_fs)
+    monkeypatch.setattr('alpaquita_installer.smanager.utils.umount_fs', umount_fs)
+    with pytest.raises(OSError):
+        smanager.mount()
+    assert sorted(mounted) == sorted([str(tmp_path), str(tmp_path / 'var'), str(tmp_path / 'home')])
+
+    # Only what was mounted is unmounted
+    smanager.unmount()
+    assert mounted == []
+
+
+def _disk_properties(name: str, rotational: bool, size: int = DISK_SIZE, **kwargs) -> DiskProperties:
+    args = dict(name=name, size=size, rotational=rotational,
+                transport='nvme' if name.startswith('nvme') else 'sata',
+                discard=not rotational, optimal_io_size=0, logical_block_size=512,
+                physical_block_size=4096, queue_depth=32, numa_node=None,
+                removable=False, read_only=False)
+    args.update(kwargs)
+    return DiskProperties(**args)
+
+
+def test_plan_layout(mock_host_disks):
+    disks = [_disk_properties('sda', rotational=True),
+             _disk_properties('sdb', rotational=True),
+             _disk_properties('nvme0n1', rotational=False),
+             _disk_properties('sdc', rotational=False)]
+    config = plan_layout(disks, efi=False, swap_size=GB)
+    assert config['bootloader_device'] == '/dev/nvme0n1'
+
+    disk_entries = {d['id']: d for d in config['storage']['disks']}
+    nvme = disk_entries['/dev/nvme0n1']
+    assert nvme['wipe'] == 'discard'
+    assert [p['id'] for p in nvme['partitions']] == ['bios_boot', 'boot', 'swap', 'root']
+    assert 'wipe' not in disk_entries['/dev/sda']
+
+    # The proposal is a valid storage configuration
+    installer = create_installer(config)
+    smanager = installer._smanager
+    assert smanager.get_unit_by_mount_point('/').storage_device.id == '/dev/nvme0n1'
+    data_vg = smanager.get_device_by_id('data_vg')
+    assert isinstance(data_vg, VolumeGroup)
+    assert {pv.storage_device.id for pv in data_vg.physical_volumes} == {'/dev/sda', '/dev/sdb', '/dev/sdc'}
+    assert smanager.get_unit_by_mount_point('/srv').id == 'data'
+
+    # A probed throughput wins over the media type
+    disks[0].throughput = 500.0 * MB
+    disks[2].throughput = 300.0 * MB
+    config = plan_layout(disks[:3], efi=True)
+    assert 'bootloader_device' not in config
+    assert [p['id'] for p in config['storage']['disks'][0]['partitions']] == ['efi', 'boot', 'root']
+    assert config['storage']['disks'][0]['id'] == '/dev/sda'
+
+    with pytest.raises(ValueError, match='No disk'):
+        plan_layout([_disk_properties('sda', rotational=True, size=GB)], efi=True)
+
+
+def test_plan_storage_cli_swap(monkeypatch, capsys):
+    from alpaquita_installer.app import application
+    from alpaquita_installer.smanager import planner
+
+    disks = [_disk_properties('sda', rotational=True), _disk_properties('nvme0n1', rotational=False)]
+    monkeypatch.setattr(planner, 'scan_disks', lambda: disks)
+    monkeypatch.setattr(planner, '_mounted_disks', lambda: set())
+    monkeypatch.setattr(application.Application, 'is_efi', lambda self: False)
+    monkeypatch.setattr('sys.argv', ['alpaquita_installer', '--plan-storage', '--plan-swap', '1G'])
+    with pytest.raises(SystemExit) as exc_info:
+        application.Application()
+    assert exc_info.value.code == 0
+
+    config = yaml.safe_load(capsys.readouterr().out)
+    disk_entries = {d['id']: d for d in config['storage']['disks']}
+    swap = [p for p in disk_entries['/dev/nvme0n1']['partitions'] if p['id'] == 'swap']
+    assert swap == [{'id': 'swap', 'size': GB, 'fs_type': 'swap'}]
+
+    monkeypatch.setattr('sys.argv', ['alpaquita_installer', '--plan-swap', '1G'])
+    with pytest.raises(SystemExit) as exc_info:
+        application.Application()
+    assert exc_info.value.code != 0
+
+
+def test_btrfs_and_f2fs(mock_host_disks, tmp_path):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: boot
+      size: 1G
+      fs_type: ext4
+      mount_point: /boot
+    - id: root
+      size: 4G
+      fs_type: btrfs
+      fs_opts: [ 'compress=zstd', 'noatime' ]
+      mount_point: /
+      subvolumes:
+      - name: home
+        mount_point: /home
+      - name: snapshots
+    - id: data
+      fs_type: f2fs
+      fs_opts: [ 'compress_algorithm=zstd' ]
+      mount_point: /srv
+    '''
+    config = yaml.safe_load(config_yaml)
+    installer = create_installer(config)
+    for pkg in ('btrfs-progs', 'f2fs-tools', 'e2fsprogs'):
+        assert pkg in installer.packages
+
+    root = installer._unit_by_id('root')
+    data = installer._unit_by_id('data')
+    root.block_device = '/dev/vda2'
+    data.block_device = '/dev/vda3'
+    assert root.mkfs_args() == ['mkfs.btrfs', '-f', '/dev/vda2']
+    assert data.mkfs_args() == ['mkfs.f2fs', '-f', '-O', 'extra_attr,compression', '/dev/vda3']
+    root.storage_device._discarded = True
+    assert root.mkfs_args() == ['mkfs.btrfs', '-f', '-K', '/dev/vda2']
+    assert data.mkfs_args()[:4] == ['mkfs.f2fs', '-f', '-t', '0']
+
+    smanager = installer._smanager
+    assert smanager.get_unit_by_mount_point('/home') is root
+    assert root.mount_opts('/home') == ['subvol=home', 'compress=zstd', 'noatime']
+    assert mount_data(root.fs_type, root.mount_opts('/home')) == 'compress=zstd,subvol=home'
+    assert mount_data(root.fs_type, root.mount_opts('/')) == 'compress=zstd'
+    assert mount_data(data.fs_type, data.fs_opts) == 'compress_algorithm=zstd'
+
+    for i, unit in enumerate(smanager.storage_units):
+        unit.fs_uuid = 'uuid{}'.format(i)
+    fstab = tmp_path / 'fstab'
+    smanager.write_fstab(str(fstab))
+    assert fstab.read_text().splitlines() == [
+        'UUID=uuid1 / btrfs compress=zstd,noatime 0 0',
+        'UUID=uuid0 /boot ext4 defaults 0 2',
+        'UUID=uuid1 /home btrfs subvol=home,compress=zstd,noatime 0 0',
+        'UUID=uuid2 /srv f2fs compress_algorithm=zstd 0 2',
+    ]
+
+    installer = new_installer(StorageInstaller, config=config, target_root=str(tmp_path))
+    installer._write_dracut_conf()
+    assert (tmp_path / 'etc/dracut.conf.d/storage.conf').read_text() == \
+        'filesystems+=" btrfs f2fs "\nadd_dracutmodules+=" btrfs "\n'
+
+    # Subvolumes are btrfs only, their mount points are unique
+    for fs_type, subvolumes, match in (
+            ('xfs', [{'name': 'home'}], 'only on btrfs'),
+            ('btrfs', [{'name': 'home', 'mount_point': '/boot'}], "'/boot' is already defined"),
+            ('btrfs', [{'name': 'a'}, {'name': 'a'}], 'duplicate subvolume'),
+            ('btrfs', [{'name': 'a/b'}], 'Invalid subvolume name')):
+        config = yaml.safe_load(config_yaml)
+        root_item = config['storage']['disks'][0]['partitions'][1]
+        root_item['fs_type'] = fs_type
+        root_item['subvolumes'] = subvolumes
+        with pytest.raises(ValueError, match=match):
+            create_installer(config)
+
+    # GRUB doesn't read compressed f2fs
+    config = yaml.safe_load(config_yaml)
+    config['storage']['disks'][0]['partitions'][2]['mount_point'] = '/boot'
+    config['storage']['disks'][0]['partitions'][0]['mount_point'] = '/mnt'
+    with pytest.raises(ValueError, match='GRUB'):
+        create_installer(config)
+
+
+def test_swap_priorities(mock_host_disks, tmp_path):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: swap
+      size: 1G
+      fs_type: swap
+      fs_opts: [ 'pri=10' ]
+    - id: root
+      fs_type: ext4
+      mount_point: /
+    '''
+    installer = create_installer(yaml.safe_load(config_yaml))
+    assert installer.swap_priorities == [10]
+
+    smanager = installer._smanager
+    for unit in smanager.storage_units:
+        unit.fs_uuid = unit.id
+    fstab = tmp_path / 'fstab'
+    smanager.write_fstab(str(fstab))
+    assert fstab.read_text().splitlines() == [
+        'UUID=root / ext4 defaults 0 1',
+        'UUID=swap none swap pri=10 0 0',
+    ]
+
+
+def test_mount_profiles(mock_host_disks, tmp_path):
+    config_yaml = '''
+storage:
+  disks:
+  - id: /dev/vda
+    partitions:
+    - id: boot
+      size: 1G
+      fs_type: ext4
+      mount_point: /boot
+      mount_profile: general
+    - id: root
+      size: 4G
+      fs_type: xfs
+      fs_opts: [ 'relatime' ]
+      mount_point: /
+      mount_profile: throughput
+    - id: data
+      fs_type: btrfs
+      mount_point: /srv
+      mount_profile: throughput
+  tmp_on_tmpfs: true
+  tmp_size: 25%
+    '''
+    config = yaml.safe_load(config_yaml)
+    installer = create_installer(config)
+    smanager = installer._smanager
+    root = installer._unit_by_id('root')
+    data = installer._unit_by_id('data')
+
+    # fs_opts override the profile options of the same kind
+    assert root.mount_opts('/') == ['lazytime', 'logbsize=256k', 'inode64', 'relatime']
+    assert data.mount_opts('/srv') == ['noatime', 'lazytime', 'commit=60']
+
+    disk = data.storage_device
+    disk.properties = DiskProperties(name='vda', size=DISK_SIZE, rotational=False, transport='nvme',
+                                     discard=True, optimal_io_size=0, logical_block_size=512,
+                                     physical_block_size=512, queue_depth=None, numa_node=None,
+                                     removable=False, read_only=False)
+    assert data.mount_opts('/srv') == ['noatime', 'lazytime', 'commit=60', 'ssd', 'discard=async']
+    assert root.mount_opts('/') == ['lazytime', 'logbsize=256k', 'inode64', 'relatime']
+
+    for i, unit in enumerate(smanager.storage_units):
+        unit.fs_uuid = 'uuid{}'.format(i)
+    fstab = tmp_path / 'fstab'
+    smanager.write_fstab(str(fstab))
+    assert fstab.read_text().splitlines() == [
+        'UUID=uuid1 / xfs lazytime,logbsize=256k,inode64,relatime 0 1',
+        'UUID=uuid0 /boot ext4 lazytime 0 2',
+        'UUID=uuid2 /srv btrfs noatime,lazytime,commit=60,ssd,discard=async 0 0',
+        'tmpfs /tmp tmpfs mode=1777,nosuid,nodev,size=25% 0 0',
+    ]
+
+    # Options and profiles are checked against the file system
+    for fs_type, key, value, match in (
+            ('ext4', 'fs_opts', ['logbsize=256k'], "'logbsize=256k' is not supported on ext4"),
+            ('xfs', 'fs_opts', ['discard=async'], "'discard=async' is not supported on xfs"),
+            ('vfat', 'mount_profile', 'general', 'supported only on ext4, xfs, btrfs and f2fs'),
+            ('ext4', 'mount_profile', 'fast', 'Unknown mount profile')):
+        config = yaml.safe_load(config_yaml)
+        root_item = config['storage']['disks'][0]['partitions'][1]
+        root_item['fs_type'] = fs_type
+        root_item.pop('fs_opts')
+        root_item.pop('mount_profile')
+        root_item[key] = value
+        with pytest.raises(ValueError, match=match):
+            create_installer(config)
+
+    config = yaml.safe_load(config_yaml)
+    config['storage']['disks'][0]['partitions'][2]['mount_point'] = '/tmp'
+    with pytest.raises(ValueError, match="'/tmp' is already defined"):
+        create_installer(config)
+
+    config = yaml.safe_load(config_yaml)
+    config['storage']['tmp_size'] = '2G'
+    assert create_installer(config)._smanager.tmp_size == str(2 * GB)
+    config['storage']['tmp_size'] = '150%'
+    with pytest.raises(ValueError, match='Invalid tmpfs size'):
+        create_installer(config)
+    del config['storage']['tmp_on_tmpfs']
+    with pytest.raises(ValueError, match="without 'tmp_on_tmpfs'"):
+        create_installer(config)
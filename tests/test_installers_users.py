@@ -1,8 +1,11 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
+import os
+
 import pytest
 
+from alpaquita_installer.installers.accounts import AccountsDB, days_since_epoch
 from alpaquita_installer.installers.installer import InstallerException
 from alpaquita_installer.installers.users import UsersInstaller
 from .utils import new_installer
@@ -47,3 +50,130 @@ def test_admin_user():
     installer = create_installer({'users': [{'name': 'user', 'password': 'password_hash',
                                              'is_admin': True}]})
     assert 'sudo' in installer.packages
+
+
+def make_etc(root):
+    etc = root / 'etc'
+    (etc / 'sudoers.d').mkdir(parents=True)
+    (etc / 'skel').mkdir()
+    (etc / 'skel/.profile').write_text('export EDITOR=vi\n')
+    (etc / 'passwd').write_text('root:x:0:0:root:/root:/bin/sh\n'
+                                'guest:x:1000:1001:guest:/home/guest:/sbin/nologin\n')
+    (etc / 'shadow').write_text('root:*:19000:0:::::\nguest:!:19000:0:99999:7:::\n')
+    (etc / 'group').write_text('root:x:0:root\nwheel:x:10:root\nusers:x:100:\nguest:x:1001:\n')
+    os.chmod(etc / 'shadow', 0o640)
+    return etc
+
+
+def test_apply(tmp_path):
+    etc = make_etc(tmp_path)
+    installer = new_installer(UsersInstaller, target_root=str(tmp_path), config={'users': [
+        {'name': 'admin', 'password': 'hash1', 'gecos': 'Admin', 'is_admin': True},
+        {'name': 'user', 'password': 'hash2'},
+    ]})
+    installer.apply()
+
+    # GID 1001 is taken, so the first free one goes to the group of admin
+    today = str(days_since_epoch())
+    assert (etc / 'passwd').read_text().splitlines()[2:] == [
+        'admin:x:1001:1000:Admin:/home/admin:/bin/sh',
+        'user:x:1002:1002::/home/user:/bin/sh',
+    ]
+    assert (etc / 'shadow').read_text().splitlines() == [
+        f'root:!:{today}:0:::::',
+        'guest:!:19000:0:99999:7:::',
+        f'admin:hash1:{today}:0:99999:7:::',
+        f'user:hash2:{today}:0:99999:7:::',
+    ]
+    assert (etc / 'group').read_text().splitlines() == [
+        'root:x:0:root', 'wheel:x:10:root,admin', 'users:x:100:', 'guest:x:1001:',
+        'admin:x:1000:', 'user:x:1002:']
+    assert os.stat(etc / 'shadow').st_mode & 0o777 == 0o640
+
+    home = tmp_path / 'home/admin'
+    assert (home / '.profile').read_text() == 'export EDITOR=vi\n'
+    assert (os.stat(home).st_uid, os.stat(home / '.profile').st_gid) == (1001, 1000)
+
+
+def test_accounts_ids(tmp_path):
+    etc = make_etc(tmp_path)
+    accounts = AccountsDB(str(etc))
+    # The same GID as UID if it's free
+    assert accounts.add_user('a', uid=2000) == (2000, 2000)
+    with pytest.raises(ValueError, match='UID 2000 is already used'):
+        accounts.add_user('b', uid=2000)
+    with pytest.raises(ValueError, match="User 'a' already exists"):
+        accounts.add_user('a')
+    with pytest.raises(RuntimeError, match="No 'nogroup'"):
+        accounts.add_to_group('a', 'nogroup')
+
+
+def test_home_outside_target(tmp_path):
+    root = tmp_path / 'root'
+    etc = make_etc(root)
+    accounts = AccountsDB(str(etc))
+    # AccountsDB is also used without UserModel validation
+    accounts.add_user('a', home='/../../../tmp/escaped_home')
+    with pytest.raises(ValueError, match='outside of the target root'):
+        accounts.create_home('a', skel=str(etc / 'skel'))
+    with pytest.raises(ValueError, match='outside of the target root'):
+        accounts.write_authorized_keys('a', ['ssh-ed25519 AAAA'])
+    assert os.listdir(tmp_path) == ['root']
+
+
+def test_account_fields(tmp_path):
+    etc = make_etc(tmp_path)
+    key = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIE admin@example.com'
+    installer = new_installer(UsersInstaller, target_root=str(tmp_path), config={'users': [
+        {'name': 'admin', 'password': 'hash1', 'is_admin': True, 'shell': '/bin/bash', 'uid': 1500,
+         'home': '/srv/admin', 'groups': ['users', 'operators'], 'ssh_authorized_keys': [key]},
+    ]})
+    installer.apply()
+
+    assert (etc / 'passwd').read_text().splitlines()[-1] == 'admin:x:1500:1500::/srv/admin:/bin/bash'
+    assert (etc / 'group').read_text().splitlines() == [
+        'root:x:0:root', 'wheel:x:10:root,admin', 'users:x:100:admin', 'guest:x:1001:',
+        'admin:x:1500:', 'operators:x:1000:admin']
+
+    ssh_dir = tmp_path / 'srv/admin/.ssh'
+    assert (ssh_dir / 'authorized_keys').read_text() == key + '\n'
+    for path, mode in ((ssh_dir, 0o700), (ssh_dir / 'authorized_keys', 0o600)):
+        st = os.stat(path)
+        assert (st.st_mode & 0o777, st.st_uid, st.st_gid) == (mode, 1500, 1500)
+
+
+def test_existing_home(tmp_path):
+    root = tmp_path / 'home_under_home'
+    make_etc(root)
+    (root / 'home/user').mkdir(parents=True)
+    installer = new_installer(UsersInstaller, target_root=str(root), config={'users': [
+        {'name': 'user', 'password': 'hash1', 'uid': 1500},
+    ]})
+    installer.apply()
+    # E.g. a mount point, only the directory itself is given to the user
+    assert os.stat(root / 'home/user').st_uid == 1500
+    assert not os.path.exists(root / 'home/user/.profile')
+
+    root = tmp_path / 'home_elsewhere'
+    make_etc(root)
+    (root / 'srv').mkdir()
+    installer = new_installer(UsersInstaller, target_root=str(root), config={'users': [
+        {'name': 'user', 'password': 'hash1', 'uid': 1500, 'home': '/srv'},
+    ]})
+    with pytest.raises(ValueError, match="'/srv' of user 'user' already exists outside /home"):
+        installer.apply()
+    assert os.stat(root / 'srv').st_uid == os.getuid()
+
+
+def test_invalid_account_fields():
+    base = {'name': 'user', 'password': 'password_hash'}
+    for extra in ({'shell': 'bash'}, {'shell': False}, {'uid': 0}, {'uid': True}, {'uid': '1000'},
+                  {'home': 'home/user'}, {'home': '/../../../tmp/escaped_home'}, {'home': '/home/../etc'},
+                  {'home': '/home/user/'}, {'shell': '/bin/../../bin/sh'},
+                  {'groups': 'wheel'}, {'groups': ['Bad Group']},
+                  {'ssh_authorized_keys': 'ssh-ed25519 AAAA'}, {'ssh_authorized_keys': ['a\nb']}):
+        with pytest.raises(InstallerException):
+            create_installer({'users': [dict(base, **extra)]})
+
+    with pytest.raises(InstallerException, match="Duplicate 'uid'"):
+        create_installer({'users': [dict(base, uid=2000), dict(base, name='user2', uid=2000)]})
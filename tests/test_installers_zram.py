@@ -0,0 +1,62 @@
+#  SPDX-FileCopyrightText: 2022 BellSoft
+#  SPDX-License-Identifier:  AGPL-3.0-or-later
+
+import pytest
+
+from alpaquita_installer.installers.installer import InstallerException
+from alpaquita_installer.installers.zram import ZramInstaller
+from .utils import new_installer
+
+
+def create_installer(config: dict, **kwargs) -> ZramInstaller:
+    return new_installer(ZramInstaller, config=config, **kwargs)
+
+
+def test_no_zram():
+    installer = create_installer({})
+    assert not installer.packages
+
+
+def test_invalid_zram_type():
+    with pytest.raises(InstallerException):
+        create_installer({'zram': False})
+
+
+def test_defaults():
+    installer = create_installer({'zram': {}})
+    assert 'zram-init' in installer.packages
+    data = installer.conf_data()
+    assert 'type0=swap\n' in data
+    assert 'algo0=zstd\n' in data
+    assert 'flag0=100\n' in data
+    assert "size0=$(( $(awk '/^MemTotal:/ { print $2 }' /proc/meminfo) * 50 / 100 / 1024 ))\n" in data
+
+
+def test_size():
+    assert 'size0=2048\n' in create_installer({'zram': {'size': '2G'}}).conf_data()
+    assert '* 150 / 100' in create_installer({'zram': {'size': '150%'}}).conf_data()
+    for size, match in (('0%', 'between'), ('300%', 'between'), ('X', 'zram/size'),
+                        ('10K', 'less than 1M')):
+        with pytest.raises(ValueError, match=match):
+            create_installer({'zram': {'size': size}})
+
+
+def test_algorithm():
+    assert 'algo0=lz4\n' in create_installer({'zram': {'algorithm': 'lz4'}}).conf_data()
+    with pytest.raises(ValueError, match='Unknown zram compression algorithm'):
+        create_installer({'zram': {'algorithm': 'gzip'}})
+
+
+def test_priority():
+    installer = create_installer({'zram': {}}, disk_swap_priorities=[5, 200])
+    assert 'flag0=201\n' in installer.conf_data()
+
+    installer = create_installer({'zram': {'priority': 10}}, disk_swap_priorities=[5])
+    assert 'flag0=10\n' in installer.conf_data()
+
+    with pytest.raises(ValueError, match='must be higher than priority 10'):
+        create_installer({'zram': {'priority': 10}}, disk_swap_priorities=[10])
+    with pytest.raises(ValueError, match="'zram/priority'"):
+        create_installer({'zram': {'priority': 'high'}})
+    with pytest.raises(ValueError, match='must not exceed'):
+        create_installer({'zram': {'priority': 40000}})
@@ -1,6 +1,7 @@
 #  SPDX-FileCopyrightText: 2022 BellSoft
 #  SPDX-License-Identifier:  AGPL-3.0-or-later
 
+import errno
 import os
 
 import pytest
@@ -8,6 +9,11 @@ import pytest
 from alpaquita_installer.common.utils import run_cmd
 from alpaquita_installer.smanager.manager import StorageManager
 from alpaquita_installer.smanager.file_system import FSType
+from alpaquita_installer.smanager.raid import parse_mdstat
+from alpaquita_installer.smanager.planner import read_disk_properties, scan_disks
+from alpaquita_installer.smanager.storage_device import alignment_grain, partition_layout
+from alpaquita_installer.smanager.utils import BlockDeviceTopology
+from alpaquita_installer.smanager.utils import mount_levels, umount_fs_with_retries
 
 MB = 1024 * 1024
 
@@ -45,3 +51,155 @@ def test_create_filesystems(test_disk):
 
             for part in disk.partitions:
                 run_cmd(args=['rm', part.block_device])
+
+
+def test_parse_mdstat():
+    data = '''Personalities : [raid1] [raid0]
+md126 : active raid0 vdd1[1] vdc1[0]
+      20953088 blocks super 1.2 512k chunks
+
+md127 : active raid1 vdb1[1] vda1[0]
+      10476544 blocks super 1.2 [2/2] [UU]
+      [=>...................]  resync =  8.7% (916352/10476544) finish=0.8min speed=183270K/sec
+      bitmap: 1/1 pages [4KB], 65536KB chunk
+
+md125 : active raid1 vdf1[1] vde1[0]
+      10476544 blocks super 1.2 [2/2] [UU]
+        resync=DELAYED
+
+unused devices: <none>
+'''
+    statuses = parse_mdstat(data)
+    assert set(statuses) == {'md127', 'md125'}
+
+    status = statuses['md127']
+    assert status.action == 'resync'
+    assert status.progress == 8.7
+    assert status.finish == '0.8min'
+    assert status.speed == '183270K/sec'
+
+    assert statuses['md125'].progress is None
+    assert str(statuses['md125']) == 'resync pending'
+
+
+def test_raid_resync_speed_restored_once(monkeypatch):
+    writes = []
+    monkeypatch.setattr('alpaquita_installer.smanager.manager.read_speed_limits', lambda: (1000, 200000))
+    monkeypatch.setattr('alpaquita_installer.smanager.manager.write_speed_limits',
+                        lambda min_limit, max_limit: writes.append((min_limit, max_limit)))
+    manager = StorageManager()
+    manager.raid_resync_speed_limit = 500
+    manager.limit_raid_resync_speed()
+    # Stopping the arrays no longer restores the limits, the installer controller does it
+    manager.deactivate_block_devices()
+    assert writes == [(500, 500)]
+    manager.restore_raid_resync_speed()
+    manager.restore_raid_resync_speed()
+    assert writes == [(500, 500), (1000, 200000)]
+
+
+def test_mount_levels():
+    assert mount_levels([]) == []
+    assert mount_levels(['/home', '/', '/var/log', '/boot/efi', '/var', '/srv/a/b']) == \
+        [['/'], ['/home', '/var', '/boot/efi', '/srv/a/b'], ['/var/log']]
+    # No root, nested into a sibling of a non-mount point
+    assert mount_levels(['/mnt/a/b', '/mnt/a', '/mnt']) == [['/mnt'], ['/mnt/a'], ['/mnt/a/b']]
+
+
+def test_umount_fs_with_retries(monkeypatch):
+    calls = []
+
+    def umount_fs(target: str, lazy: bool = False):
+        calls.append((target, lazy))
+        if not lazy:
+            raise OSError(errno.EBUSY, 'busy', target)
+
+    monkeypatch.setattr('alpaquita_installer.smanager.utils.umount_fs', umount_fs)
+    umount_fs_with_retries('/mnt', retries=3, retry_interval=0)
+    assert calls == [('/mnt', False)] * 3 + [('/mnt', True)]
+
+    def umount_fs_invalid(target: str, lazy: bool = False):
+        calls.append((target, lazy))
+        raise OSError(errno.EINVAL, 'invalid', target)
+
+    calls.clear()
+    monkeypatch.setattr('alpaquita_installer.smanager.utils.umount_fs', umount_fs_invalid)
+    with pytest.raises(OSError):
+        umount_fs_with_retries('/mnt', retries=3, retry_interval=0)
+    assert calls == [('/mnt', False)]
+
+
+def _make_sysfs_disk(sys_block, name: str, device_dir, attrs: dict):
+    device_dir.mkdir(parents=True, exist_ok=True)
+    disk_dir = sys_block / name
+    (disk_dir / 'queue').mkdir(parents=True)
+    (disk_dir / 'device').symlink_to(device_dir)
+    for path, value in attrs.items():
+        (disk_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (disk_dir / path).write_text('{}\n'.format(value))
+
+
+def test_read_disk_properties(tmp_path):
+    sys_block = tmp_path / 'block'
+    devices = tmp_path / 'devices'
+    _make_sysfs_disk(sys_block, 'sda', devices / 'pci0000:00' / 'ata1' / 'host0' / '0:0:0:0',
+                     {'size': 2097152, 'queue/rotational': 1, 'queue/discard_max_bytes': 0,
+                      'queue/optimal_io_size': 0, 'queue/logical_block_size': 512,
+                      'queue/physical_block_size': 4096, 'device/queue_depth': 32,
+                      'device/numa_node': -1, 'removable': 0, 'ro': 0})
+    _make_sysfs_disk(sys_block, 'nvme0n1', devices / 'pci0000:00' / 'nvme' / 'nvme0',
+                     {'size': 4194304, 'queue/rotational': 0, 'queue/discard_max_bytes': 2199023255040,
+                      'queue/optimal_io_size': 131072, 'queue/nr_requests': 1023,
+                      'device/device/numa_node': 1, 'removable': 0, 'ro': 0})
+    # An unreadable 'rotational' attribute
+    _make_sysfs_disk(sys_block, 'sdb', devices / 'pci0000:00' / 'ata2' / 'host1' / '1:0:0:0',
+                     {'size': 2097152})
+    # Virtual devices have no 'device' link
+    (sys_block / 'loop0' / 'queue').mkdir(parents=True)
+
+    sda = read_disk_properties('sda', sys_block=str(sys_block))
+    assert sda.size == 1024 * MB
+    assert sda.media == 'hdd'
+    assert sda.transport == 'sata'
+    assert (sda.discard, sda.numa_node, sda.queue_depth) == (False, None, 32)
+    assert sda.physical_block_size == 4096
+    assert read_disk_properties('sdb', sys_block=str(sys_block)).media == 'hdd'
+
+    disks = scan_disks(sys_block=str(sys_block))
+    assert [d.name for d in disks] == ['nvme0n1', 'sda', 'sdb']
+    nvme = disks[0]
+    assert nvme.media == 'nvme'
+    assert (nvme.discard, nvme.optimal_io_size, nvme.numa_node, nvme.queue_depth) == (True, 131072, 1, 1023)
+    assert nvme.speed_key > sda.speed_key
+
+
+def test_alignment_grain():
+    assert alignment_grain(BlockDeviceTopology()) == MB
+    assert alignment_grain(BlockDeviceTopology(physical_block_size=4096,
+                                               logical_block_size=4096)) == MB
+    # RAID5 over 4 disks with 512K chunks
+    assert alignment_grain(BlockDeviceTopology(optimal_io_size=3 * 512 * 1024)) == 3 * MB
+    # A bogus value reported by some USB bridges
+    assert alignment_grain(BlockDeviceTopology(optimal_io_size=65535 * 512)) == MB
+    # Too large a common multiple
+    assert alignment_grain(BlockDeviceTopology(optimal_io_size=67 * MB // 2)) == 67 * MB // 2
+
+
+def test_partition_layout():
+    size = 1024 * MB
+    assert partition_layout(size, [MB, 300 * MB + 1000, None], grain=MB) == \
+        [(MB, MB), (2 * MB, 300 * MB), (302 * MB, size - 303 * MB)]
+
+    grain = 3 * MB
+    offset = 3584
+    layout = partition_layout(size, [MB, 100 * MB, None], grain=grain, offset=offset)
+    for start, part_size in layout:
+        assert (start - offset) % grain == 0
+        assert part_size % grain == 0
+    assert layout[0] == (3 * MB + offset, 3 * MB)
+    # The backup GPT stays intact
+    start, part_size = layout[-1]
+    assert start + part_size <= size - MB
+
+    with pytest.raises(ValueError, match='do not fit'):
+        partition_layout(size, [size - MB], grain=MB)